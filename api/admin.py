@@ -1,5 +1,10 @@
 from django.contrib import admin
-from .models import Vehicle, Shipment, Company, Profile
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery
+from django.utils import timezone
+from .models import (
+    Vehicle, Shipment, Company, Profile, GeocodeCacheEntry, RouteDistance, Location, LocationAlias, LaneRetry,
+)
+from .retries import requeue_lanes
 
 @admin.register(Vehicle)
 class VehicleAdmin(admin.ModelAdmin):
@@ -13,10 +18,12 @@ class VehicleAdmin(admin.ModelAdmin):
 
 @admin.register(Shipment)
 class ShipmentAdmin(admin.ModelAdmin):
-    list_display = ('id', 'company', 'origin', 'destination', 'carbon_footprint', 'created_at')
-    list_filter = ('created_at', 'vehicle')
+    list_display = ('id', 'company', 'origin', 'destination', 'carbon_footprint', 'metrics_status', 'created_at')
+    list_filter = ('created_at', 'metrics_status', 'vehicle')
+    list_select_related = ('company',)
     # Make carbon_footprint read-only in admin since it's calculated automatically
-    readonly_fields = ('carbon_footprint',)
+    # (the locations are resolved from origin/destination on save)
+    readonly_fields = ('carbon_footprint', 'metrics_status', 'origin_location', 'destination_location')
 
 
 @admin.register(Company)
@@ -26,10 +33,15 @@ class CompanyAdmin(admin.ModelAdmin):
     search_fields = ('name', 'registration_number')
     readonly_fields = ('registration_number', 'created_at')
 
+    def get_queryset(self, request):
+        # Count employees in the changelist query instead of once per row
+        return super().get_queryset(request).annotate(_employee_count=Count('employees'))
+
     # A custom method to show how many people work for this company
     def employee_count(self, obj):
-        return obj.employees.count()
+        return obj._employee_count
     employee_count.short_description = "Number of Employees"
+    employee_count.admin_order_field = '_employee_count'
 
 @admin.register(Profile)
 class ProfileAdmin(admin.ModelAdmin):
@@ -38,4 +50,84 @@ class ProfileAdmin(admin.ModelAdmin):
     search_fields = ('user__username', 'user__email', 'phone_number')
     
     # Allows you to edit the role directly from the list view
-    list_editable = ('role', 'company')
\ No newline at end of file
+    list_editable = ('role', 'company')
+    list_select_related = ('user', 'company')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == 'company' and request is not None:
+            # Every editable row renders the same company dropdown: load it once per request
+            if not hasattr(request, '_company_choices'):
+                request._company_choices = list(formfield.choices)
+            formfield.choices = request._company_choices
+        return formfield
+
+@admin.register(GeocodeCacheEntry)
+class GeocodeCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('name', 'latitude', 'longitude', 'source', 'resolved_at')
+    search_fields = ('name',)
+
+
+@admin.register(RouteDistance)
+class RouteDistanceAdmin(admin.ModelAdmin):
+    list_display = ('origin', 'destination', 'mode', 'distance_km', 'hit_count', 'last_used_at')
+    list_filter = ('mode',)
+    list_select_related = ('origin', 'destination')
+    search_fields = ('origin__name', 'destination__name')
+    # Hottest lanes first
+    ordering = ('-hit_count',)
+
+
+class LocationAliasInline(admin.TabularInline):
+    model = LocationAlias
+    extra = 1
+
+
+@admin.register(Location)
+class LocationAdmin(admin.ModelAdmin):
+    list_display = ('name', 'normalized_name', 'latitude', 'longitude', 'geocoded_by', 'geocoded_at')
+    list_filter = ('geocoded_by',)
+    search_fields = ('name', 'aliases__name')
+    readonly_fields = ('normalized_name', 'geocoded_at', 'created_at')
+    inlines = [LocationAliasInline]
+
+    def save_model(self, request, obj, form, change):
+        # Coordinates typed in by hand
+        if {'latitude', 'longitude'} & set(form.changed_data):
+            obj.geocoded_by = 'manual'
+            obj.geocoded_at = timezone.now()
+            # Cached lanes from the old coordinates (workers reload their pinned lanes on restart)
+            if change:
+                RouteDistance.objects.filter(Q(origin=obj) | Q(destination=obj)).delete()
+        super().save_model(request, obj, form, change)
+
+
+@admin.register(LaneRetry)
+class LaneRetryAdmin(admin.ModelAdmin):
+    list_display = ('origin', 'destination', 'status', 'attempts', 'waiting_shipments', 'next_attempt_at', 'last_error')
+    list_filter = ('status',)
+    list_select_related = ('origin', 'destination')
+    search_fields = ('origin__name', 'destination__name')
+    readonly_fields = ('created_at', 'updated_at')
+    ordering = ('status', 'next_attempt_at')
+    actions = ['retry_now']
+
+    def get_queryset(self, request):
+        # Count the waiting shipments in the changelist query instead of once per row
+        waiting = Shipment.objects.filter(
+            origin_location=OuterRef('origin'), destination_location=OuterRef('destination'),
+            metrics_status__in=['pending', 'failed'],
+        ).order_by().values('origin_location').annotate(count=Count('id')).values('count')
+        return super().get_queryset(request).annotate(
+            _waiting=Subquery(waiting, output_field=IntegerField()),
+        )
+
+    def waiting_shipments(self, obj):
+        return obj._waiting or 0
+    waiting_shipments.short_description = "Waiting shipments"
+    waiting_shipments.admin_order_field = '_waiting'
+
+    @admin.action(description="Retry now (e.g. after fixing a place's name or coordinates)")
+    def retry_now(self, request, queryset):
+        count = requeue_lanes(queryset)
+        self.message_user(request, f"{count} lanes will be retried on the next run.")
@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from .instrumentation import install_query_timer
+        from .search import repair_search_indexes
+        post_migrate.connect(repair_search_indexes, sender=self)
+        # Per-request SQL timings for Server-Timing and /metrics
+        connection_created.connect(install_query_timer)
@@ -0,0 +1,151 @@
+"""
+Async versions of the shipment list/create/detail endpoints, for ASGI servers
+(enabled with ASYNC_VIEWS, see urls.py and the Procfile).
+
+Reads go through the async ORM, so a request waiting on the database no longer
+holds a worker thread. Geocoding is awaited too, but only backends with an
+ageocode() coroutine are truly async: a Nominatim lookup still runs in a thread.
+The parts DRF only offers synchronously (authentication, validation, saving
+through Shipment.save() and its signals) run in a thread for the duration of
+the call.
+Scoping, filters, pagination and payloads are the same as the sync views.
+"""
+from decimal import Decimal
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.http import Http404
+from geopy.exc import GeocoderServiceError
+from rest_framework import status
+from rest_framework.response import Response
+
+from .authentication import user_scope
+from .instrumentation import timed
+from .models import Location, Shipment
+from .pagination import AsyncPageNumberPagination
+from .rows import shipment_records, shipment_values
+from .services import alocation_distance, normalize_place_name
+from .views import ShipmentDetail, ShipmentList
+
+
+class AsyncAPIViewMixin:
+    """
+    APIView.dispatch() for views whose handlers are coroutines. Sync handlers
+    (e.g. DRF's OPTIONS) are run in a thread.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            # Authentication, permissions and throttles may read the DB or cache
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            method = request.method.lower()
+            handler = getattr(self, method, None) if method in self.http_method_names else None
+            if handler is None:
+                handler = self.http_method_not_allowed
+            if iscoroutinefunction(handler):
+                response = await handler(request, *args, **kwargs)
+            else:
+                response = await sync_to_async(handler)(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    def save_serializer(self, serializer, **kwargs):
+        # Saves and renders in one thread hop: the response may need related
+        # rows (owner.username) the async side can't lazy-load
+        serializer.save(**kwargs)
+        return serializer.data
+
+
+class AsyncShipmentList(AsyncAPIViewMixin, ShipmentList):
+    name = "Shipment List"
+    pagination_class = AsyncPageNumberPagination
+
+    def filtered_queryset(self):
+        return self.filter_queryset(self.get_queryset())
+
+    async def get(self, request, *args, **kwargs):
+        # Scoping may load the profile, and search may inspect the schema once
+        queryset = shipment_values(await sync_to_async(self.filtered_queryset)())
+        page = await self.paginator.apaginate_queryset(queryset, request, view=self)
+        if page is None:
+            rows = [row async for row in queryset]
+            with timed('serialize'):
+                return Response(shipment_records(rows))
+        with timed('serialize'):
+            data = shipment_records(page)
+        return self.get_paginated_response(data)
+
+    async def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        await sync_to_async(serializer.is_valid)(raise_exception=True)
+        _, company_id = await sync_to_async(user_scope)(request.user)
+
+        data = serializer.validated_data
+        places = await Location.objects.aresolve_many([data['origin'], data['destination']])
+        origin = places[normalize_place_name(data['origin'])]
+        destination = places[normalize_place_name(data['destination'])]
+
+        # Geocoding is awaited here, so the footprint comes back in the response.
+        # The metrics job only runs when it fails
+        metrics = {}
+        try:
+            km = await alocation_distance(origin, destination)
+        except (GeocoderServiceError, ValueError):
+            # Geocoder down or throttling: saved without metrics, like the sync
+            # view, and the job retries the lane in the background
+            km = None
+        if km is not None:
+            factor = float(data['vehicle'].emission_factor)
+            metrics['distance'] = Decimal(str(round(km, 2)))
+            metrics['carbon_footprint'] = Decimal(str(round(km * float(data['weight']) * factor, 3)))
+            metrics['metrics_status'] = 'ok'
+
+        body = await sync_to_async(self.save_serializer)(
+            serializer, company_id=company_id, owner_id=request.user.id,
+            origin_location=origin, destination_location=destination, **metrics,
+        )
+        return Response(body, status=status.HTTP_201_CREATED, headers=self.get_success_headers(body))
+
+
+class AsyncShipmentDetail(AsyncAPIViewMixin, ShipmentDetail):
+    name = "Shipment Detail"
+
+    async def aget_object(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            obj = await queryset.aget(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        except Shipment.DoesNotExist:
+            raise Http404("No Shipment matches the given query.")
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    async def get(self, request, *args, **kwargs):
+        instance = await self.aget_object()
+        return Response(self.get_serializer(instance).data)
+
+    async def put(self, request, *args, **kwargs):
+        return await self.aupdate(request, partial=False)
+
+    async def patch(self, request, *args, **kwargs):
+        return await self.aupdate(request, partial=True)
+
+    async def aupdate(self, request, partial):
+        instance = await self.aget_object()
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        await sync_to_async(serializer.is_valid)(raise_exception=True)
+        return Response(await sync_to_async(self.save_serializer)(serializer))
+
+    async def delete(self, request, *args, **kwargs):
+        instance = await self.aget_object()
+        await instance.adelete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
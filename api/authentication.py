@@ -0,0 +1,142 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+from .instrumentation import timed
+
+# Claims copied from the profile into every token
+CLAIMS = ('role', 'company_id', 'profile_version')
+
+
+def _version_key(user_id):
+    return f'auth:profile-version:{user_id}'
+
+
+def stamp_claims(token, user):
+    """
+    Writes the user's role, company and profile version into `token`.
+    """
+    profile = user.profile
+    token['username'] = user.username
+    token['is_staff'] = user.is_staff
+    token['role'] = profile.role
+    token['company_id'] = profile.company_id
+    token['profile_version'] = profile.token_version
+    return token
+
+
+def current_profile_version(user_id):
+    """
+    The user's Profile.token_version, from the cache when possible.
+    """
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        from .models import Profile
+        version = Profile.objects.filter(user_id=user_id).values_list('token_version', flat=True).first()
+        if version is None:
+            return None
+        remember_profile_version(user_id, version)
+    return version
+
+
+def remember_profile_version(user_id, version):
+    # A short TTL keeps per-process caches (locmem) from trusting stale
+    # claims for long; with a shared CACHE_URL the bump is seen immediately
+    cache.set(_version_key(user_id), version, getattr(settings, 'AUTH_PROFILE_VERSION_TTL', 60))
+
+
+class ClaimsUser(TokenUser):
+    """
+    request.user for tokens carrying role/company claims: answers id, username,
+    is_staff, role and company_id without touching the database. Anything else
+    (email, profile, ...) loads the real User on first use.
+    """
+
+    @property
+    def id(self):
+        # simplejwt stores the id claim as a string
+        return User._meta.pk.to_python(self.token[api_settings.USER_ID_CLAIM])
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def role(self):
+        return self.token.get('role')
+
+    @property
+    def company_id(self):
+        return self.token.get('company_id')
+
+    @cached_property
+    def user(self):
+        return User.objects.select_related('profile').get(pk=self.id)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') or attr in ('token', 'user'):
+            raise AttributeError(attr)
+        return getattr(self.user, attr)
+
+
+def user_scope(user):
+    """
+    (role, company_id) for request.user, read from the token claims when it has them.
+    """
+    if isinstance(user, ClaimsUser):
+        return user.role, user.company_id
+    profile = user.profile
+    return profile.role, profile.company_id
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that trusts the role/company claims instead of loading the
+    user and profile on every request. A token whose profile version is behind
+    (role, company or staff status changed, user deactivated) is rejected, and the client has
+    to refresh it. Tokens issued without the claims fall back to the DB lookup.
+    """
+
+    def authenticate(self, request):
+        with timed('auth'):
+            return super().authenticate(request)
+
+    def get_user(self, validated_token):
+        if not all(claim in validated_token for claim in CLAIMS):
+            return super().get_user(validated_token)
+
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None:
+            return super().get_user(validated_token)
+        if current_profile_version(user_id) != validated_token['profile_version']:
+            raise AuthenticationFailed("Token claims are out of date, refresh the token.", code='token_stale')
+        return ClaimsUser(validated_token)
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return stamp_claims(super().get_token(user), user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Re-reads the profile on refresh, so the new access token carries the
+    current role and company.
+    """
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user = User.objects.select_related('profile').filter(
+            **{api_settings.USER_ID_FIELD: refresh.get(api_settings.USER_ID_CLAIM)}
+        ).first()
+        if user is None or not user.is_active:
+            raise AuthenticationFailed("No active account found for this token.", code='no_active_account')
+        stamp_claims(refresh, user)
+        return super().validate({**attrs, 'refresh': str(refresh)})
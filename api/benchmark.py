@@ -0,0 +1,313 @@
+import json
+import math
+import random
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from urllib import error, request as urlrequest
+
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.test import Client
+
+from .geocoders import DeterministicGeocoder
+from .models import Company, EmissionRollup, GeocodeCacheEntry, Location, Shipment, Vehicle
+from .rollups import rebuild_emission_rollups
+from .services import location_distance
+
+BENCH_USERNAME = 'bench-manager'
+BENCH_PASSWORD = 'bench-pass-123'
+BENCH_REGISTRATION = 'GP-BENCH'
+# Prefix of everything the register_company scenario creates
+BENCH_PREFIX = 'bench-'
+
+CITIES = [
+    'Nairobi', 'Mombasa', 'Kisumu', 'Nakuru', 'Eldoret', 'Thika', 'Malindi', 'Kitale',
+    'Garissa', 'Nyeri', 'Machakos', 'Meru', 'Lamu', 'Naivasha', 'Voi', 'Kericho',
+]
+VEHICLES = [('Bench Truck', Decimal('0.1000')), ('Bench Van', Decimal('0.2500')), ('Bench Rail', Decimal('0.0300'))]
+
+
+def seed(scale, seed=42, batch_size=1000):
+    """
+    Creates the benchmark company, manager, vehicles and locations, and tops the
+    company up to `scale` shipments. The same seed always produces the same rows.
+    Returns the context the scenarios run with.
+    """
+    rng = random.Random(seed)
+    company = Company.objects.filter(registration_number=BENCH_REGISTRATION).first()
+    if company is None:
+        company = Company.objects.create(name="Benchmark Logistics", registration_number=BENCH_REGISTRATION)
+
+    user = User.objects.filter(username=BENCH_USERNAME).first()
+    if user is None:
+        user = User.objects.create_user(BENCH_USERNAME, f'{BENCH_USERNAME}@example.com', BENCH_PASSWORD)
+    profile = user.profile
+    if (profile.role, profile.company_id) != ('manager', company.id):
+        profile.role, profile.company = 'manager', company
+        profile.save()
+
+    vehicles = [
+        Vehicle.objects.get_or_create(name=name, defaults={'emission_factor': factor})[0]
+        for name, factor in VEHICLES
+    ]
+
+    locations = Location.objects.resolve_many(CITIES)
+    fake = DeterministicGeocoder()
+    for location in locations.values():
+        if location.coordinates is None:
+            location.latitude, location.longitude = fake.point(location.name)
+            location.geocoded_by = fake.name
+            location.save(update_fields=['latitude', 'longitude', 'geocoded_by'])
+    places = [locations[name.casefold()] for name in CITIES]
+
+    existing = Shipment.objects.filter(company=company).count()
+    # Skip the random draws for rows already there, so topping up stays reproducible
+    for _ in range(existing):
+        _draw(rng, places, vehicles)
+    batch = []
+    for _ in range(max(scale - existing, 0)):
+        shipment_id, origin, destination, vehicle, weight = _draw(rng, places, vehicles)
+        distance = Decimal(str(round(location_distance(origin, destination), 2)))
+        batch.append(Shipment(
+            id=shipment_id, company=company, owner=user, vehicle=vehicle,
+            origin=origin.name, destination=destination.name,
+            origin_location=origin, destination_location=destination,
+            weight=weight, distance=distance,
+            carbon_footprint=round(distance * weight * vehicle.emission_factor, 3),
+        ))
+        if len(batch) >= batch_size:
+            Shipment.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Shipment.objects.bulk_create(batch)
+    if scale > existing:
+        rebuild_emission_rollups()
+
+    shipment_ids = list(
+        Shipment.objects.filter(company=company).order_by('id').values_list('id', flat=True)[:1000]
+    )
+    return {
+        'company': company,
+        'user': user,
+        'vehicle_ids': [str(vehicle.id) for vehicle in vehicles],
+        'cities': CITIES,
+        'shipment_ids': [str(pk) for pk in shipment_ids],
+        'run': uuid.uuid4().hex[:8],
+    }
+
+
+def _draw(rng, places, vehicles):
+    origin, destination = rng.sample(places, 2)
+    return (
+        uuid.UUID(int=rng.getrandbits(128), version=4),
+        origin, destination, rng.choice(vehicles),
+        Decimal(str(round(rng.uniform(0.5, 40), 2))),
+    )
+
+
+def cleanup():
+    """
+    Removes the accounts and companies the register_company scenario created, and
+    the shipments and places of shipment_create_new_place.
+    """
+    with transaction.atomic():
+        users = User.objects.filter(username__startswith=BENCH_PREFIX).exclude(username=BENCH_USERNAME)
+        companies = Company.objects.filter(name__startswith=BENCH_PREFIX)
+        removed = users.delete()[0] + companies.delete()[0]
+
+        places = Location.objects.filter(normalized_name__startswith=BENCH_PREFIX)
+        removed += Shipment.objects.filter(destination_location__in=places).delete()[0]
+        removed += EmissionRollup.objects.filter(destination__in=places).delete()[0]
+        removed += GeocodeCacheEntry.objects.filter(name__startswith=BENCH_PREFIX).delete()[0]
+        return removed + places.delete()[0]
+
+
+# Clients: both return the response status code
+
+class InProcessClient:
+    """
+    Calls the Django app directly (no server, no network).
+    """
+
+    def __init__(self):
+        self.client = Client(HTTP_HOST='localhost')
+        self.headers = {}
+
+    def authenticate(self, token):
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+    def request(self, method, path, data=None):
+        kwargs = dict(self.headers)
+        if data is not None:
+            kwargs.update(data=json.dumps(data), content_type='application/json')
+        response = getattr(self.client, method.lower())(path, **kwargs)
+        self.last_body = response.content
+        return response.status_code
+
+
+class HttpClient:
+    """
+    Talks to a running server at `base_url`.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {}
+
+    def authenticate(self, token):
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+    def request(self, method, path, data=None):
+        headers = dict(self.headers)
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urlrequest.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with urlrequest.urlopen(req, timeout=30) as response:
+                self.last_body = response.read()
+                return response.status
+        except error.HTTPError as exc:
+            self.last_body = exc.read()
+            return exc.code
+
+
+def login(client):
+    status = client.request('POST', '/api/login/', {'username': BENCH_USERNAME, 'password': BENCH_PASSWORD})
+    if status != 200:
+        raise RuntimeError(f"Benchmark login failed with HTTP {status}")
+    client.authenticate(json.loads(client.last_body)['access'])
+
+
+# Scenarios: (needs a token, request(client, context, rng, i))
+
+def _create_shipment(client, ctx, rng, i):
+    origin, destination = rng.sample(ctx['cities'], 2)
+    return client.request('POST', '/api/shipments/', {
+        'origin': origin, 'destination': destination,
+        'weight': str(round(rng.uniform(0.5, 40), 2)), 'vehicle': rng.choice(ctx['vehicle_ids']),
+    })
+
+
+def _create_shipment_new_place(client, ctx, rng, i):
+    # A destination nobody shipped to before, so every request has to geocode
+    return client.request('POST', '/api/shipments/', {
+        'origin': rng.choice(ctx['cities']), 'destination': f"{BENCH_PREFIX}{ctx['run']}-town-{i}",
+        'weight': str(round(rng.uniform(0.5, 40), 2)), 'vehicle': rng.choice(ctx['vehicle_ids']),
+    })
+
+
+def _register_company(client, ctx, rng, i):
+    name = f"{BENCH_PREFIX}{ctx['run']}-{i}"
+    return client.request('POST', '/api/auth/register-company/', {
+        'company_name': name, 'username': name, 'email': f'{name}@example.com', 'password': BENCH_PASSWORD,
+    })
+
+
+SCENARIOS = {
+    'login': (False, lambda client, ctx, rng, i: client.request(
+        'POST', '/api/login/', {'username': BENCH_USERNAME, 'password': BENCH_PASSWORD}
+    )),
+    'register_company': (False, _register_company),
+    'vehicles': (False, lambda client, ctx, rng, i: client.request('GET', '/api/vehicles/')),
+    'shipment_list': (True, lambda client, ctx, rng, i: client.request('GET', '/api/shipments/')),
+    'shipment_list_cursor': (True, lambda client, ctx, rng, i: client.request(
+        'GET', '/api/shipments/?pagination=cursor'
+    )),
+    'shipment_detail': (True, lambda client, ctx, rng, i: client.request(
+        'GET', f"/api/shipments/{rng.choice(ctx['shipment_ids'])}/"
+    )),
+    'shipment_create': (True, _create_shipment),
+    'shipment_create_new_place': (True, _create_shipment_new_place),
+}
+
+
+def percentile(ordered, pct):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def run_scenario(name, make_client, ctx, requests, clients, warmup=0, seed=42):
+    """
+    Sends `requests` requests for scenario `name` from `clients` concurrent
+    clients and returns throughput and latency stats (latencies in ms).
+    """
+    authenticated, call = SCENARIOS[name]
+
+    def worker(worker_id, indexes):
+        rng = random.Random(f'{seed}-{name}-{worker_id}')
+        client = make_client()
+        latencies, statuses = [], Counter()
+        try:
+            if authenticated:
+                login(client)
+            for i in range(warmup):
+                call(client, ctx, rng, f'w{worker_id}-{i}')
+            for i in indexes:
+                start = time.perf_counter()
+                try:
+                    status = call(client, ctx, rng, i)
+                except Exception as exc:
+                    status = type(exc).__name__
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[status] += 1
+        finally:
+            connections.close_all()
+        return latencies, statuses
+
+    slices = [range(start, requests, clients) for start in range(clients)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(worker, range(clients), slices))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(latency for worker_latencies, _ in results for latency in worker_latencies)
+    statuses = Counter()
+    for _, worker_statuses in results:
+        statuses.update(worker_statuses)
+    errors = sum(count for status, count in statuses.items() if not (isinstance(status, int) and status < 400))
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p50': _round(percentile(latencies, 50)),
+            'p95': _round(percentile(latencies, 95)),
+            'p99': _round(percentile(latencies, 99)),
+            'max': _round(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+def compare(results, baseline, threshold, metric='p95'):
+    """
+    Regressions of `results` against a previous run: a scenario regresses when its
+    latency `metric` grew, or its throughput dropped, by more than `threshold`
+    (0.1 = 10%). Returns a list of messages, empty when nothing regressed.
+    """
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        before, after = previous['latency_ms'].get(metric), current['latency_ms'].get(metric)
+        if before and after and after > before * (1 + threshold):
+            regressions.append(f"{name}: {metric} {before:.1f}ms -> {after:.1f}ms (+{(after / before - 1):.0%})")
+        before, after = previous.get('throughput_rps'), current.get('throughput_rps')
+        if before and after and after < before * (1 - threshold):
+            regressions.append(f"{name}: throughput {before:.1f} -> {after:.1f} req/s ({(after / before - 1):.0%})")
+        if current['errors'] > previous.get('errors', 0):
+            regressions.append(f"{name}: errors {previous.get('errors', 0)} -> {current['errors']}")
+    return regressions
@@ -0,0 +1,134 @@
+import codecs
+import csv
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from geopy.exc import GeocoderServiceError
+
+from .models import Location, Shipment, Vehicle
+from .services import locate_many, normalize_place_name
+from .serializers import ShipmentSerializer
+from .tasks import compute_metrics_for_shipments
+
+BULK_CONTENT_TYPES = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv',
+}
+
+
+class BulkParseError(Exception):
+    pass
+
+
+def iter_rows(stream, fmt):
+    """
+    Yields one dict per manifest row. NDJSON and CSV are read line by line, so
+    the upload is never held in memory as a whole; a JSON array has to be.
+    """
+    if fmt == 'json':
+        try:
+            rows = json.load(stream)
+        except ValueError as exc:
+            raise BulkParseError(f"Invalid JSON: {exc}")
+        if not isinstance(rows, list):
+            raise BulkParseError("Expected a JSON array of shipments.")
+        yield from rows
+    elif fmt == 'ndjson':
+        for line in codecs.iterdecode(stream, 'utf-8'):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as exc:
+                # Keep going; the row is reported as invalid
+                yield {'__error__': f"Invalid JSON: {exc}"}
+    else:
+        yield from csv.DictReader(codecs.iterdecode(stream, 'utf-8'))
+
+
+def _process_chunk(chunk, context, company_id, owner_id, distance_mode=None):
+    results = {}
+    valid = []
+    for row_number, row in chunk:
+        if not isinstance(row, dict) or '__error__' in row:
+            error = row.get('__error__') if isinstance(row, dict) else "Expected an object."
+            results[row_number] = {'row': row_number, 'status': 'invalid', 'errors': {'non_field_errors': [error]}}
+            continue
+        serializer = ShipmentSerializer(data=row, context=context)
+        if serializer.is_valid():
+            valid.append((row_number, Shipment(company_id=company_id, owner_id=owner_id, **serializer.validated_data)))
+        else:
+            results[row_number] = {'row': row_number, 'status': 'invalid', 'errors': serializer.errors}
+
+    shipments = [shipment for _, shipment in valid]
+    if shipments:
+        # bulk_create skips Shipment.save(), so resolve the chunk's places here in one go
+        locations = Location.objects.resolve_many(
+            name for shipment in shipments for name in (shipment.origin, shipment.destination)
+        )
+        # One instance per place (spellings of it resolve to copies), so it's geocoded once
+        places = {}
+        for key, location in locations.items():
+            locations[key] = places.setdefault(location.id, location)
+        for shipment in shipments:
+            shipment.origin_location = locations[normalize_place_name(shipment.origin)]
+            shipment.destination_location = locations[normalize_place_name(shipment.destination)]
+
+        # Geocoded before the transaction, so no lock is held while waiting on the
+        # geocoder; places it can't find leave their lanes 'pending' for a retry
+        geocode_error = ''
+        try:
+            locate_many(list(places.values()))
+        except GeocoderServiceError as exc:
+            geocode_error = str(exc)
+
+        with transaction.atomic():
+            # bulk_create skips Shipment.save(), so no per-row task runs here
+            Shipment.objects.bulk_create(shipments)
+        compute_metrics_for_shipments(shipments, distance_mode=distance_mode, geocode_error=geocode_error)
+
+    for row_number, shipment in valid:
+        results[row_number] = {
+            'row': row_number,
+            'status': 'created',
+            'id': shipment.id,
+            'distance': None if shipment.distance is None else round(float(shipment.distance), 2),
+            'carbon_footprint': None if shipment.carbon_footprint is None else round(shipment.carbon_footprint, 3),
+            'metrics_status': shipment.metrics_status,
+        }
+    return [results[row_number] for row_number, _ in chunk]
+
+
+def ingest_shipments(rows, company_id, owner_id, chunk_size=None, distance_mode=None):
+    """
+    Validates, inserts and computes metrics for manifest rows chunk by chunk,
+    yielding one NDJSON line per row followed by a summary line. Distances use
+    `distance_mode` (see api.distance), the DISTANCE_MODE setting by default.
+    """
+    chunk_size = chunk_size or getattr(settings, 'BULK_INGEST_CHUNK_SIZE', 1000)
+    # Vehicles are a small lookup table: load it once for the whole upload
+    context = {'vehicles': {vehicle.id: vehicle for vehicle in Vehicle.objects.all()}}
+    numbered = enumerate(rows, start=1)
+    created = invalid = 0
+
+    try:
+        while True:
+            chunk = list(islice(numbered, chunk_size))
+            if not chunk:
+                break
+            for result in _process_chunk(chunk, context, company_id, owner_id, distance_mode):
+                if result['status'] == 'created':
+                    created += 1
+                else:
+                    invalid += 1
+                yield json.dumps(result, cls=DjangoJSONEncoder) + '\n'
+    except (BulkParseError, UnicodeDecodeError, csv.Error) as exc:
+        yield json.dumps({'error': str(exc)}) + '\n'
+
+    yield json.dumps({'summary': {'created': created, 'invalid': invalid}}) + '\n'
@@ -0,0 +1,220 @@
+import random
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connections
+from django.utils import timezone
+
+from .benchmark import CITIES
+from .distance import haversine_km
+from .geocoders import DeterministicGeocoder
+from .models import Company, Location, LocationAlias, Profile, Shipment, Vehicle
+from .services import normalize_place_name
+
+# (name, kg CO2 per ton-km, share of shipments)
+VEHICLE_TYPES = [
+    ('Articulated Truck 40t', Decimal('0.0620'), 0.30),
+    ('Rigid Truck 12t', Decimal('0.1050'), 0.25),
+    ('Van 3.5t', Decimal('0.2800'), 0.18),
+    ('Electric Van', Decimal('0.0500'), 0.07),
+    ('Rail Freight', Decimal('0.0220'), 0.08),
+    ('Inland Barge', Decimal('0.0310'), 0.04),
+    ('Motorbike Courier', Decimal('0.3500'), 0.06),
+    ('Air Freight', Decimal('0.6020'), 0.02),
+]
+
+
+def zipf_weights(n, exponent):
+    """
+    Probabilities proportional to 1 / rank**exponent: a few items get most of the traffic.
+    """
+    weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** exponent
+    return weights / weights.sum()
+
+
+def create_reference_data(tag, seed, companies, users_per_company, locations):
+    """
+    Creates the vehicles, locations, companies, users and profiles a dataset
+    needs, with bulk_create (no post_save signals, no Company.save()). Returns
+    the plan the shipment workers sample from.
+    """
+    rng = random.Random(seed)
+    fake = DeterministicGeocoder()
+
+    vehicles = [
+        Vehicle(name=f'{tag} {name}', emission_factor=factor, description="Synthetic dataset vehicle")
+        for name, factor, _ in VEHICLE_TYPES
+    ]
+    Vehicle.objects.bulk_create(vehicles, ignore_conflicts=True)
+    vehicles = {v.name: v for v in Vehicle.objects.filter(name__in=[v.name for v in vehicles])}
+    vehicles = [vehicles[f'{tag} {name}'] for name, _, _ in VEHICLE_TYPES]
+
+    names = CITIES + [f'{tag} Town {i:05d}' for i in range(max(locations - len(CITIES), 0))]
+    names = names[:locations]
+    places = []
+    for name in names:
+        lat, lon = fake.point(name)
+        places.append(Location(
+            name=name, normalized_name=normalize_place_name(name),
+            latitude=lat, longitude=lon, geocoded_by=fake.name, geocoded_at=timezone.now(),
+        ))
+    Location.objects.bulk_create(places, batch_size=2000, ignore_conflicts=True)
+    by_key = {loc.normalized_name: loc for loc in Location.objects.filter(normalized_name__in=[p.normalized_name for p in places])}
+    LocationAlias.objects.bulk_create(
+        [LocationAlias(name=key, location=loc) for key, loc in by_key.items()], batch_size=2000, ignore_conflicts=True
+    )
+    places = [by_key[normalize_place_name(name)] for name in names]
+    # Locations still missing coordinates (created earlier by real traffic)
+    missing = [loc for loc in places if loc.latitude is None]
+    for loc in missing:
+        loc.latitude, loc.longitude = fake.point(loc.name)
+        loc.geocoded_by = fake.name
+    Location.objects.bulk_update(missing, ['latitude', 'longitude', 'geocoded_by'], batch_size=2000)
+
+    company_rows = Company.objects.bulk_create([
+        Company(name=f'{tag} Company {i:04d}', registration_number=f'GP-{tag.upper()}{seed:x}{i:04d}'[:100])
+        for i in range(companies)
+    ], batch_size=2000)
+
+    # One hash for every generated account: hashing per user would take hours
+    password = make_password(f'{tag}-password')
+    users, roles = [], []
+    for c, company in enumerate(company_rows):
+        for u in range(users_per_company):
+            role = 'manager' if u == 0 else rng.choices(['driver', 'client'], weights=[0.7, 0.3])[0]
+            users.append(User(
+                username=f'{tag}-{c:04d}-{u:04d}', email=f'{tag}-{c:04d}-{u:04d}@example.com', password=password,
+            ))
+            roles.append((company, role))
+    User.objects.bulk_create(users, batch_size=2000)
+    Profile.objects.bulk_create(
+        [Profile(user=user, company=company, role=role) for user, (company, role) in zip(users, roles)],
+        batch_size=2000,
+    )
+
+    # Shipments are owned by the managers and drivers of their company
+    owners = {}
+    for user, (company, role) in zip(users, roles):
+        if role != 'client':
+            owners.setdefault(company.id, []).append(user.id)
+    owner_ids, owner_start, owner_count = [], [], []
+    for company in company_rows:
+        ids = owners.get(company.id, [])
+        owner_start.append(len(owner_ids))
+        owner_count.append(len(ids))
+        owner_ids.extend(ids)
+
+    return {
+        'company_ids': [company.id for company in company_rows],
+        'owner_ids': owner_ids,
+        'owner_start': owner_start,
+        'owner_count': owner_count,
+        'vehicle_ids': [str(vehicle.id) for vehicle in vehicles],
+        'vehicle_factors': [float(vehicle.emission_factor) for vehicle in vehicles],
+        'vehicle_shares': [share for _, _, share in VEHICLE_TYPES],
+        'location_ids': [loc.id for loc in places],
+        'location_names': [loc.name for loc in places],
+        'latitudes': [loc.latitude for loc in places],
+        'longitudes': [loc.longitude for loc in places],
+    }
+
+
+@contextmanager
+def keep_created_at():
+    # bulk_create would stamp every row with now() through auto_now_add
+    field = Shipment._meta.get_field('created_at')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+def build_shipments(plan, seed, chunk_index, size, options):
+    """
+    The Shipment objects of one chunk. Every chunk has its own random stream
+    derived from (seed, chunk_index), so the data doesn't depend on how chunks
+    are spread over workers.
+    """
+    rng = np.random.default_rng([seed, chunk_index])
+    companies = len(plan['company_ids'])
+    locations = len(plan['location_ids'])
+
+    # Skew: a few big shippers, a few hub cities carrying most lanes
+    company = rng.choice(companies, size, p=zipf_weights(companies, options['company_skew']))
+    location_p = zipf_weights(locations, options['lane_skew'])
+    origin = rng.choice(locations, size, p=location_p)
+    destination = rng.choice(locations, size, p=location_p)
+    # Redraw round trips to the same city; shifting them to a neighbour would skew the lanes
+    same = destination == origin
+    while same.any():
+        destination[same] = rng.choice(locations, int(same.sum()), p=location_p)
+        same = destination == origin
+
+    owner_start = np.asarray(plan['owner_start'])[company]
+    owner_count = np.asarray(plan['owner_count'])[company]
+    owner = owner_start + (rng.random(size) * np.maximum(owner_count, 1)).astype(np.int64)
+
+    shares = np.asarray(plan['vehicle_shares'])
+    vehicle = rng.choice(len(plan['vehicle_ids']), size, p=shares / shares.sum())
+
+    lat, lon = np.asarray(plan['latitudes']), np.asarray(plan['longitudes'])
+    distance = np.round(haversine_km(lat[origin], lon[origin], lat[destination], lon[destination]), 2)
+    distance = np.maximum(distance, 0.1)
+    weight = np.round(np.clip(rng.lognormal(mean=1.5, sigma=0.8, size=size), 0.1, 40), 2)
+    carbon = np.round(distance * weight * np.asarray(plan['vehicle_factors'])[vehicle], 3)
+    age = rng.random(size) * options['days'] * 86400
+    ids = rng.bytes(16 * size)
+
+    now = options['now']
+    names, location_ids = plan['location_names'], plan['location_ids']
+    owner_ids, company_ids, vehicle_ids = plan['owner_ids'], plan['company_ids'], plan['vehicle_ids']
+    shipments = []
+    for i in range(size):
+        o, d = int(origin[i]), int(destination[i])
+        shipments.append(Shipment(
+            id=uuid.UUID(bytes=ids[16 * i:16 * (i + 1)], version=4),
+            company_id=company_ids[company[i]],
+            owner_id=owner_ids[owner[i]] if owner_count[i] else None,
+            vehicle_id=vehicle_ids[vehicle[i]],
+            origin=names[o], destination=names[d],
+            origin_location_id=location_ids[o], destination_location_id=location_ids[d],
+            weight=Decimal(f'{weight[i]:.2f}'),
+            distance=Decimal(f'{distance[i]:.2f}'),
+            carbon_footprint=Decimal(f'{carbon[i]:.3f}'),
+            metrics_status='ok',
+            created_at=now - timedelta(seconds=float(age[i])),
+        ))
+    return shipments
+
+
+# Worker process state, set once by init_worker
+_worker = {}
+
+
+def init_worker(plan, seed, options):
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        # Spawned (not forked) workers start without Django
+        django.setup()
+    # Never share the parent's DB connection across processes
+    connections.close_all()
+    _worker.update(plan=plan, seed=seed, options=options)
+
+
+def insert_chunk(job):
+    """
+    Builds and inserts chunk `job` = (chunk_index, size). Returns the row count.
+    """
+    chunk_index, size = job
+    shipments = build_shipments(_worker['plan'], _worker['seed'], chunk_index, size, _worker['options'])
+    with keep_created_at():
+        Shipment.objects.bulk_create(shipments, batch_size=_worker['options']['batch_size'])
+    return size
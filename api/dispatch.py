@@ -0,0 +1,215 @@
+"""
+Background dispatch for the metric tasks.
+
+Jobs are sent once the surrounding transaction commits, so a worker never looks
+for a shipment that isn't visible yet, and the same job queued several times in
+one transaction is only sent once. METRICS_DISPATCH picks where they run:
+
+    'celery' - task.delay() through the broker in CELERY_BROKER_URL
+    'local'  - an in-process thread pool, a stand-in broker when there's no Redis
+    'eager'  - inline in the caller, the old behaviour (useful in tests)
+
+Jobs queued with a batch_task are coalesced: several of them committed together
+go out as one batch job, and so do jobs arriving faster than
+METRICS_BATCH_THRESHOLD per second, buffered for up to METRICS_BATCH_WINDOW
+seconds (see Batcher).
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class LocalWorker:
+    """
+    Thread-pool worker for METRICS_DISPATCH = 'local'. A job that is already
+    waiting in the queue isn't queued twice.
+    """
+
+    def __init__(self, threads):
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='metrics-worker')
+        self._queued = set()
+        self._lock = threading.Lock()
+
+    def submit(self, task, args):
+        key = (task.name, args)
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+        self._executor.submit(self._run, key, task, args)
+
+    def _run(self, key, task, args):
+        with self._lock:
+            # Saves from here on need a fresh run, since this one may read stale rows
+            self._queued.discard(key)
+        try:
+            task(*args)
+        except Exception:
+            logger.exception("Local job %s%r failed", task.name, args)
+        finally:
+            connections.close_all()
+
+
+_local_worker = None
+_local_worker_lock = threading.Lock()
+
+
+def get_local_worker():
+    global _local_worker
+    with _local_worker_lock:
+        if _local_worker is None:
+            _local_worker = LocalWorker(getattr(settings, 'LOCAL_WORKER_THREADS', 4))
+        return _local_worker
+
+
+def _dispatch(task, args):
+    mode = getattr(settings, 'METRICS_DISPATCH', 'eager')
+    if mode == 'celery':
+        task.delay(*args)
+    elif mode == 'local':
+        get_local_worker().submit(task, args)
+    else:
+        task(*args)
+
+
+class Batcher:
+    """
+    Switches a job to its batch task under load. While jobs arrive slower than
+    `threshold` per second each one is sent on its own, as before. Past that,
+    their ids are buffered and sent as batch_task(ids) every `window` seconds,
+    or as soon as `max_size` are waiting.
+
+    The buffer lives in this process: it's flushed at exit, but a crash loses
+    at most `window` seconds of jobs. Their shipments stay 'pending' until the
+    periodic retry job sends them again, METRICS_STALE_AFTER seconds later
+    (api.retries.redispatch_stale_shipments).
+    """
+
+    def __init__(self, threshold, window, max_size):
+        self.threshold = threshold
+        self.window = window
+        self.max_size = max_size
+        # Times of the last `threshold` arrivals
+        self._arrivals = deque(maxlen=max(threshold, 1))
+        self._buffers = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self.stats = {'single': 0, 'batched': 0, 'batches': 0}
+
+    def busy(self, now):
+        # Called with the lock held
+        self._arrivals.append(now)
+        return len(self._arrivals) == self._arrivals.maxlen and now - self._arrivals[0] < 1.0
+
+    def add(self, task, batch_task, args):
+        full = None
+        with self._lock:
+            if not (self.busy(time.monotonic()) or self._buffers):
+                self.stats['single'] += 1
+                batch_task = None
+            else:
+                self.stats['batched'] += 1
+                ids = self._buffers.setdefault(batch_task, [])
+                ids.append(args[0])
+                if len(ids) >= self.max_size:
+                    full = self._buffers.pop(batch_task)
+                elif self._timer is None:
+                    self._timer = threading.Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch_task is None:
+            _dispatch(task, args)
+        elif full:
+            self.send(batch_task, full)
+
+    def flush(self):
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+            self._timer = None
+        for batch_task, ids in buffers.items():
+            self.send(batch_task, ids)
+
+    def send(self, batch_task, ids):
+        with self._lock:
+            self.stats['batches'] += 1
+        # A tuple, so the local worker can tell queued batches apart
+        _dispatch(batch_task, (tuple(dict.fromkeys(ids)),))
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = Batcher(
+                threshold=getattr(settings, 'METRICS_BATCH_THRESHOLD', 20),
+                window=getattr(settings, 'METRICS_BATCH_WINDOW', 0.2),
+                max_size=getattr(settings, 'METRICS_BATCH_SIZE', 500),
+            )
+            atexit.register(_batcher.flush)
+        return _batcher
+
+
+def _send(task, args, batch_task=None):
+    batching = (
+        batch_task is not None
+        and getattr(settings, 'METRICS_DISPATCH', 'eager') != 'eager'
+        and getattr(settings, 'METRICS_BATCH_THRESHOLD', 20)
+    )
+    if batching:
+        get_batcher().add(task, batch_task, args)
+    else:
+        _dispatch(task, args)
+
+
+_pending = threading.local()
+
+
+def enqueue(task, *args, batch_task=None):
+    """
+    Runs task(*args) after the current transaction commits (right away in autocommit).
+    With `batch_task`, the job may run as part of batch_task([args[0], ...]) instead.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        _send(task, args, batch_task)
+        return
+
+    state = getattr(_pending, 'state', None)
+    # After a rollback our flush callback is gone from the connection; start over
+    if state is None or not any(entry[1] is state['flush'] for entry in connection.run_on_commit):
+        jobs = {}
+
+        def flush():
+            # Jobs queued from here on belong to the next commit
+            if getattr(_pending, 'state', None) is state:
+                _pending.state = None
+            batches = {}
+            for (_, job_args), (job_task, job_batch_task) in jobs.items():
+                if job_batch_task is None:
+                    _dispatch(job_task, job_args)
+                else:
+                    batches.setdefault(job_batch_task, []).append((job_task, job_args))
+            for job_batch_task, batch in batches.items():
+                if len(batch) == 1:
+                    _send(*batch[0], job_batch_task)
+                else:
+                    # Committed together, sent together
+                    _dispatch(job_batch_task, (tuple(job_args[0] for _, job_args in batch),))
+
+        state = {'flush': flush, 'jobs': jobs}
+        _pending.state = state
+        transaction.on_commit(flush)
+
+    state['jobs'][(task.name, args)] = (task, batch_task)
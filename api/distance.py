@@ -0,0 +1,151 @@
+"""
+Great-circle and ellipsoidal distances, one pair or whole batches at a time.
+
+Modes (DISTANCE_MODE setting, or passed per call):
+
+- 'geodesic': Karney's algorithm on the WGS-84 ellipsoid (geographiclib, what
+  geopy.distance.geodesic uses). Accurate to a few nanometres. The reference,
+  but pure Python: batches are computed pair by pair.
+- 'vincenty': Vincenty's inverse formula on WGS-84, vectorized with NumPy.
+  Within 1 mm of geodesic and some 250x faster on batches of lanes, but no
+  faster for a single pair. The iteration doesn't converge for nearly
+  antipodal points; those pairs fall back to geodesic.
+- 'haversine': spherical law with the mean Earth radius, vectorized with
+  NumPy. Off by up to 0.56% against geodesic (0.2% on average), well inside
+  the uncertainty of any emission factor, and over 1000x faster on batches.
+
+The bounds above are measured by `manage.py benchmark_distance`, which also
+times every mode.
+"""
+import math
+
+import numpy as np
+from django.conf import settings
+from geographiclib.geodesic import Geodesic
+
+DISTANCE_MODES = ('geodesic', 'vincenty', 'haversine')
+
+# Mean Earth radius (IUGG), the best sphere for WGS-84 distances
+EARTH_RADIUS_KM = 6371.0088
+
+# WGS-84 ellipsoid, in km
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+VINCENTY_MAX_ITERATIONS = 200
+VINCENTY_TOLERANCE = 1e-12
+
+
+def get_distance_mode(mode=None):
+    """
+    Validates `mode`, or returns the DISTANCE_MODE setting when it's empty.
+    Raises ValueError for unknown modes.
+    """
+    mode = mode or getattr(settings, 'DISTANCE_MODE', 'geodesic')
+    if mode not in DISTANCE_MODES:
+        raise ValueError(f"Unknown distance mode '{mode}'. Use one of: {', '.join(DISTANCE_MODES)}.")
+    return mode
+
+
+def geodesic_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(a, dtype=np.float64) for a in (lat1, lon1, lat2, lon2)))
+    inverse = Geodesic.WGS84.Inverse
+    km = np.fromiter(
+        (inverse(*pair, Geodesic.DISTANCE)['s12'] for pair in zip(lat1.flat, lon1.flat, lat2.flat, lon2.flat)),
+        dtype=np.float64, count=lat1.size,
+    )
+    return km.reshape(lat1.shape) / 1000
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def vincenty_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(a, dtype=np.float64) for a in (lat1, lon1, lat2, lon2)))
+    shape = lat1.shape
+    lat1, lon1, lat2, lon2 = (a.ravel() for a in (lat1, lon1, lat2, lon2))
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(U1), np.cos(U1)
+    sin_u2, cos_u2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    sin_sigma, cos_sigma, sigma = np.empty_like(L), np.empty_like(L), np.empty_like(L)
+    cos2_alpha, cos_2sigma_m = np.empty_like(L), np.empty_like(L)
+    # Each pass only works on the pairs that haven't converged yet: most take a
+    # handful of iterations, a few near-antipodal ones take hundreds
+    todo = np.arange(L.size)
+    # Coincident points and equatorial lines divide by zero below; they're fixed up after the loop
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(VINCENTY_MAX_ITERATIONS):
+            su1, cu1, su2, cu2 = sin_u1[todo], cos_u1[todo], sin_u2[todo], cos_u2[todo]
+            sin_lam, cos_lam = np.sin(lam[todo]), np.cos(lam[todo])
+            s_sigma = np.hypot(cu2 * sin_lam, cu1 * su2 - su1 * cu2 * cos_lam)
+            c_sigma = su1 * su2 + cu1 * cu2 * cos_lam
+            sig = np.arctan2(s_sigma, c_sigma)
+            sin_alpha = np.where(s_sigma == 0, 0.0, cu1 * cu2 * sin_lam / s_sigma)
+            c2_alpha = 1 - sin_alpha ** 2
+            c_2sigma_m = np.where(c2_alpha == 0, 0.0, c_sigma - 2 * su1 * su2 / c2_alpha)
+            C = WGS84_F / 16 * c2_alpha * (4 + WGS84_F * (4 - 3 * c2_alpha))
+            updated = L[todo] + (1 - C) * WGS84_F * sin_alpha * (
+                sig + C * s_sigma * (c_2sigma_m + C * c_sigma * (-1 + 2 * c_2sigma_m ** 2))
+            )
+            moving = np.abs(updated - lam[todo]) > VINCENTY_TOLERANCE
+            lam[todo] = updated
+            sin_sigma[todo], cos_sigma[todo], sigma[todo] = s_sigma, c_sigma, sig
+            cos2_alpha[todo], cos_2sigma_m[todo] = c2_alpha, c_2sigma_m
+            todo = todo[moving]
+            if not todo.size:
+                break
+
+        u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        ))
+        km = WGS84_B * A * (sigma - delta_sigma)
+
+    km = np.where(sin_sigma == 0, 0.0, km)
+    # Nearly antipodal pairs never converge
+    failed = ~np.isfinite(km)
+    failed[todo] = True
+    if failed.any():
+        km[failed] = geodesic_km(lat1[failed], lon1[failed], lat2[failed], lon2[failed])
+    return km.reshape(shape)
+
+
+_ENGINES = {'geodesic': geodesic_km, 'vincenty': vincenty_km, 'haversine': haversine_km}
+
+
+def distances_km(lat1, lon1, lat2, lon2, mode=None):
+    """
+    Distances in kilometers between (lat1, lon1) and (lat2, lon2), element-wise
+    over arrays (or sequences) of degrees. Returns a float64 array.
+    """
+    return _ENGINES[get_distance_mode(mode)](
+        np.asarray(lat1, dtype=np.float64), np.asarray(lon1, dtype=np.float64),
+        np.asarray(lat2, dtype=np.float64), np.asarray(lon2, dtype=np.float64),
+    )
+
+
+def distance_km(point1, point2, mode=None):
+    """
+    Distance in kilometers between two (latitude, longitude) points.
+    """
+    mode = get_distance_mode(mode)
+    (lat1, lon1), (lat2, lon2) = point1, point2
+    if mode == 'geodesic':
+        return Geodesic.WGS84.Inverse(lat1, lon1, lat2, lon2, Geodesic.DISTANCE)['s12'] / 1000
+    if mode == 'haversine':
+        # Plain math is several times faster than NumPy for a single pair
+        lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+    return float(vincenty_km(lat1, lon1, lat2, lon2))
@@ -0,0 +1,58 @@
+import csv
+import io
+import zlib
+
+import orjson
+from django.conf import settings
+
+from .rows import SHIPMENT_COLUMNS, column_converters
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _iter_records(queryset, chunk_size):
+    # Same columns as ShipmentSerializer, rendered the same way (see api/rows.py)
+    converters = column_converters()
+    rows = queryset.values_list(*(lookup for _, lookup in SHIPMENT_COLUMNS)).iterator(chunk_size=chunk_size)
+    for row in rows:
+        yield [value if convert is None else convert(value) for convert, value in zip(converters, row)]
+
+
+def export_rows(queryset, fmt, chunk_size=None):
+    """
+    Yields the export body in chunks of `chunk_size` rows.
+    """
+    chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+    names = [name for name, _ in SHIPMENT_COLUMNS]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(names)
+
+    for i, record in enumerate(_iter_records(queryset, chunk_size), start=1):
+        if fmt == 'csv':
+            writer.writerow(['' if value is None else value for value in record])
+        else:
+            buffer.write(orjson.dumps(dict(zip(names, record)), option=orjson.OPT_APPEND_NEWLINE).decode())
+        if i % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_stream(chunks):
+    """
+    Gzips a stream of text chunks on the fly.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
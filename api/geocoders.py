@@ -0,0 +1,339 @@
+import asyncio
+import bisect
+import csv
+import difflib
+import hashlib
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from geopy.exc import GeocoderRateLimited
+from geopy.geocoders import Nominatim
+
+from .services import normalize_place_name
+
+
+class TokenBucket:
+    """
+    Token bucket kept in the Django cache, so every thread and every process
+    sharing CACHE_URL (web and Celery workers) draws from the same budget:
+    `rate` tokens per second, up to `burst` saved up. With the default
+    local-memory cache the limit only holds per process.
+
+    A caller that finds the bucket empty reserves the next free token and
+    sleeps until it's due, so waiters are served in order without polling.
+    """
+    # Kept past the longest possible debt, then the bucket simply starts full again
+    STATE_TTL = 3600
+    LOCK_TTL = 2
+
+    def __init__(self, key, rate, burst=1, timeout=10, max_waiting=20):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self._waiting = 0
+        self._waiting_lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is ours. Raises GeocoderRateLimited instead when
+        too many lookups are already queued in this process, or when the wait
+        would exceed `timeout`.
+        """
+        with self._waiting_lock:
+            if self._waiting >= self.max_waiting:
+                raise GeocoderRateLimited(f"{self._waiting} geocoder lookups already waiting for {self.key}")
+            self._waiting += 1
+        try:
+            wait = self._reserve()
+            if wait is None:
+                raise GeocoderRateLimited(f"No {self.key} token within {self.timeout}s", retry_after=self.timeout)
+            if wait > 0:
+                time.sleep(wait)
+        finally:
+            with self._waiting_lock:
+                self._waiting -= 1
+
+    def _reserve(self):
+        # Seconds until the reserved token is due, or None (nothing reserved) if
+        # that's later than `timeout`
+        with self._locked():
+            now = time.time()
+            tokens, stamp = cache.get(self.key) or (self.burst, now)
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if wait > self.timeout:
+                return None
+            cache.set(self.key, (tokens - 1, now), self.STATE_TTL)
+            return wait
+
+    @contextmanager
+    def _locked(self):
+        # cache.add() is atomic on every backend; the TTL frees the lock if its
+        # holder dies in between
+        lock = f'{self.key}:lock'
+        while not cache.add(lock, 1, self.LOCK_TTL):
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            cache.delete(lock)
+
+
+class NominatimGeocoder:
+    """
+    Online lookups through OpenStreetMap's Nominatim service, throttled to
+    GEOCODER_RATE_LIMIT requests per second across all workers (their usage
+    policy allows one). Blocking only: there is no ageocode(), so the async
+    views run it in a worker thread.
+    """
+    name = 'nominatim'
+
+    def __init__(self):
+        self.client = Nominatim(user_agent="green_path_logistics", timeout=getattr(settings, 'GEOCODER_TIMEOUT', 5))
+        self.bucket = TokenBucket(
+            'geocoder:nominatim',
+            rate=getattr(settings, 'GEOCODER_RATE_LIMIT', 1.0),
+            burst=getattr(settings, 'GEOCODER_RATE_BURST', 1),
+            timeout=getattr(settings, 'GEOCODER_QUEUE_TIMEOUT', 10),
+            max_waiting=getattr(settings, 'GEOCODER_QUEUE_SIZE', 20),
+        )
+
+    def geocode(self, place_name):
+        self.bucket.acquire()
+        location = self.client.geocode(place_name)
+        if location is None:
+            return None
+        return (location.latitude, location.longitude)
+
+
+class GazetteerIndex:
+    """
+    Array-backed name index over a GeoNames-style gazetteer.
+
+    Every name and alternate name is normalized and kept in one sorted list, with a
+    parallel array pointing at the place it belongs to. Coordinates live in flat
+    double arrays, so a 100k-place file costs a few MB and an exact lookup is a
+    single bisect.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.places = array('I')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+
+    @classmethod
+    def from_tsv(cls, path):
+        """
+        Loads a GeoNames dump (geonameid, name, asciiname, alternatenames,
+        latitude, longitude, ..., population in column 15). Rows with fewer
+        columns are accepted as long as latitude/longitude are present.
+        """
+        index = cls()
+        best = {}  # normalized name -> (population, place)
+        with open(path, encoding='utf-8', newline='') as fh:
+            for row in csv.reader(fh, delimiter='\t', quoting=csv.QUOTE_NONE):
+                if len(row) < 6 or row[0].startswith('#'):
+                    continue
+                try:
+                    lat, lon = float(row[4]), float(row[5])
+                except ValueError:
+                    continue
+                population = int(row[14]) if len(row) > 14 and row[14].isdigit() else 0
+
+                place = len(index.latitudes)
+                index.latitudes.append(lat)
+                index.longitudes.append(lon)
+
+                aliases = {row[1], row[2], *row[3].split(',')}
+                for alias in aliases:
+                    key = normalize_place_name(alias)
+                    # Ambiguous names resolve to the most populous place
+                    if key and (key not in best or population > best[key][0]):
+                        best[key] = (population, place)
+
+        for key in sorted(best):
+            index.names.append(key)
+            index.places.append(best[key][1])
+        return index
+
+    def __len__(self):
+        return len(self.names)
+
+    def _coords(self, i):
+        place = self.places[i]
+        return (self.latitudes[place], self.longitudes[place])
+
+    def lookup(self, name):
+        key = normalize_place_name(name)
+        i = bisect.bisect_left(self.names, key)
+        if i < len(self.names) and self.names[i] == key:
+            return self._coords(i)
+        return None
+
+    def _prefix_range(self, prefix):
+        lo = bisect.bisect_left(self.names, prefix)
+        hi = bisect.bisect_left(self.names, prefix + '\uffff', lo)
+        return lo, hi
+
+    def prefix(self, prefix, limit=10):
+        """
+        Names starting with `prefix`, as (name, (lat, lon)) pairs.
+        """
+        lo, hi = self._prefix_range(normalize_place_name(prefix))
+        return [(self.names[i], self._coords(i)) for i in range(lo, min(hi, lo + limit))]
+
+    def fuzzy(self, name, cutoff=0.85):
+        """
+        Closest spelling among names sharing the first three letters, for typos
+        like "Nairobbi" or "Mombassa". Only names whose length could still reach
+        `cutoff` are compared, so a miss costs a handful of comparisons rather
+        than one per name in a crowded prefix.
+        """
+        key = normalize_place_name(name)
+        if len(key) < 3:
+            return None
+        lo, hi = self._prefix_range(key[:3])
+        # ratio() is 2 * matches / total length, and matches can't exceed the
+        # shorter name: lengths outside this window can never score `cutoff`
+        shortest, longest = len(key) * cutoff / (2 - cutoff), len(key) * (2 - cutoff) / cutoff
+        candidates = [candidate for candidate in self.names[lo:hi] if shortest <= len(candidate) <= longest]
+        if not candidates:
+            return None
+        matches = difflib.get_close_matches(key, candidates, n=1, cutoff=cutoff)
+        if not matches:
+            return None
+        return self.lookup(matches[0])
+
+
+_gazetteers = {}
+_gazetteers_lock = threading.Lock()
+
+
+def load_gazetteer(path):
+    """
+    Returns the index for `path`, building it on first use (once per process).
+    """
+    with _gazetteers_lock:
+        if path not in _gazetteers:
+            _gazetteers[path] = GazetteerIndex.from_tsv(path)
+        return _gazetteers[path]
+
+
+class GazetteerGeocoder:
+    """
+    Offline lookups against the local gazetteer in GEOCODER_GAZETTEER_PATH.
+    """
+    name = 'gazetteer'
+
+    def __init__(self, path=None):
+        self.path = path or settings.GEOCODER_GAZETTEER_PATH
+
+    @property
+    def index(self):
+        return load_gazetteer(self.path)
+
+    def geocode(self, place_name):
+        index = self.index
+        coords = index.lookup(place_name)
+        if coords is None and ',' in place_name:
+            # "Nairobi, Kenya" -> "Nairobi"
+            coords = index.lookup(place_name.split(',')[0])
+        if coords is None:
+            coords = index.fuzzy(place_name.split(',')[0])
+        return coords
+
+
+class DeterministicGeocoder:
+    """
+    Offline stand-in for benchmarks: every name maps to a fixed point inside
+    Kenya derived from a hash of the normalized name. Never touches the network
+    and always gives the same answer, so runs can be compared.
+
+    GEOCODER_FAKE_LATENCY (seconds) makes every lookup wait like a remote
+    service would, to benchmark how requests cope with a slow geocoder.
+    """
+    name = 'fake'
+    # (min lat, max lat, min lon, max lon)
+    BOUNDS = (-4.6, 4.6, 34.0, 41.8)
+
+    def __init__(self, latency=None):
+        self.latency = getattr(settings, 'GEOCODER_FAKE_LATENCY', 0) if latency is None else latency
+
+    def geocode(self, place_name):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.point(place_name)
+
+    async def ageocode(self, place_name):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.point(place_name)
+
+    def point(self, place_name):
+        key = normalize_place_name(place_name)
+        if not key:
+            return None
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        u = int.from_bytes(digest[:8], 'big') / 2 ** 64
+        v = int.from_bytes(digest[8:16], 'big') / 2 ** 64
+        min_lat, max_lat, min_lon, max_lon = self.BOUNDS
+        return (round(min_lat + u * (max_lat - min_lat), 5), round(min_lon + v * (max_lon - min_lon), 5))
+
+
+class ChainGeocoder:
+    """
+    Tries each backend in order and returns the first hit.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+
+    def geocode_with_source(self, place_name):
+        """
+        (coords, backend name) from the first backend that knows the place.
+        """
+        for backend in self.backends:
+            coords = backend.geocode(place_name)
+            if coords is not None:
+                return coords, getattr(backend, 'name', type(backend).__name__)
+        return None, None
+
+    def geocode(self, place_name):
+        return self.geocode_with_source(place_name)[0]
+
+    async def ageocode_with_source(self, place_name):
+        """
+        Async geocode_with_source(). Backends with an ageocode() coroutine are
+        awaited; blocking ones run in a worker thread, off the event loop.
+        """
+        for backend in self.backends:
+            if hasattr(backend, 'ageocode'):
+                coords = await backend.ageocode(place_name)
+            else:
+                coords = await sync_to_async(backend.geocode, thread_sensitive=False)(place_name)
+            if coords is not None:
+                return coords, getattr(backend, 'name', type(backend).__name__)
+        return None, None
+
+
+_geocoder = None
+
+
+def get_geocoder():
+    """
+    The geocoder configured in GEOCODER_BACKENDS (built once per process).
+    """
+    global _geocoder
+    if _geocoder is None:
+        paths = getattr(settings, 'GEOCODER_BACKENDS', ['api.geocoders.NominatimGeocoder'])
+        _geocoder = ChainGeocoder([import_string(path)() for path in paths])
+    return _geocoder
@@ -0,0 +1,227 @@
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+
+# Timings of the request being handled in this thread/task, None outside requests
+_current = ContextVar('request_timings', default=None)
+
+# Anything else is reported as "other", so clients can't create new label series
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class RequestTimings:
+    """
+    Wall time per section (seconds) and call counts for one request.
+    """
+    __slots__ = ('durations', 'counts')
+
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+
+    def add(self, section, duration):
+        self.durations[section] = self.durations.get(section, 0.0) + duration
+        self.counts[section] = self.counts.get(section, 0) + 1
+
+    def header(self, total):
+        parts = [f'total;dur={total * 1000:.1f}']
+        for section in ('db', 'geocode', 'serialize', 'auth'):
+            if section in self.counts:
+                desc = {'db': 'queries', 'geocode': 'calls'}.get(section)
+                part = f'{section};dur={self.durations[section] * 1000:.1f}'
+                if desc:
+                    part += f';desc="{self.counts[section]} {desc}"'
+                parts.append(part)
+        return ', '.join(parts)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Execute wrapper on every DB connection (see install_query_timer). Queries
+    are charged to the request in the current context, which also covers the
+    async ORM: its worker threads inherit the request's context.
+    """
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add('db', time.perf_counter() - start)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    # connection_created receiver
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+@contextmanager
+def timed(section):
+    """
+    Adds the time spent in the block to `section` of the current request
+    (no-op outside a request, e.g. in Celery workers).
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(section, time.perf_counter() - start)
+
+
+class Histogram:
+    """
+    Prometheus-style cumulative histogram, one series per label tuple.
+    """
+
+    def __init__(self, name, help_text, buckets, labels=('view', 'method')):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts (+Inf last), then sum
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in sorted(self._series.items())]
+        for label_values, counts, total in snapshot:
+            labels = ','.join(f'{key}="{_escape(value)}"' for key, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_DURATION = Histogram(
+    'greenpath_request_duration_seconds', "Wall time of HTTP requests.", SECONDS_BUCKETS,
+    labels=('view', 'method', 'status'),
+)
+DB_DURATION = Histogram('greenpath_request_db_duration_seconds', "Time spent in SQL per request.", SECONDS_BUCKETS)
+DB_QUERIES = Histogram('greenpath_request_db_queries', "SQL queries per request.", QUERY_BUCKETS)
+GEOCODE_DURATION = Histogram(
+    'greenpath_request_geocode_duration_seconds', "Time spent in geocoder calls per request.", SECONDS_BUCKETS
+)
+SERIALIZE_DURATION = Histogram(
+    'greenpath_request_serialize_duration_seconds', "Time spent serializing per request.", SECONDS_BUCKETS
+)
+AUTH_DURATION = Histogram('greenpath_request_auth_duration_seconds', "Time spent authenticating per request.", SECONDS_BUCKETS)
+
+METRICS = [REQUEST_DURATION, DB_DURATION, DB_QUERIES, GEOCODE_DURATION, SERIALIZE_DURATION, AUTH_DURATION]
+
+
+def record(view, method, status, total, timings):
+    labels = (view, method)
+    REQUEST_DURATION.observe((view, method, str(status)), total)
+    DB_QUERIES.observe(labels, timings.counts.get('db', 0))
+    DB_DURATION.observe(labels, timings.durations.get('db', 0.0))
+    # Only for requests that did any of this work, the rest would just pile up in the 0 bucket
+    for section, histogram in (('geocode', GEOCODE_DURATION), ('serialize', SERIALIZE_DURATION), ('auth', AUTH_DURATION)):
+        if section in timings.durations:
+            histogram.observe(labels, timings.durations[section])
+
+
+class ServerTimingMiddleware:
+    """
+    Times every request (total, SQL, geocoding, serialization, auth), sends the
+    breakdown in a Server-Timing header and feeds the /metrics histograms,
+    labeled by URL name. Metrics are kept per process.
+
+    Streaming responses are measured up to the moment their headers are sent.
+    Runs in sync or async mode, whichever the handler below it uses.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.send_header = getattr(settings, 'SERVER_TIMING_HEADER', settings.DEBUG)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings, time.perf_counter() - start)
+
+    def finish(self, request, response, timings, total):
+        if self.send_header:
+            response['Server-Timing'] = timings.header(total)
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        method = request.method if request.method in HTTP_METHODS else 'other'
+        record(view or 'unnamed', method, response.status_code, total, timings)
+        return response
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of the request histograms, for scrapers sending
+    METRICS_TOKEN as a bearer token. Not served at all while it's unset.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        return HttpResponse("Not Found", status=404, content_type='text/plain')
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not hmac.compare_digest(supplied, token):
+        return HttpResponse("Unauthorized", status=401, content_type='text/plain')
+
+    lines = []
+    for histogram in METRICS:
+        lines.extend(histogram.expose())
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,147 @@
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from api import benchmark, geocoders
+from api.services import clear_geocode_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds benchmark data and measures throughput and p50/p95/p99 latency of the main "
+        "endpoints under concurrent clients. Prints (or writes) the results as JSON; with "
+        "--baseline, fails when a scenario regressed past --threshold."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=int, default=1000, help="Shipments to seed for the benchmark company.")
+        parser.add_argument(
+            '--clients', default='8',
+            help="Concurrent clients per scenario. A list (1,8,32) runs every scenario at each "
+                 "level, reported as scenario@clients, to show how throughput scales.",
+        )
+        parser.add_argument('--requests', type=int, default=200, help="Measured requests per scenario.")
+        parser.add_argument('--warmup', type=int, default=5, help="Unmeasured requests per client first.")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument(
+            '--scenarios', default=','.join(benchmark.SCENARIOS),
+            help=f"Comma-separated subset of: {', '.join(benchmark.SCENARIOS)}.",
+        )
+        parser.add_argument(
+            '--url', default=None,
+            help="Benchmark a running server (e.g. http://127.0.0.1:8000) instead of calling the app "
+                 "in-process. Start it with GEOCODER_BACKENDS=api.geocoders.DeterministicGeocoder "
+                 "(and GEOCODER_FAKE_LATENCY to match --geocode-latency).",
+        )
+        parser.add_argument(
+            '--geocode-latency', type=float, default=0.0,
+            help="Seconds every geocoder lookup takes in-process, to simulate a slow remote geocoder.",
+        )
+        parser.add_argument('--output', default=None, help="Write the JSON results to this file.")
+        parser.add_argument('--baseline', default=None, help="Results file of a previous run to compare against.")
+        parser.add_argument('--threshold', type=float, default=0.10, help="Allowed regression (0.10 = 10%%).")
+        parser.add_argument('--metric', default='p95', choices=['p50', 'p95', 'p99', 'mean'])
+        parser.add_argument('--cleanup', action='store_true', help="Delete the accounts created by register_company.")
+
+    def handle(self, *args, **options):
+        scenarios = [name for name in options['scenarios'].split(',') if name]
+        unknown = set(scenarios) - set(benchmark.SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+        try:
+            options['clients'] = [int(n) for n in str(options['clients']).split(',') if n]
+        except ValueError:
+            raise CommandError("--clients must be a number or a comma-separated list of numbers.")
+
+        # Geocoding never leaves the process during a benchmark
+        with override_settings(
+            GEOCODER_BACKENDS=['api.geocoders.DeterministicGeocoder'],
+            GEOCODER_FAKE_LATENCY=options['geocode_latency'],
+        ):
+            geocoders._geocoder = None
+            clear_geocode_cache()
+            try:
+                results = self.run(scenarios, options)
+            finally:
+                geocoders._geocoder = None
+                clear_geocode_cache()
+
+        if options['cleanup']:
+            self.stderr.write(f"Removed {benchmark.cleanup()} benchmark rows.")
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(f"Results written to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = benchmark.compare(results, baseline, options['threshold'], options['metric'])
+            if regressions:
+                raise CommandError("Performance regressed:\n  " + "\n  ".join(regressions))
+            self.stderr.write(self.style.SUCCESS(
+                f"No regression beyond {options['threshold']:.0%} against {options['baseline']}."
+            ))
+
+    def run(self, scenarios, options):
+        self.stderr.write(f"Seeding {options['scale']} shipments...")
+        ctx = benchmark.seed(options['scale'], seed=options['seed'])
+
+        if options['url']:
+            make_client = lambda: benchmark.HttpClient(options['url'])
+        else:
+            make_client = benchmark.InProcessClient
+
+        results = {'meta': self.meta(options), 'scenarios': {}}
+        for name in scenarios:
+            for clients in options['clients']:
+                # Names created by the scenario must not repeat across levels
+                level_ctx = dict(ctx, run=f"{ctx['run']}-{clients}") if len(options['clients']) > 1 else ctx
+                stats = benchmark.run_scenario(
+                    name, make_client, level_ctx, options['requests'], clients,
+                    warmup=options['warmup'], seed=options['seed'],
+                )
+                key = name if len(options['clients']) == 1 else f'{name}@{clients}'
+                results['scenarios'][key] = stats
+                latency = stats['latency_ms']
+                self.stderr.write(
+                    f"  {key:<30} {stats['throughput_rps']:>8} req/s  p50 {latency['p50']}ms  "
+                    f"p95 {latency['p95']}ms  p99 {latency['p99']}ms  errors {stats['errors']}"
+                )
+        return results
+
+    def meta(self, options):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                cwd=settings.BASE_DIR,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'commit': commit,
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'target': options['url'] or 'in-process',
+            'database': connection.vendor,
+            'scale': options['scale'],
+            'clients': options['clients'][0] if len(options['clients']) == 1 else options['clients'],
+            # A server's latency comes from its own GEOCODER_FAKE_LATENCY
+            'geocode_latency': None if options['url'] else options['geocode_latency'],
+            'requests': options['requests'],
+            'seed': options['seed'],
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'argv': sys.argv[1:],
+        }
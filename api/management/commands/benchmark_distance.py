@@ -0,0 +1,79 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.distance import DISTANCE_MODES, distance_km, distances_km
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmark of the distance modes: pairs per second one pair at a time and in "
+        "batches, plus the error of each mode against geodesic on random point pairs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pairs', type=int, default=20000, help="Random point pairs per batch.")
+        parser.add_argument('--single', type=int, default=2000, help="Pairs timed one call at a time.")
+        parser.add_argument(
+            '--max-km', type=float, default=None,
+            help="Only pairs closer than this (e.g. 3000 for road/rail lanes). Default: anywhere on Earth.",
+        )
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        lat1, lon1, lat2, lon2 = self.random_pairs(options['pairs'], options['max_km'], options['seed'])
+        reference = None
+        results = {}
+        for mode in DISTANCE_MODES:
+            started = time.perf_counter()
+            km = distances_km(lat1, lon1, lat2, lon2, mode)
+            batch = time.perf_counter() - started
+            if mode == 'geodesic':
+                reference = km
+
+            single = min(options['single'], len(km))
+            started = time.perf_counter()
+            for i in range(single):
+                distance_km((lat1[i], lon1[i]), (lat2[i], lon2[i]), mode)
+            one_by_one = time.perf_counter() - started
+
+            error = np.abs(km - reference)
+            relative = error / np.maximum(reference, 1e-9)
+            results[mode] = {
+                'batch_pairs_per_s': round(len(km) / batch),
+                'single_pairs_per_s': round(single / one_by_one),
+                'max_error_m': round(float(error.max()) * 1000, 6),
+                'max_error_pct': round(float(relative.max()) * 100, 4),
+                'mean_error_pct': round(float(relative.mean()) * 100, 4),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps({'pairs': len(lat1), 'max_km': options['max_km'], 'modes': results}, indent=2))
+            return
+        self.stdout.write(f"{len(lat1):,} random pairs" + (f" under {options['max_km']:g} km" if options['max_km'] else ""))
+        self.stdout.write(f"{'mode':<10} {'batch pairs/s':>14} {'single pairs/s':>15} {'max err (m)':>12} {'max err %':>10} {'mean err %':>11}")
+        for mode, row in results.items():
+            self.stdout.write(
+                f"{mode:<10} {row['batch_pairs_per_s']:>14,} {row['single_pairs_per_s']:>15,} "
+                f"{row['max_error_m']:>12.3f} {row['max_error_pct']:>10.4f} {row['mean_error_pct']:>11.4f}"
+            )
+
+    def random_pairs(self, count, max_km, seed):
+        # Uniform over the sphere (not over lat/lon, which would crowd the poles)
+        rng = np.random.default_rng(seed)
+        lat1 = np.degrees(np.arcsin(rng.uniform(-1, 1, count)))
+        lon1 = rng.uniform(-180, 180, count)
+        if max_km is None:
+            lat2 = np.degrees(np.arcsin(rng.uniform(-1, 1, count)))
+            lon2 = rng.uniform(-180, 180, count)
+            return lat1, lon1, lat2, lon2
+        # Destination at a random bearing and range from the origin
+        bearing = rng.uniform(0, 2 * np.pi, count)
+        angle = rng.uniform(0, max_km, count) / 6371.0088
+        phi1, lam1 = np.radians(lat1), np.radians(lon1)
+        phi2 = np.arcsin(np.sin(phi1) * np.cos(angle) + np.cos(phi1) * np.sin(angle) * np.cos(bearing))
+        lam2 = lam1 + np.arctan2(np.sin(bearing) * np.sin(angle) * np.cos(phi1), np.cos(angle) - np.sin(phi1) * np.sin(phi2))
+        return lat1, lon1, np.degrees(phi2), (np.degrees(lam2) + 540) % 360 - 180
@@ -0,0 +1,73 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from api.models import Shipment
+from api.renderers import FastJSONRenderer
+from api.rows import shipment_records, shipment_values
+from api.serializers import ShipmentSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmark of the shipment list read path: rows per second through ShipmentSerializer "
+        "and DRF's JSONRenderer against values() + api.rows + the orjson renderer, on the shipments "
+        "in the database (seed some with generate_dataset). Checks that both render the same bytes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000, help="Shipments per run.")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per path; the best one is reported.")
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        queryset = Shipment.objects.select_related('owner').order_by('-created_at', '-pk')[:options['rows']]
+        count = queryset.count()
+        if not count:
+            raise CommandError("No shipments to serialize. Seed some with `manage.py generate_dataset` first.")
+
+        paths = {
+            'serializer': lambda rows: JSONRenderer().render(ShipmentSerializer(rows, many=True).data),
+            'fast': lambda rows: FastJSONRenderer().render(shipment_records(rows)),
+        }
+        sources = {'serializer': lambda: list(queryset.all()), 'fast': lambda: list(shipment_values(queryset))}
+
+        results, bodies = {}, {}
+        for name, render in paths.items():
+            best = None
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                rows = sources[name]()
+                fetched = time.perf_counter()
+                bodies[name] = render(rows)
+                done = time.perf_counter()
+                if best is None or done - started < best[0] + best[1]:
+                    best = (fetched - started, done - fetched)
+            fetch, render_time = best
+            results[name] = {
+                'fetch_s': round(fetch, 4),
+                'serialize_s': round(render_time, 4),
+                'serialize_rows_per_s': round(count / render_time),
+                'total_rows_per_s': round(count / (fetch + render_time)),
+            }
+        speedup = results['serializer']['serialize_s'] / results['fast']['serialize_s']
+        identical = bodies['serializer'] == bodies['fast']
+
+        if options['json']:
+            self.stdout.write(json.dumps(
+                {'rows': count, 'identical': identical, 'serialize_speedup': round(speedup, 2), 'paths': results},
+                indent=2,
+            ))
+        else:
+            self.stdout.write(f"{count:,} shipments, best of {options['repeat']}")
+            self.stdout.write(f"{'path':<11} {'fetch (s)':>10} {'serialize (s)':>14} {'rows/s':>11} {'rows/s w/ fetch':>16}")
+            for name, row in results.items():
+                self.stdout.write(
+                    f"{name:<11} {row['fetch_s']:>10.4f} {row['serialize_s']:>14.4f} "
+                    f"{row['serialize_rows_per_s']:>11,} {row['total_rows_per_s']:>16,}"
+                )
+            self.stdout.write(f"Serialization {speedup:.1f}x faster; identical output: {'yes' if identical else 'NO'}")
+        if not identical:
+            raise CommandError("The fast path rendered different bytes than ShipmentSerializer.")
@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+import time
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from api.dataset import create_reference_data, init_worker, insert_chunk
+from api.models import Company
+from api.rollups import rebuild_emission_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a synthetic, reproducible dataset for scale testing: companies, users in "
+        "every role, vehicles, locations and shipments with skewed company and lane popularity. "
+        "Rows are written with chunked bulk_create from several processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shipments', type=int, default=1_000_000)
+        parser.add_argument('--companies', type=int, default=200)
+        parser.add_argument('--users-per-company', type=int, default=25)
+        parser.add_argument('--locations', type=int, default=2000)
+        parser.add_argument('--days', type=int, default=365, help="Spread created_at over this many days.")
+        parser.add_argument(
+            '--until', default=None,
+            help="Latest created_at as YYYY-MM-DD (default: today). Pin it to reproduce a dataset exactly.",
+        )
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--tag', default='ds', help="Prefix of every generated name (must be unused).")
+        parser.add_argument(
+            '--lane-skew', type=float, default=1.1,
+            help="Zipf exponent of city popularity (0 = uniform, higher = a few hub lanes dominate).",
+        )
+        parser.add_argument('--company-skew', type=float, default=0.9, help="Zipf exponent of company size.")
+        parser.add_argument('--workers', type=int, default=None, help="Insert processes (default: CPUs, 1 on SQLite).")
+        parser.add_argument('--chunk-size', type=int, default=20000, help="Shipments built per job.")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows per INSERT.")
+        parser.add_argument('--skip-rollups', action='store_true', help="Don't rebuild the emission rollups at the end.")
+
+    def handle(self, *args, **options):
+        tag = options['tag']
+        if Company.objects.filter(name__startswith=f'{tag} Company ').exists():
+            raise CommandError(f"A dataset tagged '{tag}' already exists; pick another --tag.")
+
+        try:
+            until = parse_date(options['until']) if options['until'] else timezone.now().date()
+        except ValueError:
+            # Well formed but not a real date (2026-13-01)
+            until = None
+        if until is None:
+            raise CommandError("--until must be a YYYY-MM-DD date.")
+
+        workers = options['workers'] or os.cpu_count() or 1
+        if connection.vendor == 'sqlite' and workers > 1:
+            # SQLite takes one writer at a time: extra processes would only fail on the lock
+            if options['workers']:
+                self.stderr.write("SQLite allows a single writer, inserting with 1 worker.")
+            workers = 1
+
+        started = time.monotonic()
+        plan = create_reference_data(
+            tag, options['seed'], options['companies'], options['users_per_company'], options['locations']
+        )
+        self.stdout.write(
+            f"Created {len(plan['company_ids'])} companies, {options['companies'] * options['users_per_company']} users, "
+            f"{len(plan['vehicle_ids'])} vehicles and {len(plan['location_ids'])} locations "
+            f"in {time.monotonic() - started:.1f}s"
+        )
+
+        total, chunk_size = options['shipments'], options['chunk_size']
+        jobs = [(i, min(chunk_size, total - start)) for i, start in enumerate(range(0, total, chunk_size))]
+        worker_options = {
+            'days': options['days'],
+            'lane_skew': options['lane_skew'],
+            'company_skew': options['company_skew'],
+            'batch_size': options['batch_size'],
+            # Midnight after --until, the same for every worker and every run
+            'now': datetime.combine(until + timedelta(days=1), dt_time.min, tzinfo=dt_timezone.utc),
+        }
+
+        inserting = time.monotonic()
+        done = 0
+        if workers == 1:
+            init_worker(plan, options['seed'], worker_options)
+            results = map(insert_chunk, jobs)
+            pool = None
+        else:
+            # Children must not inherit the open connection
+            connections.close_all()
+            pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(plan, options['seed'], worker_options))
+            results = pool.imap_unordered(insert_chunk, jobs)
+        try:
+            for count in results:
+                done += count
+                elapsed = time.monotonic() - inserting
+                self.stdout.write(f"  {done:,}/{total:,} shipments ({done / elapsed:,.0f} rows/s)")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if not options['skip_rollups']:
+            self.stdout.write("Rebuilding emission rollups...")
+            rebuild_emission_rollups()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {done:,} shipments with {workers} worker(s) in {time.monotonic() - started:.1f}s"
+        ))
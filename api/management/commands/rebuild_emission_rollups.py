@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.rollups import rebuild_emission_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the EmissionRollup table from the Shipment table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = rebuild_emission_rollups(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {count} rollup rows in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,63 @@
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from api.distance import DISTANCE_MODES
+from api.models import Vehicle
+from api.recompute import recompute_shipment_distances, recompute_vehicle_footprints
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes shipment carbon footprints from the current vehicle emission factors. "
+        "With --distances, recomputes the distances from the stored coordinates first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--vehicle', action='append', dest='vehicles', default=[],
+            help="Vehicle id or name to recompute (repeatable). Defaults to all vehicles.",
+        )
+        parser.add_argument('--chunk-size', type=int, default=10000)
+        parser.add_argument(
+            '--distances', action='store_true',
+            help="Also recompute distances from the locations' coordinates (e.g. after changing DISTANCE_MODE).",
+        )
+        parser.add_argument(
+            '--distance-mode', choices=DISTANCE_MODES, default=None,
+            help="Distance formula for --distances (default: the DISTANCE_MODE setting).",
+        )
+
+    def handle(self, *args, **options):
+        vehicles = Vehicle.objects.all()
+        if options['vehicles']:
+            vehicles = [self._get_vehicle(ref) for ref in options['vehicles']]
+
+        for vehicle in vehicles:
+            started = time.monotonic()
+
+            def report(done, total):
+                elapsed = time.monotonic() - started
+                rate = done / elapsed if elapsed else 0
+                self.stdout.write(f"  {vehicle.name}: {done}/{total} shipments ({rate:,.0f} rows/s)")
+
+            if options['distances']:
+                count = recompute_shipment_distances(
+                    vehicle, mode=options['distance_mode'], chunk_size=options['chunk_size'], progress=report
+                )
+            else:
+                count = recompute_vehicle_footprints(vehicle, chunk_size=options['chunk_size'], progress=report)
+            self.stdout.write(self.style.SUCCESS(
+                f"{vehicle.name}: recomputed {count} shipments in {time.monotonic() - started:.1f}s"
+            ))
+
+    def _get_vehicle(self, ref):
+        try:
+            return Vehicle.objects.get(pk=ref)
+        except (Vehicle.DoesNotExist, ValidationError):
+            pass
+        try:
+            return Vehicle.objects.get(name=ref)
+        except Vehicle.DoesNotExist:
+            raise CommandError(f"Vehicle '{ref}' not found.")
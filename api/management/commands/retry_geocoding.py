@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from api.retries import retry_due_lanes
+
+
+class Command(BaseCommand):
+    help = (
+        "Retries the lanes whose places failed to geocode and are due, pricing their waiting "
+        "shipments once they resolve, and re-sends lost metric jobs. For deployments without "
+        "Celery beat, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help="Lanes per run (default: GEOCODE_RETRY_BATCH_SIZE).")
+
+    def handle(self, *args, **options):
+        stats = retry_due_lanes(limit=options['limit'])
+        self.stdout.write(
+            f"{stats['lanes']} lanes retried: {stats['resolved']} resolved ({stats['shipments']} shipments), "
+            f"{stats['rescheduled']} rescheduled, {stats['dead']} dead-lettered; "
+            f"{stats['stale']} stale shipments re-sent."
+        )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from api.models import RouteDistance
+from api.services import flush_route_stats
+
+
+class Command(BaseCommand):
+    help = "Lists the most used lanes in the route distance cache, both directions of a lane together."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help="Number of lanes to show.")
+
+    def handle(self, *args, **options):
+        flush_route_stats()
+        lanes = RouteDistance.objects.select_related('origin', 'destination').order_by('-hit_count')[:options['top']]
+        for lane in lanes:
+            self.stdout.write(
+                f"{lane.hit_count:>10}  {lane.origin.name} <-> {lane.destination.name}  "
+                f"({lane.distance_km:.1f} km, {lane.mode})"
+            )
+        self.stdout.write(self.style.SUCCESS(f"{RouteDistance.objects.count()} lanes cached."))
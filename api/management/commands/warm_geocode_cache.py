@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from geopy.exc import GeocoderServiceError
+
+from api.models import Location
+from api.services import geocode_cache_stats, locate
+
+
+class Command(BaseCommand):
+    # Nominatim's 1 request/second is enforced by the geocoder's own token
+    # bucket, shared with the web and worker processes; no extra sleep here
+    help = "Geocodes every Location that has no stored coordinates yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help="Stop after this many network lookups.",
+        )
+
+    def handle(self, *args, **options):
+        total = Location.objects.count()
+        pending = Location.objects.filter(latitude__isnull=True).order_by('pk')
+        self.stdout.write(f"{total} locations, {pending.count()} without coordinates.")
+
+        resolved = failed = lookups = 0
+        for i, location in enumerate(pending.iterator(), start=1):
+            misses = geocode_cache_stats()['misses']
+            try:
+                coordinates = locate(location)
+            except GeocoderServiceError as exc:
+                # Timeouts and outages: report the place and go on with the next
+                failed += 1
+                self.stderr.write(f"Geocoding '{location.name}' failed: {exc}")
+            else:
+                if coordinates is not None:
+                    resolved += 1
+                else:
+                    self.stderr.write(f"Could not geocode '{location.name}'")
+            if i % 50 == 0:
+                self.stdout.write(f"  {i} done")
+
+            # Only lookups that went past the geocode cache count against the limit
+            if geocode_cache_stats()['misses'] > misses:
+                lookups += 1
+                if options['limit'] is not None and lookups >= options['limit']:
+                    break
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Resolved {resolved} locations, {failed} failed. Cache stats: {geocode_cache_stats()}"
+        ))
@@ -0,0 +1,103 @@
+import json
+
+import numpy as np
+from django.conf import settings
+
+from .distance import distances_km
+from .models import LocationAlias
+from .services import geocode_many, normalize_place_name
+
+
+class MatrixError(Exception):
+    def __init__(self, message, places=None):
+        super().__init__(message)
+        self.places = places or []
+
+
+def matrix_coordinates(names, max_lookups=None):
+    """
+    (latitude, longitude) of every name, in order. Coordinates come from the
+    Locations first (one query, any known spelling), then the geocoding cache;
+    at most `max_lookups` places are sent to the geocoder. Nothing but the
+    geocoding cache is written. Raises MatrixError listing the places that
+    can't be placed.
+    """
+    keys = [normalize_place_name(name) for name in names]
+    known = {
+        alias: (latitude, longitude)
+        for alias, latitude, longitude in LocationAlias.objects.filter(
+            name__in=set(keys), location__latitude__isnull=False, location__longitude__isnull=False,
+        ).values_list('name', 'location__latitude', 'location__longitude')
+    }
+    missing = {key: name for key, name in zip(keys, names) if key not in known}
+    if missing:
+        if max_lookups is None:
+            max_lookups = getattr(settings, 'DISTANCE_MATRIX_MAX_GEOCODE', 10)
+        found = geocode_many(list(missing.values()), max_lookups=max_lookups)
+        for key, (coords, _) in found.items():
+            if coords is not None:
+                known[key] = coords
+
+        not_found = [missing[key] for key in missing if key in found and key not in known]
+        if not_found:
+            raise MatrixError("These places couldn't be geocoded.", not_found)
+        skipped = [missing[key] for key in missing if key not in found]
+        if skipped:
+            raise MatrixError(
+                f"Only {max_lookups} places that were never geocoded can be looked up per request; "
+                "retry to look up the next ones.", skipped,
+            )
+    return [known[key] for key in keys]
+
+
+def distance_matrix(coordinates, mode=None):
+    """
+    N x N distances (km) between the points, in one vectorized call. Only the
+    upper triangle is computed; distances don't depend on the direction.
+    """
+    points = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    n = len(points)
+    km = np.zeros((n, n))
+    i, j = np.triu_indices(n, k=1)
+    if len(i):
+        upper = distances_km(points[i, 0], points[i, 1], points[j, 0], points[j, 1], mode)
+        km[i, j] = upper
+        km[j, i] = upper
+    return km
+
+
+def _rows(matrix, decimals, rows_per_chunk):
+    # One JSON array, sent a block of rows at a time. Fixed-point formatting is
+    # about twice as fast as json.dumps() on floats, and the output is smaller
+    row_format = '[' + ','.join([f'%.{decimals}f'] * matrix.shape[1]) + ']'
+    yield '['
+    for start in range(0, len(matrix), rows_per_chunk):
+        block = ','.join(row_format % tuple(row) for row in matrix[start:start + rows_per_chunk].tolist())
+        yield (',' if start else '') + block
+    yield ']'
+
+
+def stream_matrix(names, coordinates, weight, vehicles, mode, rows_per_chunk=None):
+    """
+    Yields the JSON response body: the places, the distance matrix (km) and,
+    per requested vehicle, the CO2 matrix (kg) for `weight` tons, each a block
+    of rows at a time so big ones never sit in memory as one string.
+    """
+    rows_per_chunk = rows_per_chunk or getattr(settings, 'DISTANCE_MATRIX_CHUNK_ROWS', 100)
+    km = distance_matrix(coordinates, mode)
+    places = [
+        {'name': name, 'latitude': latitude, 'longitude': longitude}
+        for name, (latitude, longitude) in zip(names, coordinates)
+    ]
+    yield json.dumps({'distance_mode': mode, 'weight': str(weight), 'locations': places})[:-1]
+
+    yield ', "distances": '
+    yield from _rows(km, 2, rows_per_chunk)
+
+    yield ', "carbon_footprints": ['
+    for index, vehicle in enumerate(vehicles):
+        header = {'vehicle': str(vehicle.id), 'name': vehicle.name, 'emission_factor': str(vehicle.emission_factor)}
+        yield (', ' if index else '') + json.dumps(header)[:-1] + ', "matrix": '
+        yield from _rows(km * (float(weight) * float(vehicle.emission_factor)), 3, rows_per_chunk)
+        yield '}'
+    yield ']}'
@@ -0,0 +1,33 @@
+# Generated by Django 6.0.1 on 2026-10-18 07:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_geocodecacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmissionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin', models.CharField(max_length=255)),
+                ('destination', models.CharField(max_length=255)),
+                ('day', models.DateField()),
+                ('shipment_count', models.PositiveIntegerField(default=0)),
+                ('total_co2', models.DecimalField(decimal_places=3, default=0, max_digits=18)),
+                ('total_distance', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('total_weight', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='emission_rollups', to='api.company')),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='emission_rollups', to='api.vehicle')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['company', 'day'], name='api_emissio_company_f11a18_idx')],
+                'unique_together': {('company', 'vehicle', 'origin', 'destination', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.1 on 2026-10-18 07:10
+
+from django.db import migrations
+
+
+def create_search_indexes(apps, schema_editor):
+    from api.search import install_search_indexes
+    install_search_indexes(schema_editor.connection)
+
+
+def drop_search_indexes(apps, schema_editor):
+    from api.search import drop_search_indexes
+    drop_search_indexes(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+    """
+    Trigram search on Shipment.origin/destination: pg_trgm GIN indexes on
+    PostgreSQL, an FTS5 trigram table kept in sync by triggers on SQLite.
+    """
+
+    dependencies = [
+        ('api', '0009_emissionrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 6.0.1 on 2026-10-18 07:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_shipment_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Location',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('normalized_name', models.CharField(max_length=255, unique=True)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('geocoded_by', models.CharField(blank=True, max_length=50)),
+                ('geocoded_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LocationAlias',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='api.location')),
+            ],
+            options={
+                'verbose_name_plural': 'Location aliases',
+            },
+        ),
+        migrations.AddField(
+            model_name='geocodecacheentry',
+            name='source',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        # Nullable until 0012 has filled them in
+        migrations.AddField(
+            model_name='shipment',
+            name='origin_location',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.location'),
+        ),
+        migrations.AddField(
+            model_name='shipment',
+            name='destination_location',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.location'),
+        ),
+        # Rollup lanes move from place names to Locations; 0012 rebuilds the rows
+        migrations.AlterUniqueTogether(
+            name='emissionrollup',
+            unique_together=set(),
+        ),
+        migrations.RemoveField(
+            model_name='emissionrollup',
+            name='origin',
+        ),
+        migrations.RemoveField(
+            model_name='emissionrollup',
+            name='destination',
+        ),
+        migrations.AddField(
+            model_name='emissionrollup',
+            name='origin',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.location'),
+        ),
+        migrations.AddField(
+            model_name='emissionrollup',
+            name='destination',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.location'),
+        ),
+    ]
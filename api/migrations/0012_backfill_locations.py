@@ -0,0 +1,89 @@
+# Generated by Django 6.0.1 on 2026-10-18 07:20
+
+from collections import Counter, defaultdict
+
+from django.db import migrations
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def normalize(name):
+    # Same as api.services.normalize_place_name, frozen here for the migration
+    return " ".join(str(name).split()).casefold()
+
+
+def backfill_locations(apps, schema_editor):
+    Location = apps.get_model('api', 'Location')
+    LocationAlias = apps.get_model('api', 'LocationAlias')
+    Shipment = apps.get_model('api', 'Shipment')
+    GeocodeCacheEntry = apps.get_model('api', 'GeocodeCacheEntry')
+    EmissionRollup = apps.get_model('api', 'EmissionRollup')
+
+    # Every spelling in use, grouped by normalized name
+    spellings = defaultdict(Counter)
+    for field in ('origin', 'destination'):
+        for value, count in Shipment.objects.values_list(field).annotate(n=Count('id')).order_by():
+            spellings[normalize(value)][value] += count
+
+    coords = {
+        name: (latitude, longitude, source, resolved_at)
+        for name, latitude, longitude, source, resolved_at in GeocodeCacheEntry.objects.filter(
+            name__in=list(spellings)
+        ).values_list('name', 'latitude', 'longitude', 'source', 'resolved_at')
+    }
+
+    locations = []
+    for key, counts in spellings.items():
+        # The most used spelling becomes the display name
+        location = Location(name=" ".join(counts.most_common(1)[0][0].split()), normalized_name=key)
+        if key in coords:
+            latitude, longitude, source, resolved_at = coords[key]
+            location.latitude, location.longitude = latitude, longitude
+            location.geocoded_by, location.geocoded_at = source or 'cache', resolved_at
+        locations.append(location)
+    Location.objects.bulk_create(locations, batch_size=1000)
+
+    by_key = dict(Location.objects.values_list('normalized_name', 'id'))
+    LocationAlias.objects.bulk_create(
+        [LocationAlias(name=key, location_id=pk) for key, pk in by_key.items()], batch_size=1000
+    )
+
+    for key, counts in spellings.items():
+        raw = list(counts)
+        Shipment.objects.filter(origin__in=raw).update(origin_location_id=by_key[key])
+        Shipment.objects.filter(destination__in=raw).update(destination_location_id=by_key[key])
+
+    # Rebuild the rollups on the new lane keys
+    EmissionRollup.objects.all().delete()
+    rows = (
+        Shipment.objects.filter(carbon_footprint__isnull=False)
+        .annotate(day=TruncDate('created_at'))
+        .values('company_id', 'vehicle_id', 'origin_location_id', 'destination_location_id', 'day')
+        .annotate(count=Count('id'), co2=Sum('carbon_footprint'), distance=Sum('distance'), weight=Sum('weight'))
+        .order_by()
+    )
+    EmissionRollup.objects.bulk_create([
+        EmissionRollup(
+            company_id=row['company_id'], vehicle_id=row['vehicle_id'],
+            origin_id=row['origin_location_id'], destination_id=row['destination_location_id'], day=row['day'],
+            shipment_count=row['count'], total_co2=row['co2'],
+            total_distance=row['distance'] or 0, total_weight=row['weight'],
+        )
+        for row in rows
+    ], batch_size=1000)
+
+
+def clear_rollups(apps, schema_editor):
+    # The place-name rollup columns come back empty; run rebuild_emission_rollups afterwards
+    apps.get_model('api', 'EmissionRollup').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_location'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_locations, clear_rollups),
+    ]
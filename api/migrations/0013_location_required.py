@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-18 07:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_backfill_locations'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shipment',
+            name='origin_location',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.location'),
+        ),
+        migrations.AlterField(
+            model_name='shipment',
+            name='destination_location',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.location'),
+        ),
+        migrations.AlterField(
+            model_name='emissionrollup',
+            name='origin',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.location'),
+        ),
+        migrations.AlterField(
+            model_name='emissionrollup',
+            name='destination',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='api.location'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='emissionrollup',
+            unique_together={('company', 'vehicle', 'origin', 'destination', 'day')},
+        ),
+    ]
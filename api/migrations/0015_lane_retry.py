@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-18 15:20
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_profile_token_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shipment',
+            name='metrics_status',
+            field=models.CharField(choices=[('ok', 'OK'), ('pending', 'Waiting for geocoding'), ('failed', 'Geocoding failed')], default='ok', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='LaneRetry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('dead', 'Dead letter')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('destination', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.location')),
+                ('origin', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.location')),
+            ],
+            options={
+                'verbose_name_plural': 'Lane retries',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='api_laneret_status_962555_idx')],
+                'unique_together': {('origin', 'destination')},
+            },
+        ),
+    ]
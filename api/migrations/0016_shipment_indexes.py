@@ -0,0 +1,50 @@
+# Generated by Django 6.0.1 on 2026-10-18 16:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_lane_retry'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='shipment',
+            index=models.Index(fields=['company', 'created_at', 'id'], name='shipment_company_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shipment',
+            index=models.Index(fields=['company', 'owner', 'created_at', 'id'], name='shipment_driver_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shipment',
+            index=models.Index(fields=['company', 'carbon_footprint', 'id'], name='shipment_company_co2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shipment',
+            index=models.Index(fields=['company', 'weight', 'id'], name='shipment_company_weight_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shipment',
+            index=models.Index(fields=['company', 'vehicle', 'created_at'], name='shipment_company_vehicle_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shipment',
+            index=models.Index(fields=['company', 'origin', 'destination'], name='shipment_company_lane_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shipment',
+            index=models.Index(fields=['origin_location', 'destination_location'], name='shipment_location_lane_idx'),
+        ),
+        # Dropped last, once the composite indexes can serve company lookups
+        migrations.AlterField(
+            model_name='shipment',
+            name='company',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='api.company'),
+        ),
+    ]
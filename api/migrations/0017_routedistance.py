@@ -0,0 +1,31 @@
+# Generated by Django 6.0.1 on 2026-10-18 17:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_shipment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteDistance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mode', models.CharField(max_length=20)),
+                ('distance_km', models.FloatField()),
+                ('hit_count', models.PositiveBigIntegerField(default=0)),
+                ('last_used_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('destination', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.location')),
+                ('origin', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.location')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-hit_count'], name='api_routedi_hit_cou_c74036_idx')],
+                'unique_together': {('origin', 'destination', 'mode')},
+            },
+        ),
+    ]
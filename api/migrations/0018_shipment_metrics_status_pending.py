@@ -0,0 +1,56 @@
+# Generated by Django 6.0.1 on 2026-10-18 17:40
+
+from django.db import migrations, models
+from django.db.models import Q
+from django.utils import timezone
+
+
+def mark_unpriced_pending(apps, schema_editor):
+    Shipment = apps.get_model('api', 'Shipment')
+    LaneRetry = apps.get_model('api', 'LaneRetry')
+
+    # Rows the metrics job hasn't priced yet were stamped 'ok' by the old default,
+    # and a place that failed to geocode used to be saved at 0 km
+    unpriced = Shipment.objects.filter(metrics_status='ok').filter(
+        Q(carbon_footprint__isnull=True) | Q(distance__isnull=True) | Q(distance=0)
+    )
+    lanes = set(unpriced.values_list('origin_location_id', 'destination_location_id').distinct().order_by())
+    if not lanes:
+        return
+    unpriced.update(metrics_status='pending')
+
+    # Queued for the retry loop like api.retries.schedule_lane_retries() does, due right away
+    now = timezone.now()
+    LaneRetry.objects.bulk_create(
+        [
+            LaneRetry(
+                origin_id=origin, destination_id=destination, next_attempt_at=now,
+                last_error="Not priced before metrics_status tracking",
+            )
+            for origin, destination in lanes
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    for lane in LaneRetry.objects.filter(status='dead'):
+        if (lane.origin_id, lane.destination_id) in lanes:
+            Shipment.objects.filter(
+                origin_location_id=lane.origin_id, destination_location_id=lane.destination_id,
+                metrics_status='pending',
+            ).update(metrics_status='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_routedistance'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shipment',
+            name='metrics_status',
+            field=models.CharField(choices=[('ok', 'OK'), ('pending', 'Waiting for geocoding'), ('failed', 'Geocoding failed')], default='pending', max_length=10),
+        ),
+        migrations.RunPython(mark_unpriced_pending, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-18 18:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_shipment_metrics_status_pending'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='shipment',
+            index=models.Index(condition=models.Q(('metrics_status', 'pending')), fields=['created_at'], name='shipment_pending_created_idx'),
+        ),
+    ]
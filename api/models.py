@@ -1,10 +1,16 @@
 from django.db import models
+from django.db.models import F
 import uuid
+from decimal import Decimal
+from asgiref.sync import sync_to_async
 from django.core.validators import MinValueValidator
-from .services import calculate_distance
+from .services import normalize_place_name
+from .dispatch import enqueue
+from . import rollups
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_init, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 
 class Company(models.Model):
     name = models.CharField(max_length=255)
@@ -38,6 +44,33 @@ class Profile(models.Model):
     company = models.ForeignKey(Company, on_delete=models.SET_NULL, null=True, blank=True, related_name='employees')
     role = models.CharField(max_length=20, choices=ROLE_CHOICES, default='client')
     phone_number = models.CharField(max_length=15, blank=True)
+    # Bumped whenever role/company or the user's staff status change, and on
+    # deactivation; access tokens carrying an older version are refused (see
+    # api.authentication)
+    token_version = models.PositiveIntegerField(default=0, editable=False)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_claims = (instance.__dict__.get('role'), instance.__dict__.get('company_id'))
+        return instance
+
+    def invalidate_tokens(self):
+        """
+        Makes every access token issued so far for this user stale.
+        """
+        from .authentication import remember_profile_version
+        Profile.objects.filter(pk=self.pk).update(token_version=F('token_version') + 1)
+        self.token_version = Profile.objects.filter(pk=self.pk).values_list('token_version', flat=True).get()
+        remember_profile_version(self.user_id, self.token_version)
+
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, '_loaded_claims', None)
+        claims_changed = loaded is not None and loaded != (self.role, self.company_id)
+        super().save(*args, **kwargs)
+        self._loaded_claims = (self.role, self.company_id)
+        if claims_changed:
+            self.invalidate_tokens()
 
     def __str__(self):
         return f"{self.user.username} ({self.role}) - {self.company.name if self.company else 'No Company'}"
@@ -48,9 +81,25 @@ def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
 
+def _staff_status(user):
+    # Read from __dict__: a deferred field isn't worth a query here
+    return (user.__dict__.get('is_staff'), user.__dict__.get('is_superuser'))
+
+@receiver(post_init, sender=User)
+def remember_staff_status(sender, instance, **kwargs):
+    instance._loaded_staff_status = _staff_status(instance)
+
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
+def save_user_profile(sender, instance, created=False, **kwargs):
     instance.profile.save()
+    loaded = getattr(instance, '_loaded_staff_status', None)
+    instance._loaded_staff_status = _staff_status(instance)
+    # is_staff is a token claim (cross-company analytics), so changing it
+    # outdates the tokens already issued
+    staff_changed = not created and loaded != instance._loaded_staff_status
+    if staff_changed or not instance.is_active:
+        # Deactivated users lose their outstanding access tokens
+        instance.profile.invalidate_tokens()
 
 class Vehicle(models.Model):
     """
@@ -67,14 +116,167 @@ class Vehicle(models.Model):
     )
     description = models.TextField(blank=True, null=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored factor so save() can tell when it changes
+        instance._loaded_emission_factor = instance.__dict__.get('emission_factor')
+        return instance
+
+    def save(self, *args, **kwargs):
+        factor_changed = (
+            not self._state.adding
+            and getattr(self, '_loaded_emission_factor', None) is not None
+            and Decimal(str(self.emission_factor)) != self._loaded_emission_factor
+        )
+        super().save(*args, **kwargs)
+        self._loaded_emission_factor = self.emission_factor
+
+        if factor_changed:
+            from .tasks import recompute_vehicle_footprints_task
+            # Existing footprints for this vehicle are now stale
+            enqueue(recompute_vehicle_footprints_task, str(self.id))
+
+    def __str__(self):
+        return self.name
+
+class GeocodeCacheEntry(models.Model):
+    """
+    Persistent geocoding cache: normalized place name -> coordinates.
+    Shared by every worker, so a city is only looked up on Nominatim once.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    # Which geocoder backend answered (see GEOCODER_BACKENDS)
+    source = models.CharField(max_length=50, blank=True)
+    resolved_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name_plural = "Geocode cache entries"
+
+    def __str__(self):
+        return f"{self.name} ({self.latitude}, {self.longitude})"
+
+class LocationManager(models.Manager):
+    def resolve(self, name):
+        """
+        The Location a place name refers to, created on first sight. Spellings
+        that normalize the same way share one Location; other spellings can be
+        attached to it as aliases.
+        """
+        return self.resolve_many([name])[normalize_place_name(name)]
+
+    def resolve_many(self, names):
+        """
+        Bulk resolve(): {normalized name: Location} for every name, in a fixed
+        number of queries however many names there are.
+        """
+        wanted = {}
+        for name in names:
+            wanted.setdefault(normalize_place_name(name), ' '.join(str(name).split()))
+
+        found = {
+            alias.name: alias.location
+            for alias in LocationAlias.objects.filter(name__in=list(wanted)).select_related('location')
+        }
+        missing = [key for key in wanted if key not in found]
+        if missing:
+            # ignore_conflicts: another request may be creating the same places
+            self.bulk_create(
+                [Location(name=wanted[key], normalized_name=key) for key in missing], ignore_conflicts=True
+            )
+            created = self.filter(normalized_name__in=missing)
+            LocationAlias.objects.bulk_create(
+                [LocationAlias(name=location.normalized_name, location=location) for location in created],
+                ignore_conflicts=True,
+            )
+            for alias in LocationAlias.objects.filter(name__in=missing).select_related('location'):
+                found[alias.name] = alias.location
+        return found
+
+    async def aresolve_many(self, names):
+        return await sync_to_async(self.resolve_many)(names)
+
+class Location(models.Model):
+    """
+    A canonical place. Shipments point here instead of repeating free text, and
+    the coordinates are stored once, the first time the place is geocoded.
+    """
+    name = models.CharField(max_length=255)
+    normalized_name = models.CharField(max_length=255, unique=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    # Provenance: which geocoder resolved the coordinates ('manual' when typed in)
+    geocoded_by = models.CharField(max_length=50, blank=True)
+    geocoded_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = LocationManager()
+
+    @property
+    def coordinates(self):
+        if self.latitude is None or self.longitude is None:
+            return None
+        return (self.latitude, self.longitude)
+
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        self.normalized_name = normalize_place_name(self.normalized_name or self.name)
+        super().save(*args, **kwargs)
+        if is_new:
+            LocationAlias.objects.get_or_create(name=self.normalized_name, defaults={'location': self})
+
     def __str__(self):
         return self.name
 
+class LocationAlias(models.Model):
+    """
+    A normalized spelling of a Location ("nbo", "nairobi, kenya" -> Nairobi).
+    Every Location has at least its own normalized name as an alias.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='aliases')
+
+    class Meta:
+        verbose_name_plural = "Location aliases"
+
+    def save(self, *args, **kwargs):
+        self.name = normalize_place_name(self.name)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.name} -> {self.location_id}"
+
+class RouteDistance(models.Model):
+    """
+    Cached distance for the lane between two Locations in one distance mode.
+    origin is the Location with the lower id, so both directions of a lane
+    share one row (see api.services.route_key).
+    """
+    origin = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    destination = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    # One of api.distance.DISTANCE_MODES
+    mode = models.CharField(max_length=20)
+    distance_km = models.FloatField()
+    # Usage stats, used to find (and pin in memory) the hottest lanes
+    hit_count = models.PositiveBigIntegerField(default=0)
+    last_used_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('origin', 'destination', 'mode')
+        indexes = [models.Index(fields=['-hit_count'])]
+
+    def __str__(self):
+        return f"{self.origin_id} <-> {self.destination_id}: {self.distance_km:.1f} km ({self.mode})"
+
 class Shipment(models.Model):
     """
     Records shipment details and automatically calculates carbon footprint.
     """
-    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    # No index of its own: every index in Meta starts with the company
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, db_index=False)
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     owner = models.ForeignKey(
         User, 
@@ -85,6 +287,9 @@ class Shipment(models.Model):
     )
     origin = models.CharField(max_length=255)
     destination = models.CharField(max_length=255)
+    # Resolved from origin/destination on save; the free text is kept as entered
+    origin_location = models.ForeignKey(Location, on_delete=models.PROTECT, related_name='+', blank=True)
+    destination_location = models.ForeignKey(Location, on_delete=models.PROTECT, related_name='+', blank=True)
     
     # Positive constraints via MinValueValidator
     distance = models.DecimalField(
@@ -111,19 +316,184 @@ class Shipment(models.Model):
         blank=True
     )
     
+    # 'pending' until the metrics job has run, and while a place of the lane
+    # can't be geocoded and the lane waits for a retry (see LaneRetry); 'failed'
+    # once its retries ran out
+    METRICS_STATUS_CHOICES = [('ok', 'OK'), ('pending', 'Waiting for geocoding'), ('failed', 'Geocoding failed')]
+    metrics_status = models.CharField(max_length=10, choices=METRICS_STATUS_CHOICES, default='pending')
+
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # What the metrics are computed from: the distance from the places, the
+    # footprint from the distance, weight and vehicle
+    DISTANCE_INPUTS = ('origin', 'destination')
+    CARBON_INPUTS = ('weight', 'vehicle_id')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what this row currently adds to the emission rollups
+        rollups.snapshot(instance)
+        instance._loaded_inputs = instance.metric_inputs()
+        return instance
+
+    def metric_inputs(self):
+        # Deferred fields are left out until they're loaded or assigned
+        inputs = {}
+        for attname in self.DISTANCE_INPUTS + self.CARBON_INPUTS:
+            if attname in self.__dict__:
+                field = self._meta.get_field(attname.removesuffix('_id'))
+                inputs[attname] = field.to_python(self.__dict__[attname])
+        return inputs
+
+    def changed_inputs(self, update_fields=None):
+        """
+        The metric inputs edited since the row was loaded or last saved (those
+        in `update_fields` only, when given). Empty for unsaved shipments.
+        """
+        loaded = getattr(self, '_loaded_inputs', None)
+        if loaded is None:
+            return set()
+        changed = {
+            attname for attname, value in self.metric_inputs().items()
+            if attname not in loaded or loaded[attname] != value
+        }
+        if update_fields is not None:
+            changed = {attname for attname in changed if {attname, attname.removesuffix('_id')} & set(update_fields)}
+        return changed
+
+    def resolve_locations(self, changed=()):
+        """
+        Points origin_location/destination_location at the Locations for the
+        current origin/destination text, when it's new or in `changed`.
+        Returns the names of the fields changed.
+        """
+        fields = []
+        for text_field, fk_field in (('origin', 'origin_location'), ('destination', 'destination_location')):
+            # Unsaved shipments keep Locations the caller already resolved
+            if getattr(self, f'{fk_field}_id') is None or text_field in changed:
+                setattr(self, fk_field, Location.objects.resolve(getattr(self, text_field)))
+                fields.append(fk_field)
+        return fields
+
     def save(self, *args, **kwargs):
-        # Perform the standard save first
         is_new = self._state.adding
+        if is_new:
+            self._rollup_contribution = None
+        update_fields = kwargs.get('update_fields')
+        changed = self.changed_inputs(update_fields)
+        extra_fields = self.resolve_locations(changed)
+
+        needs_job = False
+        if is_new:
+            # Unless created with its footprint already computed (the async create view)
+            needs_job = not self.carbon_footprint
+        elif changed & set(self.DISTANCE_INPUTS):
+            # New places: the distance (and so the footprint) is stale until the job runs
+            self.distance = self.carbon_footprint = None
+            self.metrics_status = 'pending'
+            extra_fields += ['distance', 'carbon_footprint', 'metrics_status']
+            needs_job = True
+        elif changed and self.distance is not None:
+            # Same lane, new weight or vehicle: no geocoding needed, update the footprint in place
+            self.carbon_footprint = float(self.distance) * float(self.weight) * float(self.vehicle.emission_factor)
+            extra_fields.append('carbon_footprint')
+        elif changed:
+            needs_job = True
+        # Anything else (notes, admin edits of other fields, the job's own
+        # save) leaves the metrics alone: a single UPDATE
+
+        if extra_fields and update_fields is not None:
+            kwargs['update_fields'] = list(update_fields) + extra_fields
         super().save(*args, **kwargs)
-        
-        if is_new or not self.carbon_footprint:
-            from .tasks import compute_shipment_metrics_task
-            # In Eager mode, this line executes the task immediately
-            compute_shipment_metrics_task(str(self.id))
-      
+        self._loaded_inputs = self.metric_inputs()
+        rollups.record_shipment_change(self)
+
+        if needs_job:
+            from .tasks import compute_shipment_metrics_batch_task, compute_shipment_metrics_task
+            # Runs after commit, in the background unless METRICS_DISPATCH is 'eager'
+            # (batched with other shipments' jobs under load)
+            enqueue(compute_shipment_metrics_task, str(self.id), batch_task=compute_shipment_metrics_batch_task)
+
+    class Meta:
+        # Shaped after the list/export queries (ShipmentScopeMixin): managers see
+        # their company, drivers their own rows in it, each in created_at order by
+        # default (keyset pages break ties on id). Filters on vehicle and lane come
+        # on top. The client scope (company IS NULL) needs no index: company is
+        # NOT NULL, so it never matches a row.
+        indexes = [
+            models.Index(fields=['company', 'created_at', 'id'], name='shipment_company_created_idx'),
+            models.Index(fields=['company', 'owner', 'created_at', 'id'], name='shipment_driver_created_idx'),
+            # ?ordering= on the company-wide lists
+            models.Index(fields=['company', 'carbon_footprint', 'id'], name='shipment_company_co2_idx'),
+            models.Index(fields=['company', 'weight', 'id'], name='shipment_company_weight_idx'),
+            models.Index(fields=['company', 'vehicle', 'created_at'], name='shipment_company_vehicle_idx'),
+            models.Index(fields=['company', 'origin', 'destination'], name='shipment_company_lane_idx'),
+            # Shipments waiting on a lane (api.retries) and lane recomputes
+            models.Index(fields=['origin_location', 'destination_location'], name='shipment_location_lane_idx'),
+            # The stale-job sweep (api.retries.redispatch_stale_shipments); only the few unpriced rows
+            models.Index(
+                fields=['created_at'], name='shipment_pending_created_idx',
+                condition=models.Q(metrics_status='pending'),
+            ),
+        ]
 
     def __str__(self):
         return f"Shipment {self.id} - {self.carbon_footprint}kg CO2"
 
+@receiver(post_delete, sender=Shipment)
+def remove_shipment_from_rollups(sender, instance, **kwargs):
+    rollups.record_shipment_change(instance, deleted=True)
+
+class EmissionRollup(models.Model):
+    """
+    Pre-aggregated emissions per (company, vehicle, lane, day), kept up to date
+    as footprints are computed so analytics never scan the Shipment table.
+    Lanes are pairs of Locations; weeks and months are summed from days.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='emission_rollups')
+    vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE, related_name='emission_rollups')
+    origin = models.ForeignKey(Location, on_delete=models.PROTECT, related_name='+')
+    destination = models.ForeignKey(Location, on_delete=models.PROTECT, related_name='+')
+    day = models.DateField()
+
+    shipment_count = models.PositiveIntegerField(default=0)
+    total_co2 = models.DecimalField(max_digits=18, decimal_places=3, default=0)
+    total_distance = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    total_weight = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('company', 'vehicle', 'origin', 'destination', 'day')
+        indexes = [models.Index(fields=['company', 'day'])]
+
+    def __str__(self):
+        return f"{self.company_id}/{self.vehicle_id} {self.origin_id} -> {self.destination_id} {self.day}: {self.total_co2}kg CO2"
+
+
+class LaneRetry(models.Model):
+    """
+    A lane whose distance couldn't be computed because one of its places failed
+    to geocode. Its shipments wait in metrics_status 'pending' while the lane is
+    retried in the background with exponential backoff (api.retries); once
+    resolved, they're all priced together and the row goes away. After
+    GEOCODE_RETRY_MAX_ATTEMPTS the lane is dead-lettered: status 'dead', its
+    shipments 'failed', left for someone to fix the place in the admin.
+    """
+    STATUS_CHOICES = [('pending', 'Pending'), ('dead', 'Dead letter')]
+
+    origin = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    destination = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='+')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('origin', 'destination')
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+        verbose_name_plural = "Lane retries"
+
+    def __str__(self):
+        return f"{self.origin_id} -> {self.destination_id} ({self.status}, {self.attempts} attempts)"
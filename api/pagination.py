@@ -0,0 +1,220 @@
+import base64
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.paginator import InvalidPage
+from django.db import connection
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def approximate_count(queryset):
+    """
+    Row estimate from the PostgreSQL planner (no COUNT(*) scan), or None on
+    other databases.
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (ordering field, id): every page is a "WHERE (field, id)
+    after the last row seen ... LIMIT n" query, so page N costs the same as page 1
+    and nothing is counted. Ties on the ordering field are broken by id, and
+    NULLs (e.g. a footprint still being computed) sort last in either direction.
+
+    The ordering comes from the view's OrderingFilter (?ordering=-weight); only
+    its first field is used. Clients can ask for ?page_size= up to max_page_size
+    and for an approximate total with ?include_total=approx.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    default_ordering = '-created_at'
+
+    def __init__(self):
+        self.page_size = settings.REST_FRAMEWORK.get('PAGE_SIZE', 10)
+        self.max_page_size = getattr(settings, 'MAX_PAGE_SIZE', 100)
+
+    @classmethod
+    def is_requested(cls, request):
+        params = request.query_params
+        return cls.cursor_query_param in params or params.get('pagination') == 'cursor'
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_ordering(self, request, view):
+        for backend in getattr(view, 'filter_backends', []):
+            if hasattr(backend, 'get_ordering'):
+                ordering = backend().get_ordering(request, view.get_queryset(), view)
+                if ordering:
+                    return ordering[0]
+        return self.default_ordering
+
+    def encode_cursor(self, obj, reverse=False):
+        # Rows are model instances, or dicts from values() on the fast read path
+        if isinstance(obj, dict):
+            value, pk = obj[self.field], obj['id']
+        else:
+            value, pk = getattr(obj, self.field), obj.pk
+        if value is not None:
+            value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        payload = json.dumps({'v': value, 'id': str(pk), 'r': reverse})
+        cursor = base64.urlsafe_b64encode(payload.encode()).decode()
+        url = remove_query_param(self.base_url, 'pagination')
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, raw, model):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(raw.encode()))
+            value = data['v']
+            if value is not None:
+                value = model._meta.get_field(self.field).to_python(value)
+            return value, model._meta.pk.to_python(data['id']), bool(data.get('r'))
+        except Exception:
+            raise NotFound("Invalid cursor.")
+
+    def _after(self, value, pk, descending):
+        """
+        Rows strictly after (value, pk) in the (field, id) ordering, NULLs last.
+        """
+        field = self.field
+        cmp = 'lt' if descending else 'gt'
+        if value is None:
+            return Q(**{f'{field}__isnull': True, f'pk__{cmp}': pk})
+        after = Q(**{f'{field}__{cmp}': value}) | Q(**{field: value, f'pk__{cmp}': pk})
+        return after | Q(**{f'{field}__isnull': True}) if self.nullable else after
+
+    def _before(self, value, pk, descending):
+        field = self.field
+        cmp = 'gt' if descending else 'lt'
+        if value is None:
+            return Q(**{f'{field}__isnull': False}) | Q(**{f'{field}__isnull': True, f'pk__{cmp}': pk})
+        return Q(**{f'{field}__{cmp}': value}) | Q(**{field: value, f'pk__{cmp}': pk})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_queryset, page_size, reverse = self._page_queryset(queryset, request, view)
+        rows = list(page_queryset)
+        self.approximate_count = None
+        if request.query_params.get('include_total') == 'approx':
+            self.approximate_count = approximate_count(queryset)
+        return self._page(rows, page_size, reverse)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """
+        paginate_queryset() for async views.
+        """
+        page_queryset, page_size, reverse = self._page_queryset(queryset, request, view)
+        rows = [row async for row in page_queryset]
+        self.approximate_count = None
+        if request.query_params.get('include_total') == 'approx':
+            self.approximate_count = await sync_to_async(approximate_count)(queryset)
+        return self._page(rows, page_size, reverse)
+
+    def _page_queryset(self, queryset, request, view):
+        """
+        The query for the requested page, one row longer than the page so we
+        know whether there's a next one.
+        """
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+
+        ordering = self.get_ordering(request, view)
+        descending = ordering.startswith('-')
+        self.field = ordering.lstrip('-')
+        # NULL handling only where NULLs can occur: a plain ORDER BY is what the
+        # (company, field, id) indexes can be scanned in
+        self.nullable = queryset.model._meta.get_field(self.field).null
+
+        reverse = False
+        self.has_cursor = self.cursor_query_param in request.query_params
+        if self.has_cursor:
+            value, pk, reverse = self.decode_cursor(request.query_params[self.cursor_query_param], queryset.model)
+            position = self._before(value, pk, descending) if reverse else self._after(value, pk, descending)
+            page_queryset = queryset.filter(position)
+        else:
+            page_queryset = queryset
+
+        # Walking backwards means reading the opposite order and flipping the page
+        nulls = {}
+        if self.nullable:
+            nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+        if descending != reverse:
+            order = [F(self.field).desc(**nulls), '-pk']
+        else:
+            order = [F(self.field).asc(**nulls), 'pk']
+
+        return page_queryset.order_by(*order)[:page_size + 1], page_size, reverse
+
+    def _page(self, rows, page_size, reverse):
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+
+        self.next_link = self.previous_link = None
+        if rows:
+            if has_more or reverse:
+                self.next_link = self.encode_cursor(rows[-1])
+            if (has_more and reverse) or (self.has_cursor and not reverse):
+                self.previous_link = self.encode_cursor(rows[0], reverse=True)
+        return rows
+
+    def get_paginated_response(self, data):
+        body = {'next': self.next_link, 'previous': self.previous_link, 'results': data}
+        if self.request.query_params.get('include_total') == 'approx':
+            body['approximate_count'] = self.approximate_count
+        return Response(body)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'approximate_count': {'type': 'integer', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+
+class AsyncPageNumberPagination(PageNumberPagination):
+    """
+    The default page-number pagination for async views: the COUNT(*) and the
+    page are read with the async ORM. Same params and response body.
+    """
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        paginator = self.django_paginator_class(queryset, page_size)
+        # Counted here, so the paginator doesn't run its own blocking COUNT(*)
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            msg = self.invalid_page_message.format(page_number=page_number, message=str(exc))
+            raise NotFound(msg)
+
+        self.page.object_list = [row async for row in self.page.object_list]
+        if paginator.num_pages > 1 and self.template is not None:
+            # The browsable API renders the page links
+            self.display_page_controls = True
+        return list(self.page)
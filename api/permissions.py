@@ -11,4 +11,4 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
             return True
 
         # Write permissions are only allowed to the owner of the shipment.
-        return obj.owner == request.user
\ No newline at end of file
+        return obj.owner_id == request.user.id
\ No newline at end of file
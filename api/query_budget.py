@@ -0,0 +1,75 @@
+from contextlib import ContextDecorator
+
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class assert_max_queries(ContextDecorator):
+    """
+    Fails when the wrapped block (or decorated function) runs more than `limit`
+    queries on `using`. The error lists every query that ran, which makes N+1
+    regressions easy to spot:
+
+        with assert_max_queries(2):
+            client.get('/api/shipments/')
+    """
+
+    def __init__(self, limit, using='default'):
+        self.limit = limit
+        self.using = using
+
+    def __enter__(self):
+        self.captured = CaptureQueriesContext(connections[self.using])
+        self.captured.__enter__()
+        return self.captured
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.captured.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return False
+        count = len(self.captured)
+        if count > self.limit:
+            queries = '\n'.join(
+                f"{i}. {query['sql']}" for i, query in enumerate(self.captured.captured_queries, start=1)
+            )
+            raise QueryBudgetExceeded(f"{count} queries executed, budget is {self.limit}:\n{queries}")
+        return False
+
+
+def explain(sql, using='default'):
+    """
+    The database's plan for a query, as text: EXPLAIN QUERY PLAN on SQLite,
+    EXPLAIN on PostgreSQL. `sql` has its parameters inlined, as in the
+    captured queries of CaptureQueriesContext / assert_max_queries.
+    """
+    connection = connections[using]
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql)
+        return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+
+def full_scans(plan, table):
+    """
+    Lines of `plan` that read all of `table` instead of searching an index.
+    SQLite's "SCAN table USING INDEX" walks the whole index, so it counts too.
+    """
+    return [
+        line.strip() for line in plan.splitlines()
+        if line.strip().startswith(f'SCAN {table}') or f'Seq Scan on {table}' in line
+    ]
+
+
+def sorts(plan):
+    """
+    Lines of `plan` where rows are sorted after being read, i.e. no index
+    returned them in the requested order.
+    """
+    return [
+        line.strip() for line in plan.splitlines()
+        if 'TEMP B-TREE FOR ORDER BY' in line or line.strip(' ->').startswith(('Sort', 'Incremental Sort'))
+    ]
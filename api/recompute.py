@@ -0,0 +1,111 @@
+import numpy as np
+from django.db import transaction
+
+from . import rollups
+from .distance import distances_km
+from .models import Shipment
+
+
+def recompute_vehicle_footprints(vehicle, chunk_size=10000, progress=None):
+    """
+    Recomputes carbon_footprint for every priced shipment of `vehicle` after its
+    emission factor changed.
+
+    Shipments are walked in primary-key order (keyset, no OFFSET), each chunk's
+    (distance, weight) columns are pulled into NumPy arrays, the footprints are
+    computed in one vectorized multiply and written back with bulk_update. The
+    difference is applied to the emission rollups per chunk.
+    `progress(done, total)` is called after every chunk. Returns the row count.
+    """
+    factor = float(vehicle.emission_factor)
+    queryset = Shipment.objects.filter(vehicle=vehicle, distance__isnull=False).order_by('pk')
+    total = queryset.count()
+    done = 0
+    last_pk = None
+
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(page.values_list(
+            'pk', 'distance', 'weight', 'carbon_footprint', 'company_id', 'origin_location_id', 'destination_location_id', 'created_at'
+        )[:chunk_size])
+        if not rows:
+            break
+
+        ids, distances, weights = list(zip(*rows))[:3]
+        distance = np.fromiter(distances, dtype=np.float64, count=len(rows))
+        weight = np.fromiter(weights, dtype=np.float64, count=len(rows))
+        footprints = np.round(distance * weight * factor, 3)
+
+        updates = []
+        deltas = rollups.new_deltas()
+        for row, footprint in zip(rows, footprints.tolist()):
+            pk, distance_km, weight_t, old_footprint, company_id, origin, destination, created_at = row
+            updates.append(Shipment(pk=pk, carbon_footprint=footprint))
+            lane = (company_id, vehicle.pk, origin, destination, created_at, distance_km, weight_t)
+            rollups.add_delta(deltas, rollups.contribution(*lane, old_footprint), -1)
+            rollups.add_delta(deltas, rollups.contribution(*lane, footprint))
+
+        with transaction.atomic():
+            Shipment.objects.bulk_update(updates, ['carbon_footprint'], batch_size=1000)
+            rollups.apply_rollup_deltas(deltas)
+
+        done += len(rows)
+        last_pk = ids[-1]
+        if progress is not None:
+            progress(done, total)
+
+    return done
+
+
+def recompute_shipment_distances(vehicle, mode=None, chunk_size=10000, progress=None):
+    """
+    Recomputes distance (and with it carbon_footprint) for every shipment of
+    `vehicle` whose two places are geocoded, e.g. after switching DISTANCE_MODE.
+
+    Walks the shipments like recompute_vehicle_footprints(); each chunk's
+    coordinates are pulled into arrays and its distances computed in one call
+    to api.distance.distances_km() with `mode`. Returns the row count.
+    """
+    factor = float(vehicle.emission_factor)
+    queryset = Shipment.objects.filter(
+        vehicle=vehicle, origin_location__latitude__isnull=False, destination_location__latitude__isnull=False,
+    ).order_by('pk')
+    total = queryset.count()
+    done = 0
+    last_pk = None
+
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(page.values_list(
+            'pk', 'origin_location__latitude', 'origin_location__longitude',
+            'destination_location__latitude', 'destination_location__longitude',
+            'distance', 'weight', 'carbon_footprint', 'company_id', 'origin_location_id', 'destination_location_id', 'created_at'
+        )[:chunk_size])
+        if not rows:
+            break
+
+        columns = list(zip(*rows))
+        lat1, lon1, lat2, lon2 = (np.fromiter(column, dtype=np.float64, count=len(rows)) for column in columns[1:5])
+        weight = np.fromiter(columns[6], dtype=np.float64, count=len(rows))
+        distance = np.round(distances_km(lat1, lon1, lat2, lon2, mode), 2)
+        footprints = np.round(distance * weight * factor, 3)
+
+        updates = []
+        deltas = rollups.new_deltas()
+        for row, distance_km, footprint in zip(rows, distance.tolist(), footprints.tolist()):
+            pk, _, _, _, _, old_distance, weight_t, old_footprint, company_id, origin, destination, created_at = row
+            updates.append(Shipment(pk=pk, distance=distance_km, carbon_footprint=footprint, metrics_status='ok'))
+            lane = (company_id, vehicle.pk, origin, destination, created_at)
+            rollups.add_delta(deltas, rollups.contribution(*lane, old_distance, weight_t, old_footprint), -1)
+            rollups.add_delta(deltas, rollups.contribution(*lane, distance_km, weight_t, footprint))
+
+        with transaction.atomic():
+            Shipment.objects.bulk_update(updates, ['distance', 'carbon_footprint', 'metrics_status'], batch_size=1000)
+            rollups.apply_rollup_deltas(deltas)
+
+        done += len(rows)
+        last_pk = rows[-1][0]
+        if progress is not None:
+            progress(done, total)
+
+    return done
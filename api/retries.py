@@ -0,0 +1,185 @@
+"""
+Background retries of lanes whose places failed to geocode.
+
+compute_metrics_for_shipments() hands unresolved lanes to schedule_lane_retries()
+and leaves their shipments 'pending' instead of pricing them at 0 km. A periodic
+job (retry_geocoding_task on Celery beat, or `manage.py retry_geocoding` from
+cron) calls retry_due_lanes(), which geocodes the places of every lane that is
+due and prices all the shipments waiting on a lane once it resolves. The same
+run sends the metric job again for shipments that have been 'pending' too long
+without a lane to wait on, whose job was lost (redispatch_stale_shipments()).
+"""
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from geopy.exc import GeocoderServiceError
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'geocode-retry:lock'
+
+
+def retry_delay(attempts):
+    """
+    Seconds until the next try after `attempts` failures: doubling from
+    GEOCODE_RETRY_BASE_DELAY up to GEOCODE_RETRY_MAX_DELAY, with jitter so lanes
+    that failed together (an outage) don't all come back at once.
+    """
+    base = getattr(settings, 'GEOCODE_RETRY_BASE_DELAY', 60)
+    delay = min(base * 2 ** attempts, getattr(settings, 'GEOCODE_RETRY_MAX_DELAY', 6 * 3600))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def schedule_lane_retries(lanes, error=''):
+    """
+    Queues retries for `lanes`, (origin_location_id, destination_location_id)
+    pairs; lanes already queued keep their schedule. Returns the subset that is
+    dead-lettered, whose shipments should be marked 'failed' right away.
+    """
+    from .models import LaneRetry
+
+    lanes = set(lanes)
+    if not lanes:
+        return set()
+    now = timezone.now()
+    LaneRetry.objects.bulk_create(
+        [
+            LaneRetry(
+                origin_id=origin, destination_id=destination, last_error=error[:1000],
+                next_attempt_at=now + timedelta(seconds=retry_delay(0)),
+            )
+            for origin, destination in lanes
+        ],
+        ignore_conflicts=True,
+    )
+    query = Q()
+    for origin, destination in lanes:
+        query |= Q(origin_id=origin, destination_id=destination)
+    return set(LaneRetry.objects.filter(query, status='dead').values_list('origin_id', 'destination_id'))
+
+
+def waiting_shipments(lane):
+    from .models import Shipment
+
+    return Shipment.objects.select_related('vehicle', 'origin_location', 'destination_location').filter(
+        origin_location_id=lane.origin_id, destination_location_id=lane.destination_id,
+        metrics_status__in=['pending', 'failed'],
+    )
+
+
+def redispatch_stale_shipments(now=None, limit=None):
+    """
+    Sends the metric job again for shipments still 'pending' METRICS_STALE_AFTER
+    seconds after they were created, unless they wait on a lane retry: their
+    job was lost, e.g. buffered by api.dispatch.Batcher in a process that
+    crashed. Up to `limit` (default METRICS_BATCH_SIZE) go out as one batch job.
+    Returns how many were sent.
+    """
+    from .dispatch import enqueue
+    from .models import LaneRetry, Shipment
+    from .tasks import compute_shipment_metrics_batch_task
+
+    now = now or timezone.now()
+    limit = limit or getattr(settings, 'METRICS_BATCH_SIZE', 500)
+    cutoff = now - timedelta(seconds=getattr(settings, 'METRICS_STALE_AFTER', 300))
+    queued = LaneRetry.objects.filter(
+        origin_id=OuterRef('origin_location_id'), destination_id=OuterRef('destination_location_id'),
+    )
+    ids = list(
+        Shipment.objects.filter(metrics_status='pending', created_at__lt=cutoff).exclude(Exists(queued))
+        .order_by('created_at').values_list('id', flat=True)[:limit]
+    )
+    if ids:
+        enqueue(compute_shipment_metrics_batch_task, tuple(str(pk) for pk in ids))
+    return len(ids)
+
+
+def retry_due_lanes(limit=None, now=None):
+    """
+    Retries up to `limit` lanes whose next attempt is due, plus any pending lane
+    whose places have coordinates by now (fixed in the admin, or found while
+    retrying another lane), then re-sends lost metric jobs (see
+    redispatch_stale_shipments()). Returns counts of what happened.
+    """
+    from .models import LaneRetry, Location
+    from .services import locate_many
+    from .tasks import compute_metrics_for_shipments
+
+    limit = limit or getattr(settings, 'GEOCODE_RETRY_BATCH_SIZE', 100)
+    now = now or timezone.now()
+    stats = {'lanes': 0, 'resolved': 0, 'shipments': 0, 'rescheduled': 0, 'dead': 0, 'stale': 0}
+    # One scheduler at a time, however many workers run the periodic job
+    if not cache.add(LOCK_KEY, 1, getattr(settings, 'GEOCODE_RETRY_LOCK_TTL', 600)):
+        return stats
+    try:
+        due = list(
+            LaneRetry.objects.filter(status='pending', next_attempt_at__lte=now)
+            .select_related('origin', 'destination').order_by('next_attempt_at')[:limit]
+        )
+        places = {}
+        for lane in due:
+            places.setdefault(lane.origin_id, lane.origin)
+            places.setdefault(lane.destination_id, lane.destination)
+        error = ''
+        try:
+            locate_many(list(places.values()))
+        except GeocoderServiceError as exc:
+            # Whatever did resolve is stored; the rest waits for the next round
+            error = str(exc)
+
+        ready = LaneRetry.objects.filter(
+            status='pending', origin__latitude__isnull=False, destination__latitude__isnull=False,
+        ).exclude(pk__in=[lane.pk for lane in due if places[lane.origin_id].coordinates is None
+                          or places[lane.destination_id].coordinates is None])
+        lanes = {lane.pk: lane for lane in due}
+        lanes.update({lane.pk: lane for lane in ready[:limit]})
+        stats['lanes'] = len(lanes)
+
+        for lane in lanes.values():
+            origin = places.get(lane.origin_id) or Location.objects.get(pk=lane.origin_id)
+            destination = places.get(lane.destination_id) or Location.objects.get(pk=lane.destination_id)
+            if origin.coordinates is not None and destination.coordinates is not None:
+                shipments = list(waiting_shipments(lane))
+                if shipments:
+                    compute_metrics_for_shipments(shipments)
+                lane.delete()
+                stats['resolved'] += 1
+                stats['shipments'] += len(shipments)
+                continue
+
+            lane.attempts += 1
+            lane.last_error = (error or "Place not found")[:1000]
+            if lane.attempts >= getattr(settings, 'GEOCODE_RETRY_MAX_ATTEMPTS', 8):
+                lane.status = 'dead'
+                waiting_shipments(lane).update(metrics_status='failed')
+                stats['dead'] += 1
+            else:
+                lane.next_attempt_at = now + timedelta(seconds=retry_delay(lane.attempts))
+                stats['rescheduled'] += 1
+            lane.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at', 'updated_at'])
+
+        stats['stale'] = redispatch_stale_shipments(now)
+    finally:
+        cache.delete(LOCK_KEY)
+
+    if stats['lanes'] or stats['stale']:
+        logger.info(
+            "Geocoding retries: %(resolved)d lanes resolved (%(shipments)d shipments), "
+            "%(rescheduled)d rescheduled, %(dead)d dead-lettered; %(stale)d stale shipments re-sent", stats,
+        )
+    return stats
+
+
+def requeue_lanes(lanes):
+    """
+    Puts dead-lettered (or waiting) lanes back at the front of the queue with a
+    fresh attempt count, e.g. after fixing a place's spelling or coordinates.
+    """
+    for lane in lanes:
+        waiting_shipments(lane).filter(metrics_status='failed').update(metrics_status='pending')
+    return lanes.update(status='pending', attempts=0, next_attempt_at=timezone.now())
@@ -0,0 +1,151 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+# Shipment fields a rollup contribution depends on
+ROLLUP_FIELDS = (
+    'company_id', 'vehicle_id', 'origin_location_id', 'destination_location_id',
+    'created_at', 'distance', 'weight', 'carbon_footprint',
+)
+
+_CO2 = Decimal('0.001')
+_CENTS = Decimal('0.01')
+
+
+def _quantize(value, exp):
+    return Decimal(str(value or 0)).quantize(exp)
+
+
+def contribution(company_id, vehicle_id, origin, destination, created_at, distance, weight, carbon_footprint):
+    """
+    What one shipment adds to the rollups: (key, (count, co2, distance, weight)),
+    or None while its footprint hasn't been computed.
+    """
+    if carbon_footprint is None or created_at is None:
+        return None
+    key = (company_id, vehicle_id, origin, destination, timezone.localdate(created_at))
+    return key, (1, _quantize(carbon_footprint, _CO2), _quantize(distance, _CENTS), _quantize(weight, _CENTS))
+
+
+def shipment_contribution(shipment):
+    return contribution(*(shipment.__dict__.get(field) for field in ROLLUP_FIELDS))
+
+
+def snapshot(shipment):
+    """
+    The contribution as currently stored, kept on the instance so the next save
+    knows what to take back out. Left unset when some fields were deferred.
+    """
+    if all(field in shipment.__dict__ for field in ROLLUP_FIELDS):
+        shipment._rollup_contribution = shipment_contribution(shipment)
+
+
+def add_delta(deltas, item, sign=1):
+    if item is None:
+        return
+    key, values = item
+    totals = deltas[key]
+    for i, value in enumerate(values):
+        totals[i] += sign * value
+
+
+def new_deltas():
+    return defaultdict(lambda: [0, Decimal(0), Decimal(0), Decimal(0)])
+
+
+def apply_rollup_deltas(deltas, create=True):
+    """
+    Adds {key: [count, co2, distance, weight]} onto the EmissionRollup rows,
+    creating rows for buckets seen for the first time (unless create=False).
+    """
+    from .models import EmissionRollup
+
+    for (company_id, vehicle_id, origin, destination, day), (count, co2, distance, weight) in deltas.items():
+        if not (count or co2 or distance or weight):
+            continue
+        lookup = dict(
+            company_id=company_id, vehicle_id=vehicle_id, origin_id=origin, destination_id=destination, day=day
+        )
+        changes = dict(
+            shipment_count=F('shipment_count') + count,
+            total_co2=F('total_co2') + co2,
+            total_distance=F('total_distance') + distance,
+            total_weight=F('total_weight') + weight,
+        )
+        if EmissionRollup.objects.filter(**lookup).update(**changes):
+            if count < 0:
+                # Drop buckets whose last shipment just left
+                EmissionRollup.objects.filter(**lookup, shipment_count=0).delete()
+            continue
+        if not create:
+            continue
+        try:
+            with transaction.atomic():
+                EmissionRollup.objects.create(
+                    **lookup, shipment_count=count, total_co2=co2, total_distance=distance, total_weight=weight
+                )
+        except IntegrityError:
+            # Another worker created the bucket first
+            EmissionRollup.objects.filter(**lookup).update(**changes)
+
+
+def record_shipment_change(shipment, deleted=False):
+    """
+    Moves a saved shipment's contribution from its previous bucket/values to the
+    current ones. Called from Shipment.save() and when a shipment is deleted.
+    """
+    if not hasattr(shipment, '_rollup_contribution'):
+        # Loaded with deferred fields: can't tell what changed, leave it to a rebuild
+        return
+    before = shipment._rollup_contribution
+    after = None if deleted else shipment_contribution(shipment)
+    if before == after:
+        return
+    deltas = new_deltas()
+    add_delta(deltas, before, -1)
+    add_delta(deltas, after)
+    # A delete only takes away; never recreate a bucket (its company may be going too)
+    apply_rollup_deltas(deltas, create=not deleted)
+    shipment._rollup_contribution = after
+
+
+def rebuild_emission_rollups(batch_size=5000):
+    """
+    Recomputes every rollup row from the Shipment table. Returns the row count.
+    """
+    from .models import EmissionRollup, Shipment
+
+    rows = (
+        Shipment.objects.filter(carbon_footprint__isnull=False)
+        .annotate(day=TruncDate('created_at'))
+        .values('company_id', 'vehicle_id', 'origin_location_id', 'destination_location_id', 'day')
+        .annotate(
+            count=Count('id'), co2=Sum('carbon_footprint'), distance=Sum('distance'), weight=Sum('weight')
+        )
+        .order_by()
+    )
+    totals = new_deltas()
+    for row in rows.iterator(chunk_size=batch_size):
+        key = (
+            row['company_id'], row['vehicle_id'], row['origin_location_id'], row['destination_location_id'], row['day']
+        )
+        add_delta(totals, (key, (
+            row['count'], _quantize(row['co2'], _CO2),
+            _quantize(row['distance'], _CENTS), _quantize(row['weight'], _CENTS),
+        )))
+
+    objs = [
+        EmissionRollup(
+            company_id=company_id, vehicle_id=vehicle_id, origin_id=origin, destination_id=destination, day=day,
+            shipment_count=count, total_co2=co2, total_distance=distance, total_weight=weight,
+        )
+        for (company_id, vehicle_id, origin, destination, day), (count, co2, distance, weight) in totals.items()
+    ]
+    with transaction.atomic():
+        EmissionRollup.objects.all().delete()
+        EmissionRollup.objects.bulk_create(objs, batch_size=batch_size)
+    return len(objs)
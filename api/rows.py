@@ -0,0 +1,100 @@
+"""
+Fast read path for shipment lists and exports.
+
+Rows are read with values() (only the columns the API shows, owner.username
+joined in the same query) and turned into plain dicts by one converter per
+column, rendering exactly what ShipmentSerializer renders for the same row.
+Building model instances and running every serializer field per row is most
+of the CPU cost of a big page; `manage.py benchmark_serialization` compares
+the two.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Shipment
+
+# Same fields, in the same order, as ShipmentSerializer, and what each is read from
+SHIPMENT_COLUMNS = [
+    ('id', 'id'),
+    ('origin', 'origin'),
+    ('destination', 'destination'),
+    ('weight', 'weight'),
+    ('vehicle', 'vehicle_id'),
+    ('distance', 'distance'),
+    ('carbon_footprint', 'carbon_footprint'),
+    ('metrics_status', 'metrics_status'),
+    ('owner', 'owner__username'),
+    ('created_at', 'created_at'),
+]
+
+
+def _as_str(value):
+    return None if value is None else str(value)
+
+
+def _as_float(value):
+    # ReadOnlyField hands the Decimal to the JSON encoder, which writes a float
+    return None if value is None else float(value)
+
+
+def _decimal_string(field):
+    # serializers.DecimalField: quantized to the field's places, as a string
+    exponent = Decimal(1).scaleb(-field.decimal_places)
+
+    def convert(value):
+        return None if value is None else f'{value.quantize(exponent):f}'
+    return convert
+
+
+def _iso_datetime(tz):
+    # serializers.DateTimeField: in the current time zone, UTC written as Z
+    def convert(value):
+        if value is None:
+            return None
+        value = value.astimezone(tz).isoformat() if tz is not None else value.isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return convert
+
+
+def column_converters():
+    """
+    One converter per SHIPMENT_COLUMNS entry, None where the value is used as
+    is. Built per call: the datetime one depends on the active time zone.
+    """
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+    converters = {
+        'id': str,
+        'weight': _decimal_string(Shipment._meta.get_field('weight')),
+        'vehicle': str,
+        'distance': _as_float,
+        'carbon_footprint': _as_float,
+        'owner': _as_str,
+        'created_at': _iso_datetime(tz),
+    }
+    return [converters.get(name) for name, _ in SHIPMENT_COLUMNS]
+
+
+def shipment_values(queryset):
+    """
+    The queryset as dicts holding only the columns the API shows.
+    """
+    return queryset.values(*(lookup for _, lookup in SHIPMENT_COLUMNS))
+
+
+def shipment_records(rows):
+    """
+    ShipmentSerializer(many=True).data for rows of shipment_values().
+    """
+    columns = [
+        (name, lookup, convert) for (name, lookup), convert in zip(SHIPMENT_COLUMNS, column_converters())
+    ]
+    records = []
+    for row in rows:
+        record = {name: row[lookup] if convert is None else convert(row[lookup]) for name, lookup, convert in columns}
+        # ReadOnlyField skips owner.username altogether for shipments without an owner
+        if record['owner'] is None:
+            del record['owner']
+        records.append(record)
+    return records
@@ -0,0 +1,170 @@
+import re
+import sqlite3
+import uuid
+
+from django.db import connection
+from django.db.models import BooleanField, Func, Q, Value
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+
+SQLITE_SEARCH_TABLE = 'api_shipment_search'
+
+_HEX_PREFIX = re.compile(r'^[0-9a-f-]{1,36}$')
+
+
+class ILike(Func):
+    """
+    `column ILIKE pattern` on PostgreSQL, which a gin_trgm_ops index can serve
+    (Django's icontains wraps the column in UPPER() and can't use it).
+    """
+    arg_joiner = ' ILIKE '
+    template = '(%(expressions)s)'
+    output_field = BooleanField()
+
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def id_prefix_q(term):
+    """
+    Shipment ids starting with `term`, as an index-friendly range on the primary key.
+    """
+    digits = term.lower().replace('-', '')
+    if not _HEX_PREFIX.match(term.lower()) or not digits or len(digits) > 32:
+        return None
+    return Q(id__gte=uuid.UUID(digits.ljust(32, '0')), id__lte=uuid.UUID(digits.ljust(32, 'f')))
+
+
+def sqlite_search_available():
+    # FTS5's trigram tokenizer needs SQLite 3.34+
+    return sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+_sqlite_search_ready = None
+
+
+def _sqlite_search_ready_now():
+    global _sqlite_search_ready
+    if _sqlite_search_ready is None:
+        _sqlite_search_ready = SQLITE_SEARCH_TABLE in connection.introspection.table_names()
+    return _sqlite_search_ready
+
+
+def text_q(term):
+    """
+    Substring match on origin/destination through the search index of the
+    current database, falling back to plain icontains.
+    """
+    if connection.vendor == 'postgresql':
+        pattern = Value(_like_pattern(term))
+        return Q(ILike('origin', pattern)) | Q(ILike('destination', pattern))
+
+    # The trigram tokenizer can't match anything shorter than three characters
+    if connection.vendor == 'sqlite' and len(term) >= 3 and _sqlite_search_ready_now():
+        phrase = '"' + term.replace('"', '""') + '"'
+        return Q(id__in=RawSQL(
+            f"SELECT id FROM api_shipment WHERE rowid IN "
+            f"(SELECT rowid FROM {SQLITE_SEARCH_TABLE} WHERE {SQLITE_SEARCH_TABLE} MATCH %s)",
+            [phrase],
+        ))
+
+    return Q(origin__icontains=term) | Q(destination__icontains=term)
+
+
+class ShipmentSearchFilter(filters.SearchFilter):
+    """
+    ?search= for shipments: trigram-indexed substring search on origin and
+    destination (pg_trgm on PostgreSQL, FTS5 on SQLite) plus exact-prefix
+    matching on the shipment id. Every term must match.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        for term in self.get_search_terms(request):
+            condition = text_q(term)
+            id_q = id_prefix_q(term)
+            if id_q is not None:
+                condition |= id_q
+            queryset = queryset.filter(condition)
+        return queryset
+
+
+# Index setup, run from the migrations and again after every migrate (a SQLite
+# table rebuild drops the triggers that keep the FTS table in sync)
+
+POSTGRES_SEARCH_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS api_shipment_origin_trgm ON api_shipment USING gin (origin gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS api_shipment_destination_trgm ON api_shipment USING gin (destination gin_trgm_ops)",
+]
+
+SQLITE_TRIGGERS = {
+    'api_shipment_search_ai': f"""
+        CREATE TRIGGER IF NOT EXISTS api_shipment_search_ai AFTER INSERT ON api_shipment BEGIN
+            INSERT INTO {SQLITE_SEARCH_TABLE} (rowid, origin, destination)
+            VALUES (new.rowid, new.origin, new.destination);
+        END""",
+    'api_shipment_search_ad': f"""
+        CREATE TRIGGER IF NOT EXISTS api_shipment_search_ad AFTER DELETE ON api_shipment BEGIN
+            DELETE FROM {SQLITE_SEARCH_TABLE} WHERE rowid = old.rowid;
+        END""",
+    'api_shipment_search_au': f"""
+        CREATE TRIGGER IF NOT EXISTS api_shipment_search_au AFTER UPDATE OF origin, destination ON api_shipment BEGIN
+            DELETE FROM {SQLITE_SEARCH_TABLE} WHERE rowid = old.rowid;
+            INSERT INTO {SQLITE_SEARCH_TABLE} (rowid, origin, destination)
+            VALUES (new.rowid, new.origin, new.destination);
+        END""",
+}
+
+
+def install_search_indexes(conn):
+    """
+    Creates (or repairs) the search indexes for `conn`. Safe to run repeatedly.
+    """
+    global _sqlite_search_ready
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            for sql in POSTGRES_SEARCH_SQL:
+                cursor.execute(sql)
+        elif conn.vendor == 'sqlite' and sqlite_search_available():
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_SEARCH_TABLE} "
+                "USING fts5(origin, destination, tokenize='trigram')"
+            )
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+            existing = {row[0] for row in cursor.fetchall()}
+            if not set(SQLITE_TRIGGERS) <= existing:
+                # The FTS rows point at api_shipment rowids. Missing triggers mean
+                # the table was rebuilt (new rowids), so reindex from scratch
+                for sql in SQLITE_TRIGGERS.values():
+                    cursor.execute(sql)
+                cursor.execute(f"DELETE FROM {SQLITE_SEARCH_TABLE}")
+                cursor.execute(
+                    f"INSERT INTO {SQLITE_SEARCH_TABLE} (rowid, origin, destination) "
+                    "SELECT rowid, origin, destination FROM api_shipment"
+                )
+    _sqlite_search_ready = None
+
+
+def repair_search_indexes(using='default', **kwargs):
+    """
+    post_migrate hook: puts the SQLite sync triggers back after a migration
+    rebuilt api_shipment. Does nothing before the search migration has run.
+    """
+    from django.db import connections
+
+    conn = connections[using]
+    if conn.vendor == 'sqlite' and SQLITE_SEARCH_TABLE in conn.introspection.table_names():
+        install_search_indexes(conn)
+
+
+def drop_search_indexes(conn):
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute("DROP INDEX IF EXISTS api_shipment_origin_trgm")
+            cursor.execute("DROP INDEX IF EXISTS api_shipment_destination_trgm")
+        elif conn.vendor == 'sqlite':
+            for name in SQLITE_TRIGGERS:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+            cursor.execute(f"DROP TABLE IF EXISTS {SQLITE_SEARCH_TABLE}")
@@ -1,6 +1,11 @@
+import uuid
+from decimal import Decimal
+from django.conf import settings
 from rest_framework import serializers
+from .distance import DISTANCE_MODES
 from .models import Vehicle, Shipment, Company, Profile
 from django.contrib.auth.models import User
+from .instrumentation import timed
 
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
@@ -17,24 +22,56 @@ class RegisterSerializer(serializers.ModelSerializer):
         )
         return user
 
-class VehicleSerializer(serializers.ModelSerializer):
+class TimedListSerializer(serializers.ListSerializer):
+    # Serialization time shows up in Server-Timing and /metrics
+    @property
+    def data(self):
+        with timed('serialize'):
+            return super().data
+
+class TimedSerializerMixin:
+    @property
+    def data(self):
+        with timed('serialize'):
+            return super().data
+
+class VehicleSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Vehicle
         fields = '__all__'
+        list_serializer_class = TimedListSerializer
+
+class CachedVehicleField(serializers.PrimaryKeyRelatedField):
+    """
+    Looks vehicles up in context['vehicles'] (id -> Vehicle) when it's provided,
+    so validating thousands of rows doesn't cost one query per row.
+    """
+
+    def to_internal_value(self, data):
+        vehicles = self.context.get('vehicles')
+        if vehicles is not None:
+            try:
+                return vehicles[uuid.UUID(str(data))]
+            except (KeyError, ValueError):
+                pass
+        # Unknown or malformed ids get the usual errors from the DB lookup
+        return super().to_internal_value(data)
 
-class ShipmentSerializer(serializers.ModelSerializer):
+class ShipmentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     owner = serializers.ReadOnlyField(source='owner.username')
     # We make these read-only because the backend calculates them
     distance = serializers.ReadOnlyField()
     carbon_footprint = serializers.ReadOnlyField()
-    vehicle = serializers.PrimaryKeyRelatedField(queryset=Vehicle.objects.all())
+    metrics_status = serializers.ReadOnlyField()
+    vehicle = CachedVehicleField(queryset=Vehicle.objects.all())
 
     class Meta:
         model = Shipment
         fields = [
             'id', 'origin', 'destination', 'weight', 
-            'vehicle', 'distance', 'carbon_footprint', 'owner', 'created_at'
+            'vehicle', 'distance', 'carbon_footprint', 'metrics_status', 'owner', 'created_at'
         ]
+        list_serializer_class = TimedListSerializer
 
 
     def validate_weight(self, value):
@@ -51,6 +88,38 @@ class ShipmentSerializer(serializers.ModelSerializer):
             })
         return data
 
+class DistanceMatrixSerializer(serializers.Serializer):
+    """
+    Input of the distance matrix endpoint. CO2 matrices are opt-in: only the
+    vehicles listed in `vehicles` are priced, each adding a full N×N matrix
+    (a 500-place request measured ~0.14s with distances only, ~1.1s and ~19MB
+    with ten vehicles).
+    """
+    locations = serializers.ListField(child=serializers.CharField(max_length=255), min_length=2)
+    weight = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.1'))
+    vehicles = serializers.PrimaryKeyRelatedField(queryset=Vehicle.objects.all(), many=True, default=list)
+    distance_mode = serializers.ChoiceField(choices=DISTANCE_MODES, required=False)
+
+    def validate_locations(self, value):
+        limit = getattr(settings, 'DISTANCE_MATRIX_MAX_LOCATIONS', 1000)
+        if len(value) > limit:
+            raise serializers.ValidationError(f"At most {limit} locations per matrix.")
+        return value
+
+    def validate(self, data):
+        mode = data['distance_mode'] = data.get('distance_mode') or getattr(settings, 'DISTANCE_MATRIX_MODE', 'vincenty')
+        # Exact geodesics are computed pair by pair, far too slowly for big matrices
+        limit = getattr(settings, 'DISTANCE_MATRIX_MAX_GEODESIC_LOCATIONS', 100)
+        if mode == 'geodesic' and len(data['locations']) > limit:
+            raise serializers.ValidationError({
+                "distance_mode": f"The geodesic mode is limited to {limit} locations; use vincenty for bigger matrices."
+            })
+
+        limit = getattr(settings, 'DISTANCE_MATRIX_MAX_VEHICLES', 10)
+        if len(data['vehicles']) > limit:
+            raise serializers.ValidationError({"vehicles": f"At most {limit} vehicles per matrix."})
+        return data
+
 class CompanyRegisterSerializer(serializers.Serializer):
     # Company data
     company_name = serializers.CharField(max_length=255)
@@ -1,18 +1,528 @@
-from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
+import asyncio
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
+
+from .distance import distance_km, get_distance_mode
+from .instrumentation import timed
+
+
+def normalize_place_name(name):
+    """
+    Canonical form of a place name used as the geocoding cache key.
+    "  Nairobi ", "NAIROBI" and "nairobi" all map to "nairobi".
+    """
+    return " ".join(str(name).split()).casefold()
+
+
+class LRUCache:
+    """
+    Small thread-safe LRU with a per-entry time-to-live.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_geocode_lru = None
+_geocode_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'failures': 0}
+_stats_lock = threading.Lock()
+
+
+def _get_geocode_lru():
+    global _geocode_lru
+    if _geocode_lru is None:
+        _geocode_lru = LRUCache(
+            maxsize=getattr(settings, 'GEOCODE_CACHE_SIZE', 10000),
+            ttl=getattr(settings, 'GEOCODE_CACHE_TTL', 86400),
+        )
+    return _geocode_lru
+
+
+def _count(stat):
+    with _stats_lock:
+        _geocode_stats[stat] += 1
+
+
+def geocode_cache_stats():
+    """
+    Snapshot of the geocoding cache counters for this process.
+    """
+    with _stats_lock:
+        stats = dict(_geocode_stats)
+    stats['memory_size'] = len(_get_geocode_lru())
+    return stats
+
+
+def clear_geocode_cache():
+    """
+    Drops the in-process cache and resets the counters (the DB table is kept).
+    """
+    _get_geocode_lru().clear()
+    with _stats_lock:
+        for stat in _geocode_stats:
+            _geocode_stats[stat] = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent lookups of the same key within a process: the first
+    caller (the leader) does the work and every caller asking for that key in
+    the meantime waits for the leader's result instead of repeating it. Works
+    across threads and event loops, since callers share a concurrent Future.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """
+        (future, leader). The leader must settle the future with run() or arun().
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def run(self, key, future, fn, *args):
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        finally:
+            self._forget(key, future)
+
+    async def arun(self, key, future, afn, *args):
+        try:
+            future.set_result(await afn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        finally:
+            self._forget(key, future)
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if not future.done():
+            # The leader was cancelled (e.g. the client went away), release the others
+            future.set_exception(GeocoderUnavailable("Geocoding lookup was abandoned"))
+
+
+_in_flight = SingleFlight()
+_geocode_pool = None
+_geocode_pool_lock = threading.Lock()
+
+
+def _get_geocode_pool():
+    global _geocode_pool
+    with _geocode_pool_lock:
+        if _geocode_pool is None:
+            _geocode_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'GEOCODER_CONCURRENCY', 4), thread_name_prefix='geocode'
+            )
+    return _geocode_pool
+
+
+def _lookup_timeout():
+    # The longest a lookup can take: queued for a rate limit token, then the request itself
+    return getattr(settings, 'GEOCODER_QUEUE_TIMEOUT', 10) + getattr(settings, 'GEOCODER_TIMEOUT', 5)
+
+
+def _store_geocode(key, coords, source):
+    from .models import GeocodeCacheEntry
+
+    GeocodeCacheEntry.objects.update_or_create(
+        name=key,
+        defaults={
+            'latitude': coords[0], 'longitude': coords[1], 'source': source, 'resolved_at': timezone.now(),
+        },
+    )
+
+
+def geocode_many(place_names, max_lookups=None):
+    """
+    Resolves several place names at once. Returns {normalized name: ((latitude,
+    longitude), source)}, with (None, None) for places that can't be found.
+    Cache hits come from the LRU and a single GeocodeCacheEntry query; the misses
+    are sent to the geocoder concurrently (GEOCODER_CONCURRENCY), and a place
+    another thread is already looking up is waited for instead of asked twice.
+    With `max_lookups`, misses past that many are left out of the result.
+    """
+    from .geocoders import get_geocoder
+    from .models import GeocodeCacheEntry
+
+    names = {}
+    for name in place_names:
+        key = normalize_place_name(name)
+        if key:
+            names.setdefault(key, name)
+
+    lru = _get_geocode_lru()
+    results = {}
+    for key in names:
+        cached = lru.get(key)
+        if cached is not None:
+            _count('memory_hits')
+            results[key] = cached
+
+    missing = [key for key in names if key not in results]
+    if missing:
+        rows = GeocodeCacheEntry.objects.filter(name__in=missing).values_list('name', 'latitude', 'longitude', 'source')
+        for key, latitude, longitude, source in rows:
+            _count('db_hits')
+            results[key] = (latitude, longitude), source
+            lru.set(key, results[key])
+
+    missing = [key for key in names if key not in results][:max_lookups]
+    if not missing:
+        return results
+
+    # Only the network calls go to the pool; the DB writes stay on this thread
+    geocoder = get_geocoder()
+    pending = {}
+    for key in missing:
+        future, leader = _in_flight.claim(key)
+        if leader:
+            _count('misses')
+            _get_geocode_pool().submit(_in_flight.run, key, future, geocoder.geocode_with_source, names[key])
+        pending[key] = future, leader
+
+    error = None
+    deadline = time.monotonic() + _lookup_timeout()
+    with timed('geocode'):
+        for key, (future, leader) in pending.items():
+            try:
+                coords, source = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                error = error or GeocoderTimedOut(f"Geocoding {names[key]!r} took over {_lookup_timeout()}s")
+                continue
+            except Exception as exc:
+                error = error or exc
+                continue
+            if coords is None:
+                if leader:
+                    _count('failures')
+                results[key] = None, None
+                continue
+            if leader:
+                _store_geocode(key, coords, source)
+                lru.set(key, (coords, source))
+            results[key] = coords, source
+
+    if error is not None:
+        # What did resolve is cached by now, a retry only repeats the failed ones
+        raise error
+    return results
+
+
+def geocode_with_source(place_name):
+    """
+    Resolves a place name to ((latitude, longitude), source), or (None, None) if
+    it can't be found. `source` names the geocoder backend that answered.
+    Looks in the in-process LRU first, then the GeocodeCacheEntry table, and only
+    asks the configured geocoder (see GEOCODER_BACKENDS) when neither knows the place.
+    """
+    key = normalize_place_name(place_name)
+    if not key:
+        return None, None
+    return geocode_many([place_name])[key]
+
+
+def geocode(place_name):
+    """
+    Resolves a place name to (latitude, longitude), or None if it can't be found.
+    """
+    return geocode_with_source(place_name)[0]
+
+
+async def ageocode_with_source(place_name):
+    """
+    Async geocode_with_source() for the ASGI views: same cache layers, read with
+    the async ORM. Backends with an ageocode() coroutine are awaited; the others
+    (Nominatim included: geopy's async adapter needs aiohttp) still hold a worker
+    thread for the lookup. Lookups already in flight, from either side, are
+    joined rather than repeated.
+    """
+    from .geocoders import get_geocoder
+    from .models import GeocodeCacheEntry
+
+    key = normalize_place_name(place_name)
+    if not key:
+        return None, None
+
+    lru = _get_geocode_lru()
+    cached = lru.get(key)
+    if cached is not None:
+        _count('memory_hits')
+        return cached
+
+    row = await GeocodeCacheEntry.objects.filter(name=key).values_list('latitude', 'longitude', 'source').afirst()
+    if row is not None:
+        _count('db_hits')
+        cached = (row[0], row[1]), row[2]
+        lru.set(key, cached)
+        return cached
+
+    future, leader = _in_flight.claim(key)
+    with timed('geocode'):
+        if leader:
+            _count('misses')
+            await _in_flight.arun(key, future, get_geocoder().ageocode_with_source, place_name)
+        try:
+            # shield(): a follower timing out must not cancel the shared lookup
+            coords, source = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), _lookup_timeout())
+        except asyncio.TimeoutError:
+            raise GeocoderTimedOut(f"Geocoding {place_name!r} took over {_lookup_timeout()}s")
+    if not leader:
+        return coords, source
+    if coords is None:
+        _count('failures')
+        return None, None
+
+    await GeocodeCacheEntry.objects.aupdate_or_create(
+        name=key,
+        defaults={
+            'latitude': coords[0], 'longitude': coords[1], 'source': source, 'resolved_at': timezone.now(),
+        },
+    )
+    lru.set(key, (coords, source))
+    return coords, source
+
+
+def route_key(origin_id, destination_id):
+    """
+    Order-independent key for the lane between two Locations (by id):
+    Nairobi->Mombasa and Mombasa->Nairobi share the same cached distance.
+    """
+    return (origin_id, destination_id) if origin_id <= destination_id else (destination_id, origin_id)
+
+
+# Hottest lanes, loaded into memory at worker startup by pin_hot_routes():
+# (origin_id, destination_id, mode) -> km
+_pinned_routes = {}
+# Route hits not yet written to RouteDistance.hit_count
+_route_hits = Counter()
+_route_hits_lock = threading.Lock()
+_route_hits_flushed_at = time.monotonic()
+
+
+def record_route_hits(hits):
+    """
+    Counts uses of cached lanes. `hits` maps (origin_id, destination_id, mode)
+    to a number of uses; they're buffered and written in batches.
+    """
+    global _route_hits_flushed_at
+    with _route_hits_lock:
+        _route_hits.update(hits)
+        due = (
+            sum(_route_hits.values()) >= getattr(settings, 'ROUTE_STATS_FLUSH_EVERY', 100)
+            or time.monotonic() - _route_hits_flushed_at > 30
+        )
+    if due:
+        flush_route_stats()
+
+
+def flush_route_stats():
+    """
+    Writes the buffered per-lane hit counts to the RouteDistance table.
+    """
+    global _route_hits_flushed_at
+    from .models import RouteDistance
+
+    with _route_hits_lock:
+        pending = dict(_route_hits)
+        _route_hits.clear()
+        _route_hits_flushed_at = time.monotonic()
+
+    now = timezone.now()
+    for (origin, destination, mode), hits in pending.items():
+        RouteDistance.objects.filter(origin_id=origin, destination_id=destination, mode=mode).update(
+            hit_count=F('hit_count') + hits, last_used_at=now
+        )
+
+
+def pin_hot_routes(limit=500):
+    """
+    Loads the `limit` most used lanes into memory so they skip the DB lookup.
+    """
+    from .models import RouteDistance
+
+    rows = RouteDistance.objects.order_by('-hit_count').values_list(
+        'origin_id', 'destination_id', 'mode', 'distance_km'
+    )[:limit]
+    _pinned_routes.clear()
+    _pinned_routes.update({(origin, destination, mode): km for origin, destination, mode, km in rows})
+    return len(_pinned_routes)
+
+
+def get_route_distances(keys, mode=None):
+    """
+    Cached distances of lanes, route_key() pairs, in distance `mode`: {key: km}
+    for the lanes already computed. Pinned lanes first, one query for the rest.
+    """
+    from .models import RouteDistance
+
+    mode = get_distance_mode(mode)
+    found, missing = {}, set()
+    for key in keys:
+        km = _pinned_routes.get((*key, mode))
+        if km is None:
+            missing.add(key)
+        else:
+            found[key] = km
+    if missing:
+        rows = RouteDistance.objects.filter(
+            origin_id__in={origin for origin, _ in missing},
+            destination_id__in={destination for _, destination in missing},
+            mode=mode,
+        ).values_list('origin_id', 'destination_id', 'distance_km')
+        found.update({
+            (origin, destination): km for origin, destination, km in rows if (origin, destination) in missing
+        })
+    return found
+
+
+def store_route_distances(distances, mode=None):
+    """
+    Adds newly computed lanes, {route_key(): km}, to the cache.
+    """
+    from .models import RouteDistance
+
+    mode = get_distance_mode(mode)
+    # ignore_conflicts: another worker may have priced the same lane meanwhile
+    RouteDistance.objects.bulk_create(
+        [
+            RouteDistance(origin_id=origin, destination_id=destination, mode=mode, distance_km=km)
+            for (origin, destination), km in distances.items()
+        ],
+        ignore_conflicts=True,
+    )
+
 
 def calculate_distance(origin_name, dest_name):
     """
     Takes two city names and returns distance in kilometers.
     """
-    geolocator = Nominatim(user_agent="green_path_logistics")
-    
-    # Get coordinates for origin
-    loc1 = geolocator.geocode(origin_name)
-    # Get coordinates for destination
-    loc2 = geolocator.geocode(dest_name)
-    
+    from .models import Location
+
+    places = Location.objects.resolve_many([origin_name, dest_name])
+    origin, destination = places[normalize_place_name(origin_name)], places[normalize_place_name(dest_name)]
+    mode = get_distance_mode()
+    key = route_key(origin.id, destination.id)
+    # Recurring lanes are answered straight from the route cache
+    km = get_route_distances([key], mode).get(key)
+    if km is None:
+        # Both ends are geocoded concurrently
+        km = location_distance(origin, destination, mode)
+        if km is None:
+            return None
+        store_route_distances({key: km}, mode)
+    record_route_hits({(*key, mode): 1})
+    return km
+
+
+def locate_many(locations):
+    """
+    Fills in the coordinates of the given Locations that don't have any yet,
+    geocoding them together (see geocode_many()) and storing them on the rows.
+    Places that can't be found are left without coordinates.
+    """
+    missing = [location for location in locations if location.coordinates is None]
+    if not missing:
+        return locations
+    found = geocode_many([location.name for location in missing])
+    for location in missing:
+        coords, source = found.get(normalize_place_name(location.name), (None, None))
+        if coords is None:
+            continue
+        location.latitude, location.longitude = coords
+        location.geocoded_by = source
+        location.geocoded_at = timezone.now()
+        location.save(update_fields=['latitude', 'longitude', 'geocoded_by', 'geocoded_at'])
+    return locations
+
+
+def locate(location):
+    """
+    Coordinates of a Location, geocoded and stored on the row the first time
+    they're needed. Returns None if the place can't be found.
+    """
+    locate_many([location])
+    return location.coordinates
+
+
+async def alocate(location):
+    """
+    Async locate().
+    """
+    if location.coordinates is None:
+        coords, source = await ageocode_with_source(location.name)
+        if coords is None:
+            return None
+        location.latitude, location.longitude = coords
+        location.geocoded_by = source
+        location.geocoded_at = timezone.now()
+        await location.asave(update_fields=['latitude', 'longitude', 'geocoded_by', 'geocoded_at'])
+    return location.coordinates
+
+
+def location_distance(origin, destination, mode=None):
+    """
+    Distance in kilometers between two Locations, straight from their stored
+    coordinates. None if either place can't be geocoded. `mode` is one of
+    api.distance.DISTANCE_MODES (default: the DISTANCE_MODE setting).
+    """
+    locate_many([origin, destination])
+    loc1, loc2 = origin.coordinates, destination.coordinates
+    if loc1 and loc2:
+        return distance_km(loc1, loc2, mode)
+    return None
+
+
+async def alocation_distance(origin, destination, mode=None):
+    """
+    Async location_distance().
+    """
+    loc1, loc2 = await asyncio.gather(alocate(origin), alocate(destination))
     if loc1 and loc2:
-        # Returns distance in km
-        return geodesic((loc1.latitude, loc1.longitude), (loc2.latitude, loc2.longitude)).km
-    return None
\ No newline at end of file
+        return distance_km(loc1, loc2, mode)
+    return None
@@ -1,29 +1,186 @@
+import logging
+import time
+from collections import Counter
+
+import numpy as np
 from celery import shared_task
-from .services import calculate_distance 
+from celery.signals import worker_process_init
+from django.conf import settings
+from geopy.exc import GeocoderServiceError
+
+from . import rollups
+from .distance import distances_km, get_distance_mode
+from .retries import schedule_lane_retries
+from .services import (
+    get_route_distances, locate_many, pin_hot_routes, record_route_hits, route_key, store_route_distances,
+)
+
+logger = logging.getLogger(__name__)
+
+@worker_process_init.connect
+def pin_hot_routes_on_startup(**kwargs):
+    # Keep the busiest lanes in memory for the lifetime of the worker
+    pin_hot_routes(getattr(settings, 'ROUTE_CACHE_PINNED_LANES', 500))
 
 @shared_task
 def compute_shipment_metrics_task(shipment_id):
     from .models import Shipment
     try:
-        shipment = Shipment.objects.select_related('vehicle').get(id=shipment_id)
-        
-        # Handle Distance if missing
-        if not shipment.distance:
-            calculated = calculate_distance(shipment.origin, shipment.destination)
-            shipment.distance = calculated if calculated else 0
-        
-        # 2. Perform Carbon Calculation
-        # We convert to float/Decimal safely
-        dist = float(shipment.distance)
-        wgt = float(shipment.weight)
-        factor = float(shipment.vehicle.emission_factor)
-        
-        shipment.carbon_footprint = dist * wgt * factor
-        
-        # 3. Save only the calculated fields
-        shipment.save(update_fields=['distance', 'carbon_footprint'])
-        
-        return f"Shipment {shipment_id} processed successfully."
-    
+        shipment = Shipment.objects.select_related('vehicle', 'origin_location', 'destination_location').get(id=shipment_id)
     except Shipment.DoesNotExist:
-        return f"Shipment {shipment_id} not found."
\ No newline at end of file
+        return f"Shipment {shipment_id} not found."
+
+    # Same path as the batches, so a lane that can't be geocoded is queued for retry
+    compute_metrics_for_shipments([shipment])
+    if shipment.metrics_status != 'ok':
+        return f"Shipment {shipment_id} is waiting for geocoding ({shipment.metrics_status})."
+    return f"Shipment {shipment_id} processed successfully."
+
+
+@shared_task
+def compute_shipment_metrics_batch_task(shipment_ids):
+    """
+    compute_shipment_metrics_task for many shipments at once: one query loads
+    them, each distinct lane is resolved once and the rows are written with a
+    single bulk_update. Sent by api.dispatch when jobs arrive in bursts. Logs
+    and returns the batch's timings.
+    """
+    from .models import Shipment
+
+    started = time.perf_counter()
+    shipments = list(
+        Shipment.objects.select_related('vehicle', 'origin_location', 'destination_location').filter(id__in=shipment_ids)
+    )
+    stats = {'requested': len(shipment_ids), 'shipments': len(shipments), 'lanes': 0}
+    stats['load_s'] = round(time.perf_counter() - started, 4)
+    if shipments:
+        compute_metrics_for_shipments(shipments, stats=stats)
+    stats['total_s'] = round(time.perf_counter() - started, 4)
+    logger.info(
+        "Metrics batch: %(shipments)d/%(requested)d shipments, %(lanes)d lanes in %(total_s).3fs", stats,
+        extra={'batch_stats': stats},
+    )
+    return stats
+
+
+@shared_task
+def recompute_vehicle_footprints_task(vehicle_id):
+    from .models import Vehicle
+    from .recompute import recompute_vehicle_footprints
+    try:
+        vehicle = Vehicle.objects.get(id=vehicle_id)
+    except Vehicle.DoesNotExist:
+        return f"Vehicle {vehicle_id} not found."
+
+    count = recompute_vehicle_footprints(vehicle)
+    return f"Recomputed {count} shipments for {vehicle.name}."
+
+
+@shared_task
+def retry_geocoding_task():
+    """
+    Retries the lanes whose places failed to geocode and are due (see
+    api.retries). Run periodically by Celery beat, GEOCODE_RETRY_INTERVAL.
+    """
+    from .retries import retry_due_lanes
+    return retry_due_lanes()
+
+
+def compute_metrics_for_shipments(shipments, batch_size=1000, distance_mode=None, stats=None, geocode_error=None):
+    """
+    Batch version of compute_shipment_metrics_task for shipments already in memory
+    (with their vehicle and locations loaded). Lanes come from the route cache
+    (see api.services.route_key); the ones it doesn't have yet are computed
+    once, both directions together, in a single array operation (see
+    api.distance) and added to it. All rows are written back with a single
+    bulk_update. Shipments on a lane that
+    can't be geocoded are left 'pending' and the lane is queued for retry (see
+    api.retries). Lane counts and time spent per phase are added to the `stats`
+    dict when one is passed. Callers that geocoded the places already pass
+    `geocode_error` ('' if the geocoder was fine) and nothing is looked up again.
+    """
+    from .models import Shipment
+
+    stats = {} if stats is None else stats
+    started = time.perf_counter()
+    lanes = {}
+    for shipment in shipments:
+        if not shipment.distance:
+            key = (shipment.origin_location_id, shipment.destination_location_id)
+            lanes.setdefault(key, (shipment.origin_location, shipment.destination_location))
+
+    # Every place still missing coordinates is geocoded up front, concurrently
+    places = {}
+    for origin, destination in lanes.values():
+        places.setdefault(origin.id, origin)
+        places.setdefault(destination.id, destination)
+    error = geocode_error or ''
+    if geocode_error is None:
+        try:
+            locate_many(list(places.values()))
+        except GeocoderServiceError as exc:
+            # Geocoder down or throttling: the lanes still without coordinates are retried later
+            error = str(exc)
+    geocoded = time.perf_counter()
+
+    # Both directions of a lane are the same distance: looked up or computed once per pair
+    mode = get_distance_mode(distance_mode)
+    pairs = sorted({
+        route_key(*key) for key in lanes if places[key[0]].coordinates and places[key[1]].coordinates
+    })
+    km = get_route_distances(pairs, mode) if pairs else {}
+    new = [pair for pair in pairs if pair not in km]
+    if new:
+        origins = np.array([places[origin].coordinates for origin, _ in new], dtype=np.float64)
+        destinations = np.array([places[destination].coordinates for _, destination in new], dtype=np.float64)
+        computed = dict(zip(new, distances_km(
+            origins[:, 0], origins[:, 1], destinations[:, 0], destinations[:, 1], mode
+        ).tolist()))
+        store_route_distances(computed, mode)
+        km.update(computed)
+    distances = {key: km[route_key(*key)] for key in lanes if route_key(*key) in km}
+
+    # Lanes with a place that can't be geocoded wait for a retry instead of
+    # being priced at 0 km; their shipments stay without metrics until then
+    unresolved = set(lanes) - set(distances)
+    dead = schedule_lane_retries(unresolved, error or "Place not found") if unresolved else set()
+
+    hits = Counter()
+    for shipment in shipments:
+        lane = (shipment.origin_location_id, shipment.destination_location_id)
+        if not shipment.distance:
+            shipment.distance = distances.get(lane)
+            if shipment.distance is not None:
+                hits[(*route_key(*lane), mode)] += 1
+        if shipment.distance is None:
+            shipment.carbon_footprint = None
+            shipment.metrics_status = 'failed' if lane in dead else 'pending'
+            continue
+        shipment.carbon_footprint = (
+            float(shipment.distance) * float(shipment.weight) * float(shipment.vehicle.emission_factor)
+        )
+        shipment.metrics_status = 'ok'
+
+    computed = time.perf_counter()
+
+    Shipment.objects.bulk_update(shipments, ['distance', 'carbon_footprint', 'metrics_status'], batch_size=batch_size)
+
+    # bulk_update skips save(), so move the rollup contributions here in one go
+    deltas = rollups.new_deltas()
+    for shipment in shipments:
+        rollups.add_delta(deltas, getattr(shipment, '_rollup_contribution', None), -1)
+        shipment._rollup_contribution = rollups.shipment_contribution(shipment)
+        rollups.add_delta(deltas, shipment._rollup_contribution)
+    rollups.apply_rollup_deltas(deltas)
+    record_route_hits(hits)
+
+    stats.update(
+        lanes=len(lanes),
+        pairs=len(pairs),
+        cached_pairs=len(pairs) - len(new),
+        unresolved=len(unresolved),
+        geocode_s=round(geocoded - started, 4),
+        distance_s=round(computed - geocoded, 4),
+        write_s=round(time.perf_counter() - computed, 4),
+    )
+    return shipments
@@ -1,3 +1,2082 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from io import StringIO
 
-# Create your tests here.
+import brotli
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.urls import include, path
+from geopy.exc import GeocoderRateLimited, GeocoderUnavailable
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import benchmark, distance, geocoders, instrumentation, search, services
+from .dataset import build_shipments, create_reference_data, zipf_weights
+from .dispatch import Batcher, LocalWorker, enqueue
+from .matrix import distance_matrix
+from .async_views import AsyncShipmentDetail, AsyncShipmentList
+from .models import (
+    Company, EmissionRollup, GeocodeCacheEntry, LaneRetry, Location, Profile, RouteDistance, Shipment, Vehicle,
+)
+from .recompute import recompute_vehicle_footprints
+from .query_budget import QueryBudgetExceeded, assert_max_queries, explain, full_scans, sorts
+from .retries import requeue_lanes, retry_delay, retry_due_lanes
+from .renderers import FastJSONRenderer
+from .rollups import rebuild_emission_rollups
+from .rows import SHIPMENT_COLUMNS, shipment_records, shipment_values
+from .serializers import ShipmentSerializer
+from .tasks import compute_shipment_metrics_batch_task
+
+
+class QueryBudgetHelperTests(TestCase):
+    def test_passes_within_budget(self):
+        with assert_max_queries(1):
+            list(Vehicle.objects.all())
+
+    def test_fails_over_budget(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with assert_max_queries(1):
+                list(Vehicle.objects.all())
+                list(Company.objects.all())
+
+    def test_decorator(self):
+        @assert_max_queries(0)
+        def runs_a_query():
+            list(Vehicle.objects.all())
+
+        with self.assertRaises(QueryBudgetExceeded):
+            runs_a_query()
+
+
+class ApiTestCase(TestCase):
+    """
+    A company with a manager and a driver, a vehicle and two geocoded places;
+    the client is logged in as the manager.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name="Acme")
+        cls.vehicle = Vehicle.objects.create(name="Truck", emission_factor=Decimal('0.1000'))
+        cls.manager = cls.make_user('manager', 'manager')
+        cls.driver = cls.make_user('driver', 'driver')
+        # Coordinates already known, so nothing is geocoded over the network
+        for name, lat, lon in (('Nairobi', -1.28333, 36.81667), ('Mombasa', -4.05466, 39.66359)):
+            location = Location.objects.resolve(name)
+            location.latitude, location.longitude = lat, lon
+            location.save()
+
+    @classmethod
+    def make_user(cls, username, role):
+        user = User.objects.create_user(username=username, password='pass12345', email=f'{username}@example.com')
+        user.profile.company = cls.company
+        user.profile.role = role
+        user.profile.save()
+        return user
+
+    def setUp(self):
+        cache.clear()
+        # Route hits left over by earlier tests would be flushed mid-budget
+        services.flush_route_stats()
+        self.client = APIClient()
+        self.login(self.manager)
+
+    def login(self, user):
+        tokens = self.client.post(
+            '/api/login/', {'username': user.username, 'password': 'pass12345'}, format='json'
+        ).json()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        # Warm the profile-version cache so every request below costs the same
+        self.client.get('/api/profile/')
+
+    def add_shipments(self, count, owner=None):
+        shipments = [
+            Shipment(
+                company=self.company, owner=owner or self.driver, vehicle=self.vehicle,
+                origin='Nairobi', destination='Mombasa', weight=Decimal('2.00'),
+                distance=Decimal('440.58'), carbon_footprint=Decimal('88.116'), metrics_status='ok',
+                origin_location=Location.objects.resolve('Nairobi'),
+                destination_location=Location.objects.resolve('Mombasa'),
+            )
+            for _ in range(count)
+        ]
+        Shipment.objects.bulk_create(shipments)
+        return shipments
+
+
+class QueryBudgetTestCase(ApiTestCase):
+    """
+    Every endpoint is called with a few rows and again with many more: the
+    query count must stay within the same budget, so an N+1 fails here.
+    """
+
+    def assertConstantQueries(self, budget, request, grow=None, sizes=(3, 30)):
+        """
+        Runs `request()` after growing the data to each of `sizes` rows
+        (`grow(n)` adds n rows, shipments by default).
+        """
+        grow = grow or self.add_shipments
+        total = 0
+        for size in sizes:
+            grow(size - total)
+            total = size
+            with assert_max_queries(budget):
+                response = request()
+                # Streaming responses run their queries while being read
+                if getattr(response, 'streaming', False):
+                    b''.join(response.streaming_content)
+            self.assertLess(response.status_code, 400, getattr(response, 'data', None))
+
+
+class ApiQueryBudgetTests(QueryBudgetTestCase):
+    def test_shipment_list(self):
+        # COUNT + page
+        self.assertConstantQueries(2, lambda: self.client.get('/api/shipments/'))
+
+    def test_shipment_list_cursor(self):
+        self.assertConstantQueries(1, lambda: self.client.get('/api/shipments/?pagination=cursor'))
+
+    def test_shipment_list_as_driver(self):
+        self.login(self.driver)
+        # The first search checks (once per process) whether the FTS table exists
+        self.client.get('/api/shipments/?search=nairobi')
+        self.assertConstantQueries(2, lambda: self.client.get('/api/shipments/?search=nairobi'))
+
+    def test_shipment_create(self):
+        payload = {'origin': 'Nairobi', 'destination': 'Mombasa', 'weight': '3', 'vehicle': str(self.vehicle.id)}
+        # location lookups, insert, owner for the response
+        self.assertConstantQueries(5, lambda: self.client.post('/api/shipments/', payload, format='json'))
+
+    def test_shipment_detail(self):
+        shipment = self.add_shipments(1, owner=self.manager)[0]
+        url = f'/api/shipments/{shipment.id}/'
+        self.assertConstantQueries(1, lambda: self.client.get(url))
+        payload = {'origin': 'Nairobi', 'destination': 'Mombasa', 'weight': '4', 'vehicle': str(self.vehicle.id)}
+        self.assertConstantQueries(7, lambda: self.client.put(url, payload, format='json'))
+
+    def test_shipment_export(self):
+        self.assertConstantQueries(1, lambda: self.client.get('/api/shipments/export/csv/'))
+
+    def test_shipment_bulk_create(self):
+        body = '\n'.join(
+            f'{{"origin": "Nairobi", "destination": "Mombasa", "weight": "1", "vehicle": "{self.vehicle.id}"}}'
+            for _ in range(20)
+        )
+        # Two of them are the route cache: the lookup, and storing a lane on its first use
+        self.assertConstantQueries(
+            12, lambda: self.client.post('/api/shipments/bulk/', body, content_type='application/x-ndjson')
+        )
+
+    def test_emission_analytics(self):
+        def grow(count):
+            self.add_shipments(count)
+            rebuild_emission_rollups()
+
+        url = '/api/analytics/emissions/?bucket=day&group_by=vehicle,lane'
+        self.assertConstantQueries(1, lambda: self.client.get(url), grow=grow)
+
+    def test_vehicle_list(self):
+        self.assertConstantQueries(2, lambda: self.client.get('/api/vehicles/'))
+
+    def test_profile(self):
+        # email isn't in the token claims: one user lookup
+        self.assertConstantQueries(1, lambda: self.client.get('/api/profile/'))
+
+
+# The project URLs with the async shipment views, as served with ASYNC_VIEWS
+urlpatterns = [
+    path('api/shipments/', AsyncShipmentList.as_view(), name='shipment-list'),
+    path('api/shipments/<uuid:pk>/', AsyncShipmentDetail.as_view(), name='shipment-detail'),
+    path('', include('green_path.urls')),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncApiQueryBudgetTests(QueryBudgetTestCase):
+    def test_shipment_list(self):
+        self.assertConstantQueries(2, lambda: self.client.get('/api/shipments/'))
+
+    def test_shipment_list_cursor(self):
+        self.assertConstantQueries(1, lambda: self.client.get('/api/shipments/?pagination=cursor'))
+
+    def test_shipment_create(self):
+        payload = {'origin': 'Nairobi', 'destination': 'Mombasa', 'weight': '3', 'vehicle': str(self.vehicle.id)}
+        # As the sync view, plus the rollup update: the footprint is computed inline
+        self.assertConstantQueries(8, lambda: self.client.post('/api/shipments/', payload, format='json'))
+
+    def test_shipment_create_returns_footprint(self):
+        payload = {'origin': 'Nairobi', 'destination': 'Mombasa', 'weight': '3', 'vehicle': str(self.vehicle.id)}
+        response = self.client.post('/api/shipments/', payload, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        shipment = Shipment.objects.get(pk=response.data['id'])
+        self.assertEqual(response.data['distance'], shipment.distance)
+        self.assertEqual(response.data['carbon_footprint'], shipment.carbon_footprint)
+        self.assertAlmostEqual(float(shipment.carbon_footprint), float(shipment.distance) * 3 * 0.1, delta=0.01)
+
+    def test_shipment_detail(self):
+        shipment = self.add_shipments(1, owner=self.manager)[0]
+        url = f'/api/shipments/{shipment.id}/'
+        self.assertConstantQueries(1, lambda: self.client.get(url))
+        payload = {'origin': 'Nairobi', 'destination': 'Mombasa', 'weight': '4', 'vehicle': str(self.vehicle.id)}
+        self.assertConstantQueries(7, lambda: self.client.put(url, payload, format='json'))
+        # add_shipments bypasses the rollups, which the delete takes the shipment out of
+        rebuild_emission_rollups()
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+@override_settings(EXPORT_CHUNK_SIZE=10)
+class AsgiStreamingTests(ApiTestCase):
+    """
+    Under ASGI the streamed endpoints must hand Django an async iterator: a
+    sync one is read to the end before the first byte goes out.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.add_shipments(25)
+        self.headers = {'Authorization': self.client._credentials['HTTP_AUTHORIZATION']}
+
+    async def read(self, response):
+        self.assertTrue(response.streaming)
+        self.assertTrue(response.is_async)
+        return [chunk async for chunk in response.streaming_content]
+
+    async def test_export(self):
+        response = await self.async_client.get('/api/shipments/export/csv/', headers=self.headers)
+        chunks = await self.read(response)
+        # Header + 25 rows, 10 rows a chunk
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(b''.join(chunks).count(b'\n'), 26)
+
+    async def test_export_compressed(self):
+        headers = {**self.headers, 'Accept-Encoding': 'br'}
+        response = await self.async_client.get('/api/shipments/export/ndjson/', headers=headers)
+        self.assertEqual(response['Content-Encoding'], 'br')
+        body = brotli.decompress(b''.join(await self.read(response)))
+        self.assertEqual(body.count(b'\n'), 25)
+
+    async def test_bulk_create(self):
+        body = '\n'.join(
+            f'{{"origin": "Nairobi", "destination": "Mombasa", "weight": "1", "vehicle": "{self.vehicle.id}"}}'
+            for _ in range(3)
+        )
+        response = await self.async_client.post(
+            '/api/shipments/bulk/', body, content_type='application/x-ndjson', headers=self.headers
+        )
+        lines = [json.loads(line) for line in b''.join(await self.read(response)).splitlines()]
+        self.assertEqual([line['status'] for line in lines[:-1]], ['created'] * 3)
+        self.assertEqual(lines[-1], {'summary': {'created': 3, 'invalid': 0}})
+
+    async def test_distance_matrix(self):
+        payload = {'locations': ['Nairobi', 'Mombasa'], 'weight': '1', 'vehicles': [str(self.vehicle.id)]}
+        response = await self.async_client.post(
+            '/api/distance-matrix/', payload, content_type='application/json', headers=self.headers
+        )
+        body = json.loads(b''.join(await self.read(response)))
+        self.assertAlmostEqual(body['distances'][0][1], 440.58, delta=1)
+
+
+class AdminQueryBudgetTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pass12345')
+        self.client.force_login(self.admin)
+        self.companies = 0
+
+    def add_companies(self, count):
+        for _ in range(count):
+            self.companies += 1
+            company = Company.objects.create(name=f"Company {self.companies}")
+            user = User.objects.create_user(username=f'employee{self.companies}')
+            user.profile.company = company
+            user.profile.save()
+
+    def add_locations(self, count):
+        Location.objects.resolve_many(f"Town {Location.objects.count() + i}" for i in range(count))
+
+    def add_lane_retries(self, count):
+        nairobi = Location.objects.resolve('Nairobi')
+        places = Location.objects.resolve_many(f"Village {LaneRetry.objects.count() + i}" for i in range(count))
+        LaneRetry.objects.bulk_create([LaneRetry(origin=nairobi, destination=place) for place in places.values()])
+
+    def assertAdminChangelist(self, url, budget, grow=None):
+        self.assertConstantQueries(budget, lambda: self.client.get(url), grow=grow)
+
+    def test_shipment_changelist(self):
+        self.assertAdminChangelist('/admin/api/shipment/', 6)
+
+    def test_company_changelist(self):
+        self.assertAdminChangelist('/admin/api/company/', 5, grow=self.add_companies)
+
+    def test_profile_changelist(self):
+        self.assertAdminChangelist('/admin/api/profile/', 8, grow=self.add_companies)
+
+    def test_location_changelist(self):
+        self.assertAdminChangelist('/admin/api/location/', 6, grow=self.add_locations)
+
+    def test_vehicle_changelist(self):
+        self.assertAdminChangelist('/admin/api/vehicle/', 5)
+
+    def test_lane_retry_changelist(self):
+        self.assertAdminChangelist('/admin/api/laneretry/', 5, grow=self.add_lane_retries)
+
+
+class KnownPlacesGeocoder:
+    name = 'known'
+    places = {'Nairobi': (-1.28333, 36.81667), 'Mombasa': (-4.05466, 39.66359)}
+
+    def __init__(self):
+        self.calls = []
+
+    def geocode(self, place_name):
+        self.calls.append(place_name)
+        return self.places.get(place_name.strip().title())
+
+
+class GeocodeCacheTests(TestCase):
+    def setUp(self):
+        self.backend = KnownPlacesGeocoder()
+        self.previous = geocoders._geocoder
+        geocoders._geocoder = geocoders.ChainGeocoder([self.backend])
+        services.clear_geocode_cache()
+
+    def tearDown(self):
+        geocoders._geocoder = self.previous
+        services.clear_geocode_cache()
+
+    def test_lookups_are_cached_in_memory_and_in_the_table(self):
+        self.assertEqual(services.geocode_with_source('Nairobi'), ((-1.28333, 36.81667), 'known'))
+        # Other spellings of the same place are the same cache entry
+        self.assertEqual(services.geocode('  NAIROBI '), (-1.28333, 36.81667))
+        self.assertEqual(self.backend.calls, ['Nairobi'])
+        entry = GeocodeCacheEntry.objects.get()
+        self.assertEqual((entry.name, entry.latitude, entry.source), ('nairobi', -1.28333, 'known'))
+
+        # A new process (empty LRU) reads the table instead of the geocoder
+        services.clear_geocode_cache()
+        self.assertEqual(services.geocode('nairobi'), (-1.28333, 36.81667))
+        self.assertEqual(services.geocode('Nairobi'), (-1.28333, 36.81667))
+        self.assertEqual(self.backend.calls, ['Nairobi'])
+        stats = services.geocode_cache_stats()
+        self.assertEqual((stats['db_hits'], stats['memory_hits'], stats['misses'], stats['memory_size']), (1, 1, 0, 1))
+
+    def test_unknown_places_are_not_cached(self):
+        self.assertIsNone(services.geocode('Atlantis'))
+        self.assertIsNone(services.geocode('Atlantis'))
+        self.assertEqual(self.backend.calls, ['Atlantis', 'Atlantis'])
+        self.assertFalse(GeocodeCacheEntry.objects.exists())
+        self.assertEqual(services.geocode_cache_stats()['failures'], 2)
+        self.assertEqual(services.geocode_with_source('   '), (None, None))
+
+    def test_calculate_distance(self):
+        self.assertAlmostEqual(services.calculate_distance('Nairobi', 'mombasa'), 440.58, delta=0.5)
+        self.assertAlmostEqual(services.calculate_distance('MOMBASA', 'nairobi'), 440.58, delta=0.5)
+        self.assertEqual(sorted(self.backend.calls), ['Nairobi', 'mombasa'])
+        self.assertIsNone(services.calculate_distance('Nairobi', 'Atlantis'))
+
+    def test_lru(self):
+        lru = services.LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        # 'b' was the least recently used
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+        expired = services.LRUCache(maxsize=2, ttl=-1)
+        expired.set('a', 1)
+        self.assertIsNone(expired.get('a'))
+        self.assertEqual(len(expired), 0)
+
+    def test_warm_command_stores_coordinates_on_locations(self):
+        for name in ('Nairobi', 'Atlantis'):
+            Location.objects.resolve(name)
+        out, err = StringIO(), StringIO()
+        call_command('warm_geocode_cache', stdout=out, stderr=err)
+        self.assertEqual(Location.objects.get(name='Nairobi').coordinates, (-1.28333, 36.81667))
+        self.assertIsNone(Location.objects.get(name='Atlantis').coordinates)
+        self.assertIn("Resolved 1 locations, 0 failed", out.getvalue())
+        self.assertIn("Could not geocode 'Atlantis'", err.getvalue())
+
+    def test_warm_command_reports_geocoder_errors_and_goes_on(self):
+        class FlakyGeocoder(KnownPlacesGeocoder):
+            def geocode(self, place_name):
+                if place_name == 'Mombasa':
+                    raise GeocoderUnavailable("Nominatim is down")
+                return super().geocode(place_name)
+
+        geocoders._geocoder = geocoders.ChainGeocoder([FlakyGeocoder()])
+        for name in ('Mombasa', 'Nairobi'):
+            Location.objects.resolve(name)
+        out, err = StringIO(), StringIO()
+        call_command('warm_geocode_cache', stdout=out, stderr=err)
+        self.assertIsNone(Location.objects.get(name='Mombasa').coordinates)
+        self.assertEqual(Location.objects.get(name='Nairobi').coordinates, (-1.28333, 36.81667))
+        self.assertIn("Geocoding 'Mombasa' failed: Nominatim is down", err.getvalue())
+        self.assertIn("Resolved 1 locations, 1 failed", out.getvalue())
+
+
+class SlowGeocoder:
+    name = 'slow'
+
+    def __init__(self):
+        self.calls = []
+
+    def geocode(self, place_name):
+        self.calls.append(place_name)
+        time.sleep(0.2)
+        return (1.0, 2.0)
+
+
+class GeocodingClientTests(TestCase):
+    def setUp(self):
+        self.backend = SlowGeocoder()
+        self.previous = geocoders._geocoder
+        geocoders._geocoder = geocoders.ChainGeocoder([self.backend])
+        services.clear_geocode_cache()
+
+    def tearDown(self):
+        geocoders._geocoder = self.previous
+        services.clear_geocode_cache()
+
+    def test_misses_are_geocoded_concurrently(self):
+        started = time.monotonic()
+        found = services.geocode_many(['Lamu', 'Kisumu', 'Nakuru', 'lamu'])
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(sorted(self.backend.calls), ['Kisumu', 'Lamu', 'Nakuru'])
+        self.assertEqual(found['kisumu'], ((1.0, 2.0), 'slow'))
+        # Cached afterwards
+        self.assertEqual(services.geocode('Nakuru'), (1.0, 2.0))
+        self.assertEqual(len(self.backend.calls), 3)
+
+    def test_concurrent_lookups_are_coalesced(self):
+        flight = services.SingleFlight()
+        results = []
+
+        def lookup():
+            future, leader = flight.claim('voi')
+            if leader:
+                flight.run('voi', future, self.backend.geocode, 'Voi')
+            results.append(future.result(timeout=1))
+
+        threads = [threading.Thread(target=lookup) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.backend.calls, ['Voi'])
+        self.assertEqual(results, [(1.0, 2.0)] * 6)
+
+    def test_token_bucket_bounds_the_queue(self):
+        bucket = geocoders.TokenBucket('test-geocoder-bucket', rate=5, burst=1, timeout=0.5, max_waiting=2)
+        outcomes = []
+
+        def acquire():
+            try:
+                bucket.acquire()
+                outcomes.append('ok')
+            except GeocoderRateLimited:
+                outcomes.append('limited')
+
+        threads = [threading.Thread(target=acquire) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache.delete('test-geocoder-bucket')
+        self.assertIn('limited', outcomes)
+        self.assertLessEqual(outcomes.count('ok'), 3)
+
+
+class GazetteerTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        places = [
+            ('1', 'Nairobi', 'Nairobi', 'Nairobi City,NBO', '-1.28333', '36.81667', 4397073),
+            ('2', 'Mombasa', 'Mombasa', 'Mvita', '-4.05466', '39.66359', 1208333),
+            # Same name, smaller place: the big one wins
+            ('3', 'Nairobi', 'Nairobi', '', '0.5', '35.2', 120),
+            ('4', 'Naivasha', 'Naivasha', '', '-0.71667', '36.43333', 181966),
+        ]
+        # A crowded prefix, as in a full country dump
+        places += [(str(10 + i), f'Nai{"x" * (i % 40)}{i}', '', '', '0', '0', 0) for i in range(3000)]
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmpdir.name, 'places.tsv')
+        with open(cls.path, 'w', encoding='utf-8') as fh:
+            fh.write('# comment\n')
+            for geonameid, name, ascii_name, alternates, lat, lon, population in places:
+                columns = [geonameid, name, ascii_name, alternates, lat, lon] + [''] * 8 + [str(population)]
+                fh.write('\t'.join(columns) + '\n')
+        cls.index = geocoders.GazetteerIndex.from_tsv(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+        super().tearDownClass()
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('  NAIROBI '), (-1.28333, 36.81667))
+        self.assertEqual(self.index.lookup('nbo'), (-1.28333, 36.81667))
+        self.assertEqual(self.index.lookup('Mvita'), (-4.05466, 39.66359))
+        self.assertIsNone(self.index.lookup('Kisumu'))
+
+    def test_prefix(self):
+        self.assertEqual([name for name, _ in self.index.prefix('Mom')], ['mombasa'])
+        self.assertEqual(len(self.index.prefix('nai', limit=5)), 5)
+
+    def test_fuzzy(self):
+        self.assertEqual(self.index.fuzzy('Nairobbi'), (-1.28333, 36.81667))
+        self.assertEqual(self.index.fuzzy('Mombassa'), (-4.05466, 39.66359))
+        self.assertEqual(self.index.fuzzy('Naivashaa'), (-0.71667, 36.43333))
+        self.assertIsNone(self.index.fuzzy('Nakuru'))
+        self.assertIsNone(self.index.fuzzy('Na'))
+
+    def test_geocoder(self):
+        geocoder = geocoders.GazetteerGeocoder(self.path)
+        self.assertEqual(geocoder.geocode('Mombasa, Kenya'), (-4.05466, 39.66359))
+        self.assertEqual(geocoder.geocode('Nairobbi, Kenya'), (-1.28333, 36.81667))
+        self.assertIsNone(geocoder.geocode('Atlantis'))
+
+
+class DistanceTests(TestCase):
+    # (Nairobi, Mombasa), (London, New York), (Quito, Singapore)
+    LANES = [((-1.2864, 36.8172), (-4.0435, 39.6682)), ((51.5074, -0.1278), (40.7128, -74.0060)),
+             ((-0.1807, -78.4678), (1.3521, 103.8198))]
+
+    def test_modes_agree_with_geodesic(self):
+        for (lat1, lon1), (lat2, lon2) in self.LANES:
+            exact = distance.distance_km((lat1, lon1), (lat2, lon2), 'geodesic')
+            self.assertAlmostEqual(distance.distance_km((lat1, lon1), (lat2, lon2), 'vincenty'), exact, places=5)
+            self.assertLess(abs(distance.distance_km((lat1, lon1), (lat2, lon2), 'haversine') - exact) / exact, 0.0056)
+
+    def test_batches_match_single_pairs(self):
+        lat1, lon1, lat2, lon2 = zip(*((*a, *b) for a, b in self.LANES))
+        for mode in distance.DISTANCE_MODES:
+            batch = distance.distances_km(lat1, lon1, lat2, lon2, mode)
+            expected = [distance.distance_km(a, b, mode) for a, b in self.LANES]
+            self.assertEqual([round(km, 6) for km in batch.tolist()], [round(km, 6) for km in expected])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            distance.distance_km((0, 0), (1, 1), 'flat-earth')
+        user = User.objects.create_user(username='mode-tester', password='pass12345')
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post('/api/shipments/bulk/?distance_mode=flat-earth', '[]', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class DistanceMatrixTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='planner', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.truck = Vehicle.objects.create(name="Matrix Truck", emission_factor=Decimal('0.1000'))
+        for name, lat, lon in [('Nairobi', -1.2864, 36.8172), ('Mombasa', -4.0435, 39.6682), ('Kisumu', -0.0917, 34.768)]:
+            Location.objects.create(name=name, latitude=lat, longitude=lon)
+
+    def matrix(self, **payload):
+        response = self.client.post('/api/distance-matrix/', payload, format='json')
+        if response.status_code != 200:
+            return response.status_code, response.data
+        return response.status_code, json.loads(b''.join(response.streaming_content))
+
+    def test_matrix(self):
+        code, body = self.matrix(locations=['Nairobi', 'mombasa ', 'Kisumu'], weight='2.00', vehicles=[str(self.truck.id)])
+        self.assertEqual(code, 200)
+        km = body['distances']
+        self.assertEqual([km[i][i] for i in range(3)], [0, 0, 0])
+        self.assertEqual(km[0][1], km[1][0])
+        self.assertAlmostEqual(km[0][1], distance.distance_km((-1.2864, 36.8172), (-4.0435, 39.6682)), delta=0.01)
+        co2 = body['carbon_footprints'][0]
+        self.assertEqual(co2['vehicle'], str(self.truck.id))
+        self.assertAlmostEqual(co2['matrix'][0][1], km[0][1] * 2 * 0.1, delta=0.01)
+        self.assertFalse(Shipment.objects.exists())
+
+    def test_carbon_matrices_are_opt_in(self):
+        code, body = self.matrix(locations=['Nairobi', 'Mombasa'], weight='1.00')
+        self.assertEqual(code, 200)
+        self.assertEqual(len(body['distances']), 2)
+        self.assertEqual(body['carbon_footprints'], [])
+
+    def test_vectorized_matrix_matches_pairs(self):
+        points = [(-1.2864, 36.8172), (-4.0435, 39.6682), (51.5074, -0.1278)]
+        km = distance_matrix(points, 'vincenty')
+        self.assertAlmostEqual(km[2][1], distance.distance_km(points[1], points[2], 'geodesic'), places=5)
+
+    @override_settings(DISTANCE_MATRIX_MAX_LOCATIONS=2, DISTANCE_MATRIX_MAX_GEOCODE=0)
+    def test_caps(self):
+        code, body = self.matrix(locations=['Nairobi', 'Mombasa', 'Kisumu'], weight='1.00')
+        self.assertEqual(code, 400)
+        self.assertIn('locations', body)
+        with self.settings(DISTANCE_MATRIX_MAX_VEHICLES=0):
+            code, body = self.matrix(locations=['Nairobi', 'Mombasa'], weight='1.00', vehicles=[str(self.truck.id)])
+        self.assertEqual(code, 400)
+        self.assertIn('vehicles', body)
+        code, body = self.matrix(locations=['Nairobi', 'Atlantis'], weight='1.00')
+        self.assertEqual(code, 400)
+        self.assertEqual(body['locations'], ['Atlantis'])
+
+
+class RecordingTask:
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+
+
+@override_settings(METRICS_DISPATCH='eager')
+class MetricsBatchTests(ApiTestCase):
+    def test_batch_task(self):
+        for size in (3, 30):
+            shipments = self.add_shipments(size)
+            ids = [str(shipment.id) for shipment in shipments]
+            Shipment.objects.filter(id__in=ids).update(distance=None, carbon_footprint=None)
+            # Load, the route cache (lookup and store), bulk_update and the rollups
+            # (created in a savepoint), however many shipments
+            with assert_max_queries(8):
+                stats = compute_shipment_metrics_batch_task(ids + ['00000000-0000-0000-0000-000000000000'])
+            self.assertEqual((stats['requested'], stats['shipments'], stats['lanes']), (size + 1, size, 1))
+            self.assertFalse(Shipment.objects.filter(id__in=ids, carbon_footprint__isnull=True).exists())
+
+    def test_both_directions_of_a_lane_share_one_distance(self):
+        shipments = self.add_shipments(4)
+        for shipment in shipments[:2]:
+            shipment.origin_location, shipment.destination_location = shipment.destination_location, shipment.origin_location
+        Shipment.objects.bulk_update(shipments, ['origin_location', 'destination_location'])
+        ids = [str(shipment.id) for shipment in shipments]
+        Shipment.objects.filter(id__in=ids).update(distance=None, carbon_footprint=None)
+        stats = compute_shipment_metrics_batch_task(ids)
+        self.assertEqual((stats['lanes'], stats['pairs']), (2, 1))
+        self.assertEqual(len(set(Shipment.objects.values_list('distance', flat=True))), 1)
+
+    def price(self, count, reverse=0):
+        shipments = self.add_shipments(count)
+        for shipment in shipments[:reverse]:
+            shipment.origin_location, shipment.destination_location = shipment.destination_location, shipment.origin_location
+        Shipment.objects.bulk_update(shipments, ['origin_location', 'destination_location'])
+        ids = [str(shipment.id) for shipment in shipments]
+        Shipment.objects.filter(id__in=ids).update(distance=None, carbon_footprint=None)
+        return compute_shipment_metrics_batch_task(ids)
+
+    def test_lanes_come_from_the_route_cache(self):
+        services.flush_route_stats()
+        first, second = self.price(2, reverse=1), self.price(2)
+        self.assertEqual((first['pairs'], first['cached_pairs'], second['cached_pairs']), (1, 0, 1))
+        lane = RouteDistance.objects.get()
+        self.assertEqual((lane.origin.name, lane.destination.name, lane.mode), ('Nairobi', 'Mombasa', 'geodesic'))
+        self.assertAlmostEqual(lane.distance_km, 440.58, delta=0.01)
+
+        # Each mode has its own distances
+        with self.settings(DISTANCE_MODE='haversine'):
+            self.assertEqual(self.price(1)['cached_pairs'], 0)
+        self.assertEqual(RouteDistance.objects.count(), 2)
+
+        # A cached distance is used as is, without recomputing it
+        RouteDistance.objects.filter(mode='geodesic').update(distance_km=500)
+        shipment_ids = [str(shipment.id) for shipment in self.add_shipments(1)]
+        Shipment.objects.filter(id__in=shipment_ids).update(distance=None, carbon_footprint=None)
+        compute_shipment_metrics_batch_task(shipment_ids)
+        self.assertEqual(Shipment.objects.get(id=shipment_ids[0]).distance, Decimal('500.00'))
+
+    def test_hot_lanes_are_pinned(self):
+        services.flush_route_stats()
+        self.price(1)
+        try:
+            self.assertEqual(services.pin_hot_routes(), 1)
+            # Pinned lanes skip the query
+            shipment_ids = [str(shipment.id) for shipment in self.add_shipments(1)]
+            Shipment.objects.filter(id__in=shipment_ids).update(distance=None, carbon_footprint=None)
+            with assert_max_queries(6):
+                self.assertEqual(compute_shipment_metrics_batch_task(shipment_ids)['cached_pairs'], 1)
+        finally:
+            services._pinned_routes.clear()
+
+    def test_calculate_distance_uses_the_route_cache(self):
+        services.flush_route_stats()
+        self.assertAlmostEqual(services.calculate_distance('Nairobi', 'mombasa'), 440.58, delta=0.5)
+        RouteDistance.objects.update(distance_km=500)
+        self.assertEqual(services.calculate_distance('MOMBASA', 'nairobi'), 500)
+        services.flush_route_stats()
+        self.assertEqual(RouteDistance.objects.get().hit_count, 2)
+
+    def test_moving_a_place_drops_its_cached_lanes(self):
+        self.price(1)
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'pass12345')
+        self.client.force_login(admin_user)
+        nairobi = Location.objects.get(name='Nairobi')
+        response = self.client.post(f'/admin/api/location/{nairobi.pk}/change/', {
+            'name': 'Nairobi', 'latitude': '-1.3', 'longitude': '36.8', 'geocoded_by': 'manual',
+            'aliases-TOTAL_FORMS': '0', 'aliases-INITIAL_FORMS': '0',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(RouteDistance.objects.exists())
+
+    def test_route_stats_counts_both_directions(self):
+        services.flush_route_stats()
+        self.price(3, reverse=1)
+        out = StringIO()
+        call_command('route_stats', stdout=out)
+        self.assertIn("3  Nairobi <-> Mombasa  (440.6 km, geodesic)", out.getvalue())
+        self.assertIn("1 lanes cached.", out.getvalue())
+
+    def test_batcher_switches_to_batches_under_load(self):
+        single, batch = RecordingTask('single'), RecordingTask('batch')
+        batcher = Batcher(threshold=3, window=60, max_size=4)
+        for i in range(9):
+            batcher.add(single, batch, (f'id-{i}',))
+        batcher.flush()
+        # Two jobs go out alone, then the rate trips the threshold
+        self.assertEqual(single.calls, [('id-0',), ('id-1',)])
+        self.assertEqual(batch.calls, [(('id-2', 'id-3', 'id-4', 'id-5'),), (('id-6', 'id-7', 'id-8'),)])
+
+
+@override_settings(METRICS_DISPATCH='eager')
+class ShipmentMetricsTrackingTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_shipments(1)
+        self.shipment = Shipment.objects.get()
+
+    def save(self, shipment, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            shipment.save(**kwargs)
+        shipment.refresh_from_db()
+        return callbacks
+
+    def test_new_shipment_is_pending_until_priced(self):
+        shipment = Shipment(
+            company=self.company, owner=self.driver, vehicle=self.vehicle,
+            origin='Nairobi', destination='Mombasa', weight=Decimal('1.00'),
+        )
+        with self.captureOnCommitCallbacks() as callbacks:
+            shipment.save()
+        self.assertEqual(Shipment.objects.get(pk=shipment.pk).metrics_status, 'pending')
+        callbacks[0]()
+        shipment.refresh_from_db()
+        self.assertEqual(shipment.metrics_status, 'ok')
+        self.assertIsNotNone(shipment.carbon_footprint)
+
+    def test_unrelated_save_is_one_update(self):
+        # A failed geocode left zeros behind: saving again must not retry it
+        Shipment.objects.filter(pk=self.shipment.pk).update(distance=0, carbon_footprint=0)
+        shipment = Shipment.objects.get()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks, assert_max_queries(1):
+            shipment.save()
+        self.assertEqual(callbacks, [])
+        shipment.refresh_from_db()
+        self.assertEqual(shipment.carbon_footprint, 0)
+
+    def test_weight_change_updates_footprint_in_place(self):
+        self.shipment.weight = Decimal('4.00')
+        callbacks = self.save(self.shipment)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.shipment.distance, Decimal('440.58'))
+        self.assertEqual(self.shipment.carbon_footprint, Decimal('176.232'))
+
+    def test_place_change_recomputes_distance(self):
+        self.shipment.destination = 'nairobi'
+        self.shipment.origin = 'Mombasa'
+        callbacks = self.save(self.shipment, update_fields=['origin', 'destination'])
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.shipment.origin_location, Location.objects.resolve('Mombasa'))
+        self.assertAlmostEqual(float(self.shipment.distance), 440.58, delta=0.5)
+        self.assertIsNotNone(self.shipment.carbon_footprint)
+
+
+class FlakyGeocoder:
+    name = 'flaky'
+
+    def __init__(self):
+        self.down = True
+
+    def geocode(self, place_name):
+        if self.down:
+            raise GeocoderUnavailable("Service unavailable")
+        return (-0.30309, 36.08)
+
+
+class GeocodingRetryTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = FlakyGeocoder()
+        self.previous = geocoders._geocoder
+        geocoders._geocoder = geocoders.ChainGeocoder([self.backend])
+        services.clear_geocode_cache()
+        destination = Location.objects.resolve('Nakuru')
+        shipments = Shipment.objects.bulk_create([
+            Shipment(
+                company=self.company, owner=self.driver, vehicle=self.vehicle, origin='Nairobi', destination='Nakuru',
+                weight=Decimal('2.00'), origin_location=Location.objects.resolve('Nairobi'), destination_location=destination,
+            )
+            for _ in range(3)
+        ])
+        self.ids = [str(shipment.id) for shipment in shipments]
+        compute_shipment_metrics_batch_task(self.ids)
+
+    def tearDown(self):
+        geocoders._geocoder = self.previous
+        services.clear_geocode_cache()
+
+    def later(self, hours=24):
+        return timezone.now() + timedelta(hours=hours)
+
+    def test_failed_lane_waits_and_resolves_on_retry(self):
+        self.assertEqual(set(Shipment.objects.filter(id__in=self.ids).values_list('metrics_status', 'distance')), {('pending', None)})
+        lane = LaneRetry.objects.get()
+        self.assertEqual((lane.status, lane.attempts), ('pending', 0))
+        self.assertIn("unavailable", lane.last_error)
+        # Not due yet
+        self.assertEqual(retry_due_lanes()['lanes'], 0)
+
+        self.backend.down = False
+        stats = retry_due_lanes(now=self.later())
+        self.assertEqual((stats['resolved'], stats['shipments']), (1, 3))
+        self.assertFalse(LaneRetry.objects.exists())
+        for shipment in Shipment.objects.filter(id__in=self.ids):
+            self.assertEqual(shipment.metrics_status, 'ok')
+            self.assertAlmostEqual(float(shipment.carbon_footprint), float(shipment.distance) * 0.2, places=2)
+
+    @override_settings(METRICS_DISPATCH='eager', METRICS_STALE_AFTER=300)
+    def test_lost_jobs_are_sent_again(self):
+        # Jobs lost with a crashed process: old enough, and recent ones still in flight
+        lost, recent = self.add_shipments(2)
+        Shipment.objects.filter(pk__in=[lost.pk, recent.pk]).update(
+            distance=None, carbon_footprint=None, metrics_status='pending',
+        )
+        Shipment.objects.filter(pk=lost.pk).update(created_at=timezone.now() - timedelta(minutes=10))
+        Shipment.objects.filter(id__in=self.ids).update(created_at=timezone.now() - timedelta(minutes=10))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = retry_due_lanes()
+        # The shipments on the queued Nakuru lane keep waiting for their retry
+        self.assertEqual((stats['lanes'], stats['stale']), (0, 1))
+        statuses = dict(Shipment.objects.values_list('id', 'metrics_status'))
+        self.assertEqual((statuses[lost.pk], statuses[recent.pk]), ('ok', 'pending'))
+        self.assertEqual(set(Shipment.objects.filter(id__in=self.ids).values_list('metrics_status', flat=True)), {'pending'})
+
+    def test_rows_priced_at_zero_before_retries_existed(self):
+        # What migration 0018 leaves behind for a lane that failed to geocode back then
+        legacy = self.add_shipments(1)[0]
+        Shipment.objects.filter(pk=legacy.pk).update(distance=0, carbon_footprint=0, metrics_status='pending')
+        rebuild_emission_rollups()
+        LaneRetry.objects.create(origin=legacy.origin_location, destination=legacy.destination_location)
+
+        self.assertEqual(retry_due_lanes()['shipments'], 1)
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.metrics_status, 'ok')
+        self.assertAlmostEqual(float(legacy.carbon_footprint), 88.116, places=2)
+        rollup = EmissionRollup.objects.get(destination__name='Mombasa')
+        self.assertEqual(rollup.shipment_count, 1)
+        self.assertAlmostEqual(float(rollup.total_co2), 88.116, places=2)
+
+    @override_settings(ROOT_URLCONF=__name__, METRICS_DISPATCH='eager')
+    def test_async_create_saves_without_metrics_when_geocoding_fails(self):
+        payload = {'origin': 'Nairobi', 'destination': 'Eldoret', 'weight': '3', 'vehicle': str(self.vehicle.id)}
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = self.client.post('/api/shipments/', payload, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual((response.data['distance'], response.data['carbon_footprint']), (None, None))
+        # The metrics job ran and queued the lane for a retry
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(Shipment.objects.get(pk=response.data['id']).metrics_status, 'pending')
+        self.assertTrue(LaneRetry.objects.filter(destination__name='Eldoret').exists())
+
+        self.backend.down = False
+        retry_due_lanes(now=self.later())
+        self.assertEqual(Shipment.objects.get(pk=response.data['id']).metrics_status, 'ok')
+
+    @override_settings(GEOCODE_RETRY_MAX_ATTEMPTS=2)
+    def test_lane_is_dead_lettered_after_max_attempts(self):
+        self.assertEqual(retry_due_lanes(now=self.later())['rescheduled'], 1)
+        lane = LaneRetry.objects.get()
+        self.assertEqual(lane.attempts, 1)
+        self.assertGreater(lane.next_attempt_at, timezone.now())
+        self.assertEqual(retry_due_lanes(now=self.later(48))['dead'], 1)
+        self.assertEqual(LaneRetry.objects.get().status, 'dead')
+        self.assertEqual(set(Shipment.objects.filter(id__in=self.ids).values_list('metrics_status', flat=True)), {'failed'})
+        # Dead lanes aren't retried until someone requeues them
+        self.backend.down = False
+        self.assertEqual(retry_due_lanes(now=self.later(72))['lanes'], 0)
+
+        requeue_lanes(LaneRetry.objects.all())
+        self.assertEqual(retry_due_lanes()['shipments'], 3)
+        self.assertEqual(set(Shipment.objects.filter(id__in=self.ids).values_list('metrics_status', flat=True)), {'ok'})
+
+    @override_settings(GEOCODE_RETRY_BASE_DELAY=60, GEOCODE_RETRY_MAX_DELAY=3600)
+    def test_retry_delay_backs_off_with_jitter(self):
+        for attempts, ceiling in ((0, 60), (3, 480), (10, 3600)):
+            delays = [retry_delay(attempts) for _ in range(50)]
+            self.assertTrue(all(ceiling / 2 <= delay <= ceiling for delay in delays))
+            self.assertGreater(len(set(delays)), 1)
+
+
+class RecordingGeocoder(FlakyGeocoder):
+    """
+    Also notes how deep in savepoints the test's connection was during each
+    lookup (made from the geocoding pool's threads).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.connection = connections['default']
+        self.depths = []
+
+    def geocode(self, place_name):
+        self.depths.append(len(self.connection.savepoint_ids))
+        return super().geocode(place_name)
+
+
+class BulkIngestTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = RecordingGeocoder()
+        self.previous = geocoders._geocoder
+        geocoders._geocoder = geocoders.ChainGeocoder([self.backend])
+        services.clear_geocode_cache()
+
+    def tearDown(self):
+        geocoders._geocoder = self.previous
+        services.clear_geocode_cache()
+
+    def post(self, body, content_type='application/x-ndjson'):
+        response = self.client.post('/api/shipments/bulk/', body, content_type=content_type)
+        return response, [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def row(self, **fields):
+        return {'origin': 'Nairobi', 'destination': 'Mombasa', 'weight': '2', 'vehicle': str(self.vehicle.id), **fields}
+
+    def test_report_has_a_line_per_row(self):
+        body = '\n'.join([
+            json.dumps(self.row()),
+            '{"origin": "Nairobi",',
+            json.dumps(self.row(weight='-1')),
+            '[1, 2]',
+            json.dumps(self.row(origin='  nairobi ', destination='MOMBASA')),
+        ])
+        response, lines = self.post(body)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([line.get('status') for line in lines[:-1]], ['created', 'invalid', 'invalid', 'invalid', 'created'])
+        self.assertEqual([line.get('row') for line in lines[:-1]], [1, 2, 3, 4, 5])
+        self.assertIn("Invalid JSON", lines[1]['errors']['non_field_errors'][0])
+        self.assertIn('weight', lines[2]['errors'])
+        self.assertEqual(lines[3]['errors'], {'non_field_errors': ["Expected an object."]})
+        self.assertEqual(lines[-1], {'summary': {'created': 2, 'invalid': 3}})
+
+        for line in (lines[0], lines[4]):
+            shipment = Shipment.objects.get(pk=line['id'])
+            self.assertEqual((shipment.company, shipment.owner, shipment.metrics_status), (self.company, self.manager, 'ok'))
+            self.assertAlmostEqual(line['distance'], 440.58, delta=0.5)
+            self.assertAlmostEqual(line['carbon_footprint'], line['distance'] * 2 * 0.1, places=2)
+        self.assertEqual(Shipment.objects.count(), 2)
+
+    def test_csv_and_json_array(self):
+        csv_body = 'origin,destination,weight,vehicle\n' + f'Nairobi,Mombasa,2,{self.vehicle.id}\n' * 3
+        _, lines = self.post(csv_body, 'text/csv')
+        self.assertEqual(lines[-1], {'summary': {'created': 3, 'invalid': 0}})
+        _, lines = self.post(json.dumps([self.row(), self.row(vehicle='nope')]), 'application/json')
+        self.assertEqual(lines[-1], {'summary': {'created': 1, 'invalid': 1}})
+        _, lines = self.post('{"not": "a list"}', 'application/json')
+        self.assertEqual(lines, [{'error': "Expected a JSON array of shipments."}, {'summary': {'created': 0, 'invalid': 0}}])
+
+    def test_unsupported_content_type(self):
+        response = self.client.post('/api/shipments/bulk/', 'x', content_type='text/plain')
+        self.assertEqual(response.status_code, 415)
+
+    def test_places_are_geocoded_outside_the_transaction(self):
+        depth = len(connection.savepoint_ids)
+        _, lines = self.post('\n'.join(json.dumps(self.row(destination='Kisumu')) for _ in range(3)))
+        # Geocoder down: rows are created, waiting for a retry of the lane
+        self.assertEqual([line['metrics_status'] for line in lines[:-1]], ['pending'] * 3)
+        self.assertEqual([line['carbon_footprint'] for line in lines[:-1]], [None] * 3)
+        self.assertIn("unavailable", LaneRetry.objects.get(destination__name='Kisumu').last_error)
+        # Kisumu was looked up once, and not from inside the insert's transaction
+        self.assertEqual(self.backend.depths, [depth])
+
+
+class FastReadPathTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        shipments = self.add_shipments(4)
+        # Odd values: no metrics yet, no owner, text the renderer has to escape
+        Shipment.objects.filter(pk=shipments[0].pk).update(
+            distance=None, carbon_footprint=None, metrics_status='pending', weight=Decimal('0.50'),
+        )
+        Shipment.objects.filter(pk=shipments[1].pk).update(owner=None, origin='Nairobi \u2028 "CBD" – Ruaka')
+        Shipment.objects.filter(pk=shipments[2].pk).update(weight=Decimal('12345.60'), carbon_footprint=Decimal('0.001'))
+        Shipment.objects.filter(pk=shipments[3].pk).update(weight=Decimal('7.25'))
+
+    def test_records_match_serializer(self):
+        queryset = Shipment.objects.select_related('owner').order_by('weight')
+        expected = JSONRenderer().render(ShipmentSerializer(queryset, many=True).data)
+        self.assertEqual(FastJSONRenderer().render(shipment_records(shipment_values(queryset))), expected)
+
+    def test_list_response_is_byte_compatible(self):
+        response = self.client.get('/api/shipments/?ordering=-weight')
+        queryset = Shipment.objects.select_related('owner').order_by('-weight')
+        expected = JSONRenderer().render({
+            'count': 4, 'next': None, 'previous': None, 'results': ShipmentSerializer(queryset, many=True).data,
+        })
+        self.assertEqual(response.content, expected)
+
+        cursor_page = self.client.get('/api/shipments/?pagination=cursor&ordering=-weight&page_size=3').json()
+        self.assertEqual(cursor_page['results'], json.loads(expected)['results'][:3])
+        self.assertEqual(self.client.get(cursor_page['next']).json()['results'], json.loads(expected)['results'][3:])
+
+    def test_responses_are_compressed(self):
+        plain = self.client.get('/api/shipments/').content
+        response = self.client.get('/api/shipments/', HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(brotli.decompress(response.content), plain)
+
+        response = self.client.get('/api/shipments/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain)
+
+        export = self.client.get('/api/shipments/export/ndjson/', HTTP_ACCEPT_ENCODING='br')
+        self.assertEqual(export['Content-Encoding'], 'br')
+        rows = brotli.decompress(b''.join(export.streaming_content)).decode().rstrip('\n').split('\n')
+        self.assertEqual(len(rows), 4)
+        self.assertEqual({json.loads(row)['id'] for row in rows}, {str(pk) for pk in Shipment.objects.values_list('pk', flat=True)})
+        # Already a gzip file: not compressed twice
+        export = self.client.get('/api/shipments/export/csv/?compress=gzip', HTTP_ACCEPT_ENCODING='br')
+        self.assertFalse(export.has_header('Content-Encoding'))
+
+
+class ShipmentQueryPlanTests(ApiTestCase):
+    """
+    Every role's list query is served by an index on a table where the
+    company is a small share of the rows: no full scans, and no sorting for
+    the orderings the indexes are built for (see Shipment.Meta.indexes).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.client_user = User.objects.create_user(username='client', password='pass12345')
+        nairobi, mombasa = Location.objects.resolve('Nairobi'), Location.objects.resolve('Mombasa')
+        companies = [Company.objects.create(name=f"Carrier {i}") for i in range(40)]
+        owners = [None, cls.driver, cls.manager] + [
+            User.objects.create_user(username=f'carrier-driver-{i}') for i in range(10)
+        ]
+        shipments = [
+            Shipment(
+                company=company, owner=owners[i % len(owners)], vehicle=cls.vehicle,
+                origin='Nairobi', destination='Mombasa', weight=Decimal(i % 50 + 1),
+                distance=Decimal('440.58'), carbon_footprint=Decimal(i % 97), origin_location=nairobi,
+                destination_location=mombasa,
+            )
+            for company in companies + [cls.company] * 2
+            for i in range(100)
+        ]
+        Shipment.objects.bulk_create(shipments, batch_size=1000)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertIndexedList(self, user, *urls, ordered=()):
+        self.login(user)
+        for url in urls:
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            queries = [query['sql'] for query in captured.captured_queries if 'FROM "api_shipment"' in query['sql']]
+            self.assertTrue(queries, url)
+            for sql in queries:
+                plan = explain(sql)
+                self.assertEqual(full_scans(plan, 'api_shipment'), [], f"{url}\n{sql}\n{plan}")
+                if url in ordered and 'ORDER BY' in sql:
+                    self.assertEqual(sorts(plan), [], f"{url}\n{sql}\n{plan}")
+
+    def test_manager_lists(self):
+        ordered = [
+            '/api/shipments/?ordering=-created_at', '/api/shipments/?ordering=carbon_footprint',
+            '/api/shipments/?ordering=-weight', '/api/shipments/?pagination=cursor',
+        ]
+        self.assertIndexedList(
+            self.manager, '/api/shipments/', f'/api/shipments/?vehicle={self.vehicle.id}',
+            '/api/shipments/?origin=Nairobi&destination=Mombasa', *ordered, ordered=ordered,
+        )
+
+    def test_driver_lists(self):
+        ordered = ['/api/shipments/?ordering=-created_at', '/api/shipments/?pagination=cursor']
+        self.assertIndexedList(self.driver, '/api/shipments/', *ordered, ordered=ordered)
+
+    def test_client_lists(self):
+        # No ordered index for the client scope: company is NOT NULL, so it never
+        # matches a row, and the owner index keeps it off a full scan
+        self.assertIndexedList(
+            self.client_user, '/api/shipments/', '/api/shipments/?ordering=-created_at',
+            '/api/shipments/?pagination=cursor',
+        )
+
+
+
+class DelayRecordingTask(RecordingTask):
+    def delay(self, *args):
+        self.calls.append(('delay',) + args)
+
+
+@override_settings(METRICS_DISPATCH='eager')
+class DispatchTests(TestCase):
+    def setUp(self):
+        self.single, self.batch = RecordingTask('single'), RecordingTask('batch')
+
+    def test_jobs_wait_for_the_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            enqueue(self.single, 'a')
+            self.assertEqual(self.single.calls, [])
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEqual(self.single.calls, [('a',)])
+
+    def test_saves_of_one_shipment_are_coalesced(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                enqueue(self.single, 'a', batch_task=self.batch)
+        self.assertEqual((self.single.calls, self.batch.calls), ([('a',)], []))
+
+    def test_jobs_committed_together_go_out_as_a_batch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for shipment_id in ('a', 'b', 'a', 'c'):
+                enqueue(self.single, shipment_id, batch_task=self.batch)
+        self.assertEqual((self.single.calls, self.batch.calls), ([], [(('a', 'b', 'c'),)]))
+
+    def test_later_commits_get_their_own_jobs(self):
+        for shipment_id in ('a', 'b'):
+            with self.captureOnCommitCallbacks(execute=True):
+                enqueue(self.single, shipment_id)
+        self.assertEqual(self.single.calls, [('a',), ('b',)])
+
+    def test_rolled_back_jobs_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    enqueue(self.single, 'a')
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            enqueue(self.single, 'b')
+        self.assertEqual(self.single.calls, [('b',)])
+
+    @override_settings(METRICS_DISPATCH='celery')
+    def test_celery_mode_sends_through_the_broker(self):
+        task = DelayRecordingTask('single')
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue(task, 'a')
+        self.assertEqual(task.calls, [('delay', 'a')])
+
+    def test_local_worker_skips_jobs_already_queued(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def task(shipment_id):
+            calls.append(shipment_id)
+            started.set()
+            release.wait(5)
+        task.name = 'blocking'
+
+        worker = LocalWorker(threads=1)
+        worker.submit(task, ('a',))
+        started.wait(5)
+        # 'a' is running, so a new 'a' is queued once; 'b' waits behind it
+        for shipment_id in ('a', 'a', 'b', 'b'):
+            worker.submit(task, (shipment_id,))
+        release.set()
+        worker._executor.shutdown(wait=True)
+        self.assertEqual(calls, ['a', 'a', 'b'])
+
+
+@override_settings(METRICS_DISPATCH='eager')
+class EmissionRollupTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.van = Vehicle.objects.create(name="Van", emission_factor=Decimal('0.2500'))
+        nakuru = Location.objects.resolve('Nakuru')
+        nakuru.latitude, nakuru.longitude = -0.30309, 36.08
+        nakuru.save()
+        cls.staff = User.objects.create_user(username='staff', password='pass12345', is_staff=True)
+
+    def create(self, origin='Nairobi', destination='Mombasa', weight='2.00', vehicle=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            shipment = Shipment.objects.create(
+                company=self.company, owner=self.driver, vehicle=vehicle or self.vehicle,
+                origin=origin, destination=destination, weight=Decimal(weight),
+            )
+        return Shipment.objects.select_related('vehicle').get(pk=shipment.pk)
+
+    def save(self, shipment):
+        with self.captureOnCommitCallbacks(execute=True):
+            shipment.save()
+        return Shipment.objects.select_related('vehicle').get(pk=shipment.pk)
+
+    def rollup_rows(self):
+        return sorted(EmissionRollup.objects.values_list(
+            'company_id', 'vehicle_id', 'origin_id', 'destination_id', 'day',
+            'shipment_count', 'total_co2', 'total_distance', 'total_weight',
+        ))
+
+    def assertMatchesRebuild(self):
+        kept = self.rollup_rows()
+        rebuild_emission_rollups()
+        self.assertEqual(kept, self.rollup_rows())
+        return kept
+
+    def test_rollups_follow_creates_updates_and_deletes(self):
+        shipments = [self.create(), self.create(weight='5.50'), self.create('Nairobi', 'Nakuru', vehicle=self.van)]
+        rows = self.assertMatchesRebuild()
+        self.assertEqual(sorted(row[5] for row in rows), [1, 2])
+
+        # Same lane, new weight; new vehicle; new lane
+        shipments[0].weight = Decimal('3.25')
+        shipments[0] = self.save(shipments[0])
+        shipments[1].vehicle = self.van
+        shipments[1] = self.save(shipments[1])
+        shipments[2].destination = 'Mombasa'
+        shipments[2] = self.save(shipments[2])
+        self.assertMatchesRebuild()
+
+        shipments[0].delete()
+        self.assertMatchesRebuild()
+        for shipment in shipments[1:]:
+            shipment.delete()
+        self.assertEqual(self.assertMatchesRebuild(), [])
+
+    def test_vehicle_factor_change_moves_the_rollups(self):
+        self.create()
+        self.create('Nairobi', 'Nakuru')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vehicle.emission_factor = Decimal('0.3000')
+            self.vehicle.save()
+        self.assertMatchesRebuild()
+
+    def test_analytics_totals(self):
+        created = [self.create(), self.create(weight='4.00'), self.create('Nairobi', 'Nakuru', vehicle=self.van)]
+        response = self.client.get('/api/analytics/emissions/?bucket=total&group_by=vehicle')
+        self.assertEqual(response.status_code, 200)
+        results = {row['vehicle__name']: row for row in response.data['results']}
+        for name, shipments in (('Truck', created[:2]), ('Van', created[2:])):
+            self.assertEqual(results[name]['shipments'], len(shipments))
+            self.assertAlmostEqual(
+                float(results[name]['total_co2']), sum(float(s.carbon_footprint) for s in shipments), places=2
+            )
+
+        response = self.client.get('/api/analytics/emissions/?bucket=day&group_by=lane')
+        lanes = {(row['origin__name'], row['destination__name']): row['shipments'] for row in response.data['results']}
+        self.assertEqual(lanes, {('Nairobi', 'Mombasa'): 2, ('Nairobi', 'Nakuru'): 1})
+        self.assertEqual(response.data['results'][0]['period'], timezone.localdate())
+
+        later = (timezone.localdate() + timedelta(days=1)).isoformat()
+        response = self.client.get(f'/api/analytics/emissions/?bucket=total&start={later}')
+        self.assertEqual(response.data['results'], [
+            {'shipments': None, 'total_co2': None, 'total_distance': None, 'total_weight': None}
+        ])
+
+    def test_analytics_scoping_and_validation(self):
+        self.create()
+        other = Company.objects.create(name="Other")
+        self.login(self.driver)
+        self.assertEqual(self.client.get('/api/analytics/emissions/').status_code, 403)
+
+        self.login(self.staff)
+        for params in ('company=abc', 'company=1.5', 'company=-1', 'bucket=year', 'group_by=owner', 'start=2026-13-01'):
+            response = self.client.get(f'/api/analytics/emissions/?{params}')
+            self.assertEqual(response.status_code, 400, params)
+        response = self.client.get(f'/api/analytics/emissions/?bucket=total&company={other.id}')
+        self.assertEqual(response.data['results'][0]['shipments'], None)
+        response = self.client.get(f'/api/analytics/emissions/?bucket=total&company={self.company.id}')
+        self.assertEqual(response.data['results'][0]['shipments'], 1)
+
+
+class TokenClaimsTests(ApiTestCase):
+    def tokens(self, user):
+        return self.client.post(
+            '/api/login/', {'username': user.username, 'password': 'pass12345'}, format='json'
+        ).json()
+
+    def use(self, access):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+
+    def refresh(self, tokens):
+        response = self.client.post('/api/token/refresh/', {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['access']
+
+    def test_tokens_carry_the_profile_claims(self):
+        claims = AccessToken(self.tokens(self.manager)['access'])
+        self.assertEqual(
+            (claims['username'], claims['role'], claims['company_id']), ('manager', 'manager', self.company.id)
+        )
+
+    def test_demoted_manager_token_is_stale(self):
+        tokens = self.tokens(self.manager)
+        self.use(tokens['access'])
+        self.assertEqual(self.client.get('/api/analytics/emissions/').status_code, 200)
+
+        self.manager.profile.role = 'driver'
+        self.manager.profile.save()
+        response = self.client.get('/api/analytics/emissions/')
+        # 403 rather than 401: session auth comes first and sends no challenge
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data['detail'].code, 'token_stale')
+
+        # Refreshing stamps the new role into the access token
+        access = self.refresh(tokens)
+        self.assertEqual(AccessToken(access)['role'], 'driver')
+        self.use(access)
+        self.assertEqual(self.client.get('/api/analytics/emissions/').status_code, 403)
+
+    def test_saves_without_claim_changes_keep_tokens_valid(self):
+        tokens = self.tokens(self.manager)
+        self.manager.profile.save()
+        self.manager.email = 'new@example.com'
+        self.manager.save()
+        self.use(tokens['access'])
+        self.assertEqual(self.client.get('/api/shipments/').status_code, 200)
+
+    def test_moved_user_loses_the_old_company(self):
+        self.add_shipments(1)
+        rebuild_emission_rollups()
+        tokens = self.tokens(self.manager)
+        self.use(tokens['access'])
+        self.assertEqual(self.client.get('/api/shipments/').data['count'], 1)
+
+        other = Company.objects.create(name="Other")
+        self.manager.profile.company = other
+        self.manager.profile.save()
+        self.assertEqual(self.client.get('/api/shipments/').data['detail'].code, 'token_stale')
+
+        access = self.refresh(tokens)
+        self.assertEqual(AccessToken(access)['company_id'], other.id)
+        self.use(access)
+        self.assertEqual(self.client.get('/api/shipments/').data['count'], 0)
+        self.assertEqual(self.client.get('/api/shipments/export/ndjson/').getvalue(), b'')
+        response = self.client.get('/api/analytics/emissions/?bucket=total')
+        self.assertEqual(response.data['results'][0]['shipments'], None)
+
+    def test_revoked_staff_token_is_stale(self):
+        other = Company.objects.create(name="Other")
+        self.manager.is_staff = True
+        self.manager.save()
+        tokens = self.tokens(self.manager)
+        self.use(tokens['access'])
+        self.assertEqual(self.client.get(f'/api/analytics/emissions/?company={other.id}').status_code, 200)
+
+        self.manager.is_staff = False
+        self.manager.save()
+        response = self.client.get(f'/api/analytics/emissions/?company={other.id}')
+        self.assertEqual(response.data['detail'].code, 'token_stale')
+
+        access = self.refresh(tokens)
+        self.assertIs(AccessToken(access)['is_staff'], False)
+
+    def test_superuser_change_outdates_tokens(self):
+        tokens = self.tokens(self.manager)
+        user = User.objects.get(pk=self.manager.pk)
+        user.is_superuser = True
+        user.save()
+        self.use(tokens['access'])
+        self.assertEqual(self.client.get('/api/shipments/').data['detail'].code, 'token_stale')
+
+    def test_login_bookkeeping_keeps_tokens_valid(self):
+        tokens = self.tokens(self.manager)
+        user = User.objects.get(pk=self.manager.pk)
+        user.last_login = timezone.now()
+        user.save(update_fields=['last_login'])
+        self.use(tokens['access'])
+        self.assertEqual(self.client.get('/api/shipments/').status_code, 200)
+
+    def test_deactivated_user_cannot_refresh(self):
+        tokens = self.tokens(self.manager)
+        self.manager.is_active = False
+        self.manager.save()
+        self.use(tokens['access'])
+        self.assertEqual(self.client.get('/api/shipments/').data['detail'].code, 'token_stale')
+        self.client.credentials()
+        response = self.client.post('/api/token/refresh/', {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+
+class InstrumentationTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        for histogram in instrumentation.METRICS:
+            histogram.clear()
+
+    def fresh_client(self):
+        # Middleware settings are read when the client's handler loads it
+        client = APIClient()
+        client.credentials(**self.client._credentials)
+        return client
+
+    def test_histogram(self):
+        histogram = instrumentation.Histogram('test_seconds', "Test.", (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(('list', 'GET'), value)
+        histogram.observe(('say "hi"\n', 'GET'), 0.2)
+        self.assertEqual(histogram.expose(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{view="list",method="GET",le="0.1"} 2',
+            'test_seconds_bucket{view="list",method="GET",le="1.0"} 3',
+            'test_seconds_bucket{view="list",method="GET",le="+Inf"} 4',
+            'test_seconds_sum{view="list",method="GET"} 3.65',
+            'test_seconds_count{view="list",method="GET"} 4',
+            'test_seconds_bucket{view="say \\"hi\\"\\n",method="GET",le="0.1"} 0',
+            'test_seconds_bucket{view="say \\"hi\\"\\n",method="GET",le="1.0"} 1',
+            'test_seconds_bucket{view="say \\"hi\\"\\n",method="GET",le="+Inf"} 1',
+            'test_seconds_sum{view="say \\"hi\\"\\n",method="GET"} 0.2',
+            'test_seconds_count{view="say \\"hi\\"\\n",method="GET"} 1',
+        ])
+
+    def test_server_timing_header_follows_debug_by_default(self):
+        with override_settings():
+            del settings.SERVER_TIMING_HEADER
+            self.assertNotIn('Server-Timing', self.fresh_client().get('/api/shipments/'))
+            with self.settings(DEBUG=True):
+                self.assertIn('Server-Timing', self.fresh_client().get('/api/shipments/'))
+        with self.settings(SERVER_TIMING_HEADER=False, DEBUG=True):
+            self.assertNotIn('Server-Timing', self.fresh_client().get('/api/shipments/'))
+
+    @override_settings(SERVER_TIMING_HEADER=True)
+    def test_server_timing_header(self):
+        self.add_shipments(3)
+        header = self.fresh_client().get('/api/shipments/')['Server-Timing']
+        sections = dict(part.split(';', 1) for part in header.split(', '))
+        self.assertEqual(list(sections), ['total', 'db', 'serialize', 'auth'])
+        self.assertIn('desc="2 queries"', sections['db'])
+
+    def test_metrics_need_the_token(self):
+        self.client.credentials()
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with self.settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer nope').status_code, 401)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_requests_are_recorded(self):
+        self.add_shipments(3)
+        client = self.fresh_client()
+        client.get('/api/shipments/')
+        client.get('/api/shipments/')
+        client.generic('BREW', '/api/shipments/')
+        client.credentials()
+        body = client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret').content.decode()
+        self.assertIn('greenpath_request_duration_seconds_count{view="shipment-list",method="GET",status="200"} 2', body)
+        self.assertIn('greenpath_request_duration_seconds_count{view="shipment-list",method="other",status="405"} 1', body)
+        # Two queries per list request: COUNT + page
+        self.assertIn('greenpath_request_db_queries_bucket{view="shipment-list",method="GET",le="1"} 0', body)
+        self.assertIn('greenpath_request_db_queries_bucket{view="shipment-list",method="GET",le="2"} 2', body)
+        self.assertIn('greenpath_request_serialize_duration_seconds_count{view="shipment-list",method="GET"} 2', body)
+
+
+@override_settings(METRICS_DISPATCH='eager')
+class FootprintRecomputeTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shipments = self.add_shipments(5)
+        Shipment.objects.filter(pk=self.shipments[0].pk).update(weight=Decimal('7.50'))
+        # Not priced yet: left for the metrics job
+        Shipment.objects.filter(pk=self.shipments[1].pk).update(distance=None, carbon_footprint=None)
+        self.other = Vehicle.objects.create(name="Bike", emission_factor=Decimal('0.0100'))
+        self.other_shipment = self.add_shipments(1)[0]
+        Shipment.objects.filter(pk=self.other_shipment.pk).update(vehicle=self.other)
+
+    def assertFootprints(self, factor):
+        for distance_km, weight, footprint in Shipment.objects.filter(
+            vehicle=self.vehicle, distance__isnull=False
+        ).values_list('distance', 'weight', 'carbon_footprint'):
+            self.assertAlmostEqual(float(footprint), float(distance_km) * float(weight) * factor, places=3)
+
+    def test_factor_change_recomputes_the_vehicle(self):
+        vehicle = Vehicle.objects.get(pk=self.vehicle.pk)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            vehicle.emission_factor = Decimal('0.2500')
+            vehicle.save()
+        self.assertEqual(len(callbacks), 1)
+        self.assertFootprints(0.25)
+        self.assertIsNone(Shipment.objects.get(pk=self.shipments[1].pk).carbon_footprint)
+        self.assertEqual(Shipment.objects.get(pk=self.other_shipment.pk).carbon_footprint, Decimal('88.116'))
+
+    def test_other_saves_do_not_recompute(self):
+        vehicle = Vehicle.objects.get(pk=self.vehicle.pk)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            vehicle.name = "Lorry"
+            vehicle.emission_factor = '0.1000'
+            vehicle.save()
+        self.assertEqual(callbacks, [])
+
+    def test_chunks_and_progress(self):
+        Vehicle.objects.filter(pk=self.vehicle.pk).update(emission_factor=Decimal('0.5000'))
+        progress = []
+        count = recompute_vehicle_footprints(
+            Vehicle.objects.get(pk=self.vehicle.pk), chunk_size=2, progress=lambda *args: progress.append(args)
+        )
+        self.assertEqual(count, 4)
+        self.assertEqual(progress, [(2, 4), (4, 4)])
+        self.assertFootprints(0.5)
+
+    def test_command(self):
+        Vehicle.objects.filter(pk=self.vehicle.pk).update(emission_factor=Decimal('0.3000'))
+        out = StringIO()
+        call_command('recompute_footprints', vehicle=['Truck'], chunk_size=3, stdout=out)
+        self.assertIn("Truck: 3/4 shipments", out.getvalue())
+        self.assertIn("Truck: recomputed 4 shipments", out.getvalue())
+        self.assertNotIn("Bike", out.getvalue())
+        self.assertFootprints(0.3)
+
+        with self.assertRaisesMessage(CommandError, "Vehicle 'Plane' not found."):
+            call_command('recompute_footprints', vehicle=['Plane'], stdout=out)
+
+    def test_command_recomputes_distances(self):
+        call_command('recompute_footprints', distances=True, distance_mode='haversine', stdout=StringIO())
+        haversine = distance.distance_km((-1.28333, 36.81667), (-4.05466, 39.66359), 'haversine')
+        for distance_km in Shipment.objects.filter(vehicle=self.vehicle).values_list('distance', flat=True):
+            self.assertAlmostEqual(float(distance_km), haversine, places=2)
+        self.assertFootprints(0.1)
+
+
+class KeysetPaginationTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        shipments = self.add_shipments(23)
+        for i, shipment in enumerate(shipments):
+            # Lots of ties, and footprints still being computed
+            shipment.weight = Decimal(1 + i % 3)
+            shipment.carbon_footprint = None if i % 4 == 0 else Decimal(10 * (i % 5))
+        Shipment.objects.bulk_update(shipments, ['weight', 'carbon_footprint'])
+        self.rows = list(Shipment.objects.values('id', 'weight', 'carbon_footprint', 'created_at'))
+
+    def expected(self, ordering):
+        field, descending = ordering.lstrip('-'), ordering.startswith('-')
+        present = sorted(
+            (row for row in self.rows if row[field] is not None),
+            key=lambda row: (row[field], row['id']), reverse=descending,
+        )
+        missing = sorted(
+            (row for row in self.rows if row[field] is None), key=lambda row: row['id'], reverse=descending
+        )
+        return [str(row['id']) for row in present + missing]
+
+    def walk(self, url, link='next'):
+        ids, pages = [], 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.data)
+            page = [row['id'] for row in response.data['results']]
+            ids.extend(page if link == 'next' else reversed(page))
+            url = response.data[link]
+            pages += 1
+            self.assertLess(pages, 20)
+        return ids, response
+
+    def test_pages_have_no_gaps_or_duplicates(self):
+        for ordering in ('-created_at', 'carbon_footprint', '-carbon_footprint', 'weight', '-weight'):
+            with self.subTest(ordering=ordering):
+                expected = self.expected(ordering)
+                ids, last = self.walk(f'/api/shipments/?pagination=cursor&ordering={ordering}&page_size=4')
+                self.assertEqual(ids, expected)
+                self.assertEqual(len(last.data['results']), 3)
+
+                # And back again from the last page
+                back, _ = self.walk(last.data['previous'], link='previous')
+                self.assertEqual(back, list(reversed(expected[:-3])))
+
+    def test_page_size_and_bad_cursors(self):
+        response = self.client.get('/api/shipments/?pagination=cursor&page_size=1000')
+        self.assertEqual(len(response.data['results']), 23)
+        self.assertIsNone(response.data['next'])
+        self.assertIsNone(response.data['previous'])
+        response = self.client.get('/api/shipments/?pagination=cursor&page_size=nope')
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(self.client.get('/api/shipments/?cursor=garbage').status_code, 404)
+
+    def test_approximate_total(self):
+        response = self.client.get('/api/shipments/?pagination=cursor&include_total=approx')
+        # Only PostgreSQL's planner gives an estimate
+        self.assertIn('approximate_count', response.data)
+        self.assertNotIn('count', response.data)
+
+
+class ShipmentExportTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_shipments(3)
+        self.add_shipments(2, owner=self.manager)
+        # One without metrics yet
+        Shipment.objects.filter(pk=self.add_shipments(1)[0].pk).update(distance=None, carbon_footprint=None)
+
+    def export(self, url, **extra):
+        response = self.client.get(url, **extra)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def listed(self, query=''):
+        response = self.client.get(f'/api/shipments/?page_size=100{query}')
+        return {row['id']: row for row in json.loads(response.content)['results']}
+
+    def test_ndjson_matches_the_list(self):
+        response, body = self.export('/api/shipments/export/ndjson/')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="shipments.ndjson"')
+        records = [json.loads(line) for line in body.decode().splitlines()]
+        listed = self.listed()
+        self.assertEqual(len(records), 6)
+        for record in records:
+            # The list leaves out owner for rows without one; the export always has the column
+            self.assertEqual(record, {**listed[record['id']], 'owner': record['owner']})
+            self.assertEqual(record['owner'], listed[record['id']].get('owner'))
+
+    def test_csv(self):
+        response, body = self.export('/api/shipments/export/csv/')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(body.decode())))
+        self.assertEqual(list(rows[0]), [name for name, _ in SHIPMENT_COLUMNS])
+        listed = self.listed()
+        self.assertEqual(len(rows), 6)
+        for row in rows:
+            expected = listed[row['id']]
+            self.assertEqual((row['origin'], row['weight'], row['owner']), ('Nairobi', expected['weight'], expected['owner']))
+            if expected['carbon_footprint'] is None:
+                self.assertEqual((row['distance'], row['carbon_footprint']), ('', ''))
+            else:
+                self.assertEqual(float(row['carbon_footprint']), expected['carbon_footprint'])
+
+    def test_gzip_download(self):
+        response, body = self.export('/api/shipments/export/csv/?compress=gzip', HTTP_ACCEPT_ENCODING='br')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="shipments.csv.gz"')
+        # Already compressed: the middleware leaves it alone
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(gzip.decompress(body), self.export('/api/shipments/export/csv/')[1])
+
+    def test_scoping_and_filters(self):
+        self.login(self.driver)
+        _, body = self.export('/api/shipments/export/ndjson/')
+        self.assertEqual(len(body.splitlines()), 4)
+        self.login(self.manager)
+        _, body = self.export('/api/shipments/export/ndjson/?ordering=created_at&search=mombasa')
+        created = [json.loads(line)['created_at'] for line in body.splitlines()]
+        self.assertEqual((len(created), created), (6, sorted(created)))
+        _, body = self.export('/api/shipments/export/ndjson/?destination=Kisumu')
+        self.assertEqual(body, b'')
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get('/api/shipments/export/xml/').status_code, 404)
+
+    def test_large_export_is_chunked(self):
+        self.add_shipments(45)
+        with self.settings(EXPORT_CHUNK_SIZE=20):
+            response = self.client.get('/api/shipments/export/ndjson/')
+            chunks = list(response.streaming_content)
+        self.assertEqual([chunk.count(b'\n') for chunk in chunks], [20, 20, 11])
+
+
+class ShipmentSearchTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        lanes = [('Nairobi', 'Mombasa'), ('Nairobi', 'Kisumu'), ('Kisumu', 'Nakuru'), ('Eldoret', 'Mombasa')]
+        locations = Location.objects.resolve_many({place for lane in lanes for place in lane})
+        self.shipments = Shipment.objects.bulk_create([
+            Shipment(
+                company=self.company, owner=self.driver, vehicle=self.vehicle, origin=origin,
+                destination=destination, weight=Decimal('1.00'), metrics_status='ok',
+                origin_location=locations[origin.lower()], destination_location=locations[destination.lower()],
+            )
+            for origin, destination in lanes
+        ])
+
+    def search(self, term):
+        response = self.client.get('/api/shipments/', {'search': term})
+        self.assertEqual(response.status_code, 200)
+        return sorted(
+            (row['origin'], row['destination']) for row in json.loads(response.content)['results']
+        )
+
+    def test_substring_in_either_column(self):
+        self.assertEqual(self.search('ROBI'), [('Nairobi', 'Kisumu'), ('Nairobi', 'Mombasa')])
+        self.assertEqual(self.search('isum'), [('Kisumu', 'Nakuru'), ('Nairobi', 'Kisumu')])
+        self.assertEqual(self.search('Nakuru'), [('Kisumu', 'Nakuru')])
+
+    def test_every_term_must_match(self):
+        self.assertEqual(self.search('nairobi kisumu'), [('Nairobi', 'Kisumu')])
+        self.assertEqual(self.search('eldoret kisumu'), [])
+
+    def test_uses_the_trigram_index(self):
+        if not search.sqlite_search_available():
+            self.skipTest("SQLite without the FTS5 trigram tokenizer")
+        with CaptureQueriesContext(connection) as captured:
+            self.search('basa')
+        self.assertTrue(any(search.SQLITE_SEARCH_TABLE in query['sql'] for query in captured))
+
+    def test_short_terms_fall_back_to_icontains(self):
+        # Below three characters the trigram index can't match anything
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.search('ak'), [('Kisumu', 'Nakuru')])
+        self.assertFalse(any(search.SQLITE_SEARCH_TABLE in query['sql'] for query in captured))
+        self.assertEqual(len(self.search('o')), 3)
+
+    def test_index_follows_updates_and_deletes(self):
+        nairobi_kisumu = self.shipments[1]
+        Shipment.objects.filter(pk=nairobi_kisumu.pk).update(origin='Thika')
+        self.assertEqual(self.search('thika'), [('Thika', 'Kisumu')])
+        self.assertEqual(self.search('nairobi'), [('Nairobi', 'Mombasa')])
+        Shipment.objects.filter(pk=nairobi_kisumu.pk).delete()
+        self.assertEqual(self.search('thika'), [])
+
+    def test_id_prefix(self):
+        shipment = self.shipments[3]
+        self.assertEqual(self.search(str(shipment.id)[:8]), [('Eldoret', 'Mombasa')])
+        self.assertEqual(self.search(str(shipment.id).upper()), [('Eldoret', 'Mombasa')])
+
+    def test_special_characters_are_literal(self):
+        for term in ('ro"bi', '%', 'a_b', 'NEAR(nai', 'nai*'):
+            with self.subTest(term=term):
+                self.assertEqual(self.search(term), [])
+
+
+class MigrationTestCase(TransactionTestCase):
+    """
+    Runs a data migration on rows written with the models as they were before
+    it: setUp migrates back to `before`, and migrate() runs up to `after` and
+    returns the models as of then.
+    """
+    before = after = None
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        self.apps = executor.loader.project_state(self.before).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        # The migrate command does this through post_migrate
+        search.install_search_indexes(connection)
+
+    def migrate(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        return executor.loader.project_state(self.after).apps
+
+
+class LocationBackfillMigrationTests(MigrationTestCase):
+    """
+    0012_backfill_locations on shipments written before Locations existed.
+    """
+    before = [('api', '0011_location')]
+    after = [('api', '0012_backfill_locations')]
+
+    def test_backfill(self):
+        Company = self.apps.get_model('api', 'Company')
+        Vehicle = self.apps.get_model('api', 'Vehicle')
+        Shipment = self.apps.get_model('api', 'Shipment')
+        GeocodeCacheEntry = self.apps.get_model('api', 'GeocodeCacheEntry')
+        company = Company.objects.create(name="Acme", registration_number='A1')
+        vehicle = Vehicle.objects.create(name="Truck", emission_factor=Decimal('0.1000'))
+        lanes = [
+            ('Nairobi', 'Mombasa', Decimal('88.116')), ('Nairobi', 'Mombasa', Decimal('88.116')),
+            (' nairobi ', 'MOMBASA', Decimal('44.058')), ('Mombasa', 'Nairobi', None),
+        ]
+        for origin, destination, footprint in lanes:
+            Shipment.objects.create(
+                company=company, vehicle=vehicle, origin=origin, destination=destination, weight=Decimal('1.00'),
+                distance=footprint and Decimal('440.58'), carbon_footprint=footprint,
+            )
+        GeocodeCacheEntry.objects.create(name='nairobi', latitude=-1.28333, longitude=36.81667, source='nominatim')
+
+        apps = self.migrate()
+        Location = apps.get_model('api', 'Location')
+        Shipment = apps.get_model('api', 'Shipment')
+        EmissionRollup = apps.get_model('api', 'EmissionRollup')
+
+        # One Location per place whatever the spelling, named after the most used one
+        locations = {location.normalized_name: location for location in Location.objects.all()}
+        self.assertEqual(sorted(locations), ['mombasa', 'nairobi'])
+        nairobi, mombasa = locations['nairobi'], locations['mombasa']
+        self.assertEqual((nairobi.name, mombasa.name), ('Nairobi', 'Mombasa'))
+        self.assertEqual(apps.get_model('api', 'LocationAlias').objects.count(), 2)
+        # Coordinates come over from the geocode cache
+        self.assertEqual((nairobi.latitude, nairobi.longitude, nairobi.geocoded_by), (-1.28333, 36.81667, 'nominatim'))
+        self.assertIsNone(mombasa.latitude)
+
+        self.assertFalse(Shipment.objects.filter(origin_location=None).exists())
+        self.assertFalse(Shipment.objects.filter(destination_location=None).exists())
+        self.assertEqual(Shipment.objects.filter(origin_location=nairobi, destination_location=mombasa).count(), 3)
+
+        # Rollups regrouped on the new lane keys; unpriced shipments left out
+        rollup = EmissionRollup.objects.get()
+        self.assertEqual((rollup.origin_id, rollup.destination_id), (nairobi.pk, mombasa.pk))
+        self.assertEqual((rollup.shipment_count, rollup.total_co2), (3, Decimal('220.290')))
+
+
+class MetricsStatusMigrationTests(MigrationTestCase):
+    """
+    0018_shipment_metrics_status_pending on rows stamped 'ok' by the old default.
+    """
+    before = [('api', '0017_routedistance')]
+    after = [('api', '0018_shipment_metrics_status_pending')]
+
+    def test_unpriced_rows_wait_for_a_retry(self):
+        Company = self.apps.get_model('api', 'Company')
+        Vehicle = self.apps.get_model('api', 'Vehicle')
+        Location = self.apps.get_model('api', 'Location')
+        Shipment = self.apps.get_model('api', 'Shipment')
+        LaneRetry = self.apps.get_model('api', 'LaneRetry')
+        company = Company.objects.create(name="Acme", registration_number='A1')
+        vehicle = Vehicle.objects.create(name="Truck", emission_factor=Decimal('0.1000'))
+        places = {
+            name: Location.objects.create(name=name, normalized_name=name.lower())
+            for name in ('Nairobi', 'Mombasa', 'Kisumu', 'Atlantis', 'Nakuru')
+        }
+        rows = {
+            'priced': ('Nairobi', 'Mombasa', Decimal('440.58'), Decimal('88.116')),
+            # Geocoding failed before the retries existed
+            'zero': ('Nairobi', 'Atlantis', Decimal('0'), Decimal('0')),
+            'no_distance': ('Kisumu', 'Atlantis', None, None),
+            'no_footprint': ('Mombasa', 'Kisumu', Decimal('349.00'), None),
+            'dead_lane': ('Nakuru', 'Atlantis', Decimal('0'), Decimal('0')),
+        }
+        ids = {}
+        for key, (origin, destination, distance, footprint) in rows.items():
+            ids[key] = Shipment.objects.create(
+                company=company, vehicle=vehicle, origin=origin, destination=destination, weight=Decimal('1.00'),
+                origin_location=places[origin], destination_location=places[destination],
+                distance=distance, carbon_footprint=footprint, metrics_status='ok',
+            ).id
+        LaneRetry.objects.create(origin=places['Nakuru'], destination=places['Atlantis'], status='dead', attempts=8)
+        LaneRetry.objects.create(origin=places['Kisumu'], destination=places['Atlantis'], attempts=3)
+
+        apps = self.migrate()
+        Shipment = apps.get_model('api', 'Shipment')
+        LaneRetry = apps.get_model('api', 'LaneRetry')
+        statuses = dict(Shipment.objects.values_list('id', 'metrics_status'))
+        self.assertEqual({key: statuses[pk] for key, pk in ids.items()}, {
+            'priced': 'ok', 'zero': 'pending', 'no_distance': 'pending', 'no_footprint': 'pending',
+            'dead_lane': 'failed',
+        })
+
+        lanes = {
+            (lane.origin.name, lane.destination.name): lane
+            for lane in LaneRetry.objects.select_related('origin', 'destination')
+        }
+        self.assertEqual(sorted(lanes), [
+            ('Kisumu', 'Atlantis'), ('Mombasa', 'Kisumu'), ('Nairobi', 'Atlantis'), ('Nakuru', 'Atlantis'),
+        ])
+        # Lanes already queued keep their schedule; the new ones are due now
+        self.assertEqual(lanes[('Kisumu', 'Atlantis')].attempts, 3)
+        self.assertLessEqual(lanes[('Nairobi', 'Atlantis')].next_attempt_at, timezone.now())
+        self.assertEqual(lanes[('Nakuru', 'Atlantis')].status, 'dead')
+
+
+class BenchmarkTests(TestCase):
+    def test_seed_is_reproducible_and_tops_up(self):
+        ctx = benchmark.seed(5, seed=7)
+        first = list(Shipment.objects.order_by('created_at', 'pk').values_list('id', flat=True))
+        self.assertEqual(len(first), 5)
+        self.assertEqual(benchmark.seed(5, seed=7)['company'], ctx['company'])
+        self.assertEqual(Shipment.objects.count(), 5)
+
+        benchmark.seed(8, seed=7)
+        self.assertLessEqual(set(first), set(Shipment.objects.values_list('id', flat=True)))
+        self.assertEqual(Shipment.objects.count(), 8)
+        self.assertEqual(sum(EmissionRollup.objects.values_list('shipment_count', flat=True)), 8)
+        for shipment in Shipment.objects.select_related('vehicle'):
+            self.assertEqual(
+                shipment.carbon_footprint, round(shipment.distance * shipment.weight * shipment.vehicle.emission_factor, 3)
+            )
+
+        # The same seed gives the same rows from scratch, whether topped up or not
+        ids = set(Shipment.objects.values_list('id', flat=True))
+        Shipment.objects.all().delete()
+        benchmark.seed(8, seed=7)
+        self.assertEqual(set(Shipment.objects.values_list('id', flat=True)), ids)
+        Shipment.objects.all().delete()
+        benchmark.seed(8, seed=8)
+        self.assertFalse(ids & set(Shipment.objects.values_list('id', flat=True)))
+
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+        self.assertEqual([benchmark.percentile(ordered, pct) for pct in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(benchmark.percentile([5], 99), 5)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_compare(self):
+        def results(p95, rps, errors=0):
+            return {'scenarios': {'shipment_list': {'latency_ms': {'p95': p95}, 'throughput_rps': rps, 'errors': errors}}}
+
+        baseline = results(100, 50)
+        self.assertEqual(benchmark.compare(results(109, 46), baseline, 0.10), [])
+        regressions = benchmark.compare(results(120, 40, errors=2), baseline, 0.10)
+        self.assertEqual(len(regressions), 3)
+        self.assertIn("p95 100.0ms -> 120.0ms", regressions[0])
+        self.assertIn("throughput 50.0 -> 40.0", regressions[1])
+        self.assertIn("errors 0 -> 2", regressions[2])
+        # Scenarios the baseline didn't run aren't compared
+        self.assertEqual(benchmark.compare(results(500, 1), {'scenarios': {}}, 0.10), [])
+
+    def test_cleanup_keeps_the_seeded_data(self):
+        benchmark.seed(3)
+        Company.objects.create(name=f'{benchmark.BENCH_PREFIX}run-1', registration_number='X1')
+        User.objects.create_user(f'{benchmark.BENCH_PREFIX}run-1', password='pass12345')
+        User.objects.create_user('someone', password='pass12345')
+        self.assertGreater(benchmark.cleanup(), 0)
+        self.assertEqual(
+            sorted(User.objects.values_list('username', flat=True)), [benchmark.BENCH_USERNAME, 'someone']
+        )
+        self.assertEqual(list(Company.objects.values_list('name', flat=True)), ["Benchmark Logistics"])
+        self.assertEqual(Shipment.objects.count(), 3)
+
+    def test_bad_options(self):
+        with self.assertRaisesMessage(CommandError, "Unknown scenario(s): nope"):
+            call_command('benchmark', scenarios='vehicles,nope', stdout=StringIO(), stderr=StringIO())
+        with self.assertRaisesMessage(CommandError, "--clients"):
+            call_command('benchmark', clients='1,many', stdout=StringIO(), stderr=StringIO())
+
+
+class BenchmarkRunTests(TransactionTestCase):
+    """
+    The benchmark's clients run in their own threads, on their own connections,
+    so the seeded rows have to be committed.
+    """
+
+    def test_run_and_compare_with_a_baseline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            options = dict(scale=5, clients='1,2', requests=4, warmup=1, scenarios='vehicles,shipment_list', stderr=StringIO())
+            call_command('benchmark', output=output, **options)
+            with open(output) as f:
+                results = json.load(f)
+
+            self.assertEqual(
+                sorted(results['scenarios']), ['shipment_list@1', 'shipment_list@2', 'vehicles@1', 'vehicles@2']
+            )
+            for stats in results['scenarios'].values():
+                self.assertEqual((stats['requests'], stats['errors'], stats['statuses']), (4, 0, {'200': 4}))
+                latency = stats['latency_ms']
+                self.assertLessEqual(latency['p50'], latency['p95'])
+                self.assertLessEqual(latency['p99'], latency['max'])
+            meta = results['meta']
+            self.assertEqual((meta['target'], meta['scale'], meta['clients']), ('in-process', 5, [1, 2]))
+            self.assertEqual(Shipment.objects.count(), 5)
+
+            err = StringIO()
+            call_command('benchmark', baseline=output, threshold=1000, **dict(options, stderr=err, stdout=StringIO()))
+            self.assertIn("No regression", err.getvalue())
+
+            results['scenarios']['vehicles@1']['latency_ms']['p95'] = 0.001
+            with open(output, 'w') as f:
+                json.dump(results, f)
+            with self.assertRaisesMessage(CommandError, "vehicles@1: p95"):
+                call_command('benchmark', baseline=output, **dict(options, stdout=StringIO()))
+
+
+class DatasetTests(TestCase):
+    options = {
+        'days': 30, 'lane_skew': 1.1, 'company_skew': 0.9, 'batch_size': 100,
+        'now': datetime(2026, 2, 1, tzinfo=dt_timezone.utc),
+    }
+
+    @staticmethod
+    def fields(shipments):
+        return [
+            (s.id, s.company_id, s.owner_id, s.vehicle_id, s.origin_location_id, s.destination_location_id,
+             s.weight, s.distance, s.carbon_footprint, s.created_at)
+            for s in shipments
+        ]
+
+    def test_zipf_weights(self):
+        weights = zipf_weights(5, 1.1)
+        self.assertAlmostEqual(weights.sum(), 1.0)
+        self.assertTrue(all(weights[i] > weights[i + 1] for i in range(4)))
+        self.assertEqual(list(zipf_weights(4, 0)), [0.25] * 4)
+
+    def test_reference_data(self):
+        plan = create_reference_data('rd', 3, companies=2, users_per_company=5, locations=20)
+        self.assertEqual(Company.objects.filter(name__startswith='rd Company ').count(), 2)
+        self.assertEqual(Location.objects.filter(latitude__isnull=False).count(), 20)
+        # Existing places are reused by name
+        self.assertEqual(plan['location_names'][:3], ['Nairobi', 'Mombasa', 'Kisumu'])
+        self.assertEqual(len(plan['vehicle_ids']), 8)
+        users = User.objects.filter(username__startswith='rd-').select_related('profile')
+        self.assertEqual(len(users), 10)
+        self.assertEqual(sorted(u.username for u in users if u.profile.role == 'manager'), ['rd-0000-0000', 'rd-0001-0000'])
+        self.assertTrue(users[0].check_password('rd-password'))
+        # Clients own no shipments
+        owners = set(plan['owner_ids'])
+        self.assertEqual(owners, {u.id for u in users if u.profile.role != 'client'})
+
+    def test_chunks_are_reproducible(self):
+        plan = create_reference_data('rp', 3, companies=3, users_per_company=3, locations=20)
+        chunk = build_shipments(plan, 7, 0, 200, self.options)
+        self.assertEqual(self.fields(chunk), self.fields(build_shipments(plan, 7, 0, 200, self.options)))
+        self.assertNotEqual(self.fields(chunk), self.fields(build_shipments(plan, 7, 1, 200, self.options)))
+        self.assertNotEqual(self.fields(chunk), self.fields(build_shipments(plan, 8, 0, 200, self.options)))
+
+        factors = dict(zip(plan['vehicle_ids'], plan['vehicle_factors']))
+        companies = dict(Profile.objects.filter(user_id__in=plan['owner_ids']).values_list('user_id', 'company_id'))
+        for shipment in chunk:
+            self.assertNotEqual(shipment.origin_location_id, shipment.destination_location_id)
+            self.assertEqual(companies[shipment.owner_id], shipment.company_id)
+            self.assertTrue(timedelta(0) < self.options['now'] - shipment.created_at <= timedelta(days=30))
+            self.assertAlmostEqual(
+                float(shipment.carbon_footprint),
+                float(shipment.distance) * float(shipment.weight) * factors[str(shipment.vehicle_id)], places=2,
+            )
+
+
+class GenerateDatasetTests(TransactionTestCase):
+    def generate(self, **options):
+        out = StringIO()
+        options = {
+            'shipments': 250, 'companies': 3, 'users_per_company': 4, 'locations': 20, 'chunk_size': 100,
+            'until': '2026-01-31', 'days': 30, 'seed': 5, 'tag': 'gd', 'stdout': out, 'stderr': StringIO(),
+            **options,
+        }
+        call_command('generate_dataset', **options)
+        return out.getvalue()
+
+    def test_generate(self):
+        out = self.generate(workers=4)
+        self.assertIn("Generated 250 shipments with 1 worker(s)", out)
+        self.assertEqual(Shipment.objects.count(), 250)
+        self.assertEqual(set(Shipment.objects.values_list('metrics_status', flat=True)), {'ok'})
+        self.assertEqual(User.objects.filter(username__startswith='gd-').count(), 12)
+        first, last = Shipment.objects.order_by('created_at').values_list('created_at', flat=True)[::249]
+        self.assertGreaterEqual(first, datetime(2026, 1, 2, tzinfo=dt_timezone.utc))
+        self.assertLess(last, datetime(2026, 2, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(sum(EmissionRollup.objects.values_list('shipment_count', flat=True)), 250)
+
+        with self.assertRaisesMessage(CommandError, "already exists"):
+            self.generate()
+        for until in ('2026-13-01', 'January'):
+            with self.assertRaisesMessage(CommandError, "--until"):
+                self.generate(tag='gd2', until=until)
+
+    def test_skip_rollups(self):
+        self.generate(shipments=30, skip_rollups=True)
+        self.assertEqual(Shipment.objects.count(), 30)
+        self.assertFalse(EmissionRollup.objects.exists())
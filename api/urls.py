@@ -1,18 +1,28 @@
+from django.conf import settings
 from django.urls import path
-from .views import VehicleList, ShipmentList, ShipmentDetail, RegisterView, UserProfileView, RegisterCompanyView, AddEmployeeView
+from .views import VehicleList, ShipmentList, ShipmentBulkCreate, ShipmentExport, ShipmentDetail, DistanceMatrixView, RegisterView, UserProfileView, RegisterCompanyView, AddEmployeeView, EmissionAnalyticsView
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
 )
+from .async_views import AsyncShipmentDetail, AsyncShipmentList
+
+# The async views are served under an ASGI server (see Procfile)
+shipment_list = AsyncShipmentList if settings.ASYNC_VIEWS else ShipmentList
+shipment_detail = AsyncShipmentDetail if settings.ASYNC_VIEWS else ShipmentDetail
 
 urlpatterns = [
     path('vehicles/', VehicleList.as_view(), name='vehicle-list'),
-    path('shipments/', ShipmentList.as_view(), name='shipment-list'),
-    path('shipments/<uuid:pk>/', ShipmentDetail.as_view(), name='shipment-detail'),
+    path('shipments/', shipment_list.as_view(), name='shipment-list'),
+    path('shipments/bulk/', ShipmentBulkCreate.as_view(), name='shipment-bulk-create'),
+    path('shipments/export/<str:fmt>/', ShipmentExport.as_view(), name='shipment-export'),
+    path('shipments/<uuid:pk>/', shipment_detail.as_view(), name='shipment-detail'),
+    path('distance-matrix/', DistanceMatrixView.as_view(), name='distance-matrix'),
     path('register/', RegisterView.as_view(), name='auth_register'),
     path('profile/', UserProfileView.as_view(), name='user_profile'),
     path('login/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('auth/register-company/', RegisterCompanyView.as_view(), name='register-company'),
     path('company/add-employee/', AddEmployeeView.as_view(), name='add-employee'),
+    path('analytics/emissions/', EmissionAnalyticsView.as_view(), name='emission-analytics'),
 ]
\ No newline at end of file
@@ -1,10 +1,26 @@
 from rest_framework import generics, filters, permissions, views, status
-from .models import Vehicle, Shipment
-from .serializers import VehicleSerializer, ShipmentSerializer, RegisterSerializer, CompanyRegisterSerializer, AddEmployeeSerializer
+from .models import Vehicle, Shipment, EmissionRollup
+from .serializers import VehicleSerializer, ShipmentSerializer, RegisterSerializer, CompanyRegisterSerializer, AddEmployeeSerializer, DistanceMatrixSerializer
 from django_filters.rest_framework import DjangoFilterBackend
 from .permissions import IsOwnerOrReadOnly
+from .authentication import user_scope
+from .pagination import KeysetPagination
+from .rows import shipment_records, shipment_values
+from .search import ShipmentSearchFilter
 from rest_framework.response import Response
 from django.contrib.auth.models import User
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.utils.dateparse import parse_date
+from .bulk import BULK_CONTENT_TYPES, ingest_shipments, iter_rows
+from .distance import get_distance_mode
+from .export import EXPORT_FORMATS, export_rows, gzip_stream
+from .instrumentation import timed
+from .matrix import MatrixError, matrix_coordinates, stream_matrix
+from geopy.exc import GeocoderServiceError
 
 # Registration View
 class RegisterView(generics.CreateAPIView):
@@ -28,15 +44,16 @@ class VehicleList(generics.ListCreateAPIView):
     serializer_class = VehicleSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly] #Can be seen publicly but only modified by staff
 
-class ShipmentList(generics.ListCreateAPIView):
-    serializer_class = ShipmentSerializer
-    permission_classes = [permissions.IsAuthenticated] #Must be logged in to do anything
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+class ShipmentScopeMixin:
+    """
+    Role scoping and filters shared by the shipment list and export views.
+    """
+    filter_backends = [DjangoFilterBackend, ShipmentSearchFilter, filters.OrderingFilter]
     
     # Enable filtering by specific fields
     filterset_fields = ['vehicle', 'origin', 'destination']
     
-    # Enable text search across these fields
+    # Enable text search across these fields (indexed, see api/search.py)
     search_fields = ['origin', 'destination', 'id']
     
     # Allow users to order results by date or carbon footprint
@@ -44,28 +61,158 @@ class ShipmentList(generics.ListCreateAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        profile = user.profile
+        # Straight from the token claims with ClaimsJWTAuthentication
+        role, company_id = user_scope(user)
+
+        # owner.username is rendered for every row: join it instead of N lookups
+        shipments = Shipment.objects.select_related('owner')
 
         # Manager: Sees EVERYTHING for Jumia
-        if profile.role == 'manager':
-            return Shipment.objects.filter(company=profile.company)
+        if role == 'manager':
+            return shipments.filter(company_id=company_id)
 
         # Driver: Sees only shipments assigned to him
-        if profile.role == 'driver':
-            return Shipment.objects.filter(company=profile.company, owner=user)
+        if role == 'driver':
+            return shipments.filter(company_id=company_id, owner_id=user.id)
 
         # Client: Sees only his own shipments
-        return Shipment.objects.filter(owner=user, company__isnull=True)
+        return shipments.filter(owner_id=user.id, company__isnull=True)
+
+class ShipmentList(ShipmentScopeMixin, generics.ListCreateAPIView):
+    serializer_class = ShipmentSerializer
+    permission_classes = [permissions.IsAuthenticated] #Must be logged in to do anything
+
+    @property
+    def paginator(self):
+        # ?pagination=cursor (or a ?cursor= from a previous page) switches to
+        # keyset pagination, which skips the COUNT(*) and deep OFFSETs
+        if not hasattr(self, '_paginator'):
+            if KeysetPagination.is_requested(self.request):
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def list(self, request, *args, **kwargs):
+        # Read path: plain dicts from values(), no model instances or serializer
+        # fields per row. Same payload as ShipmentSerializer (see api/rows.py)
+        queryset = shipment_values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        with timed('serialize'):
+            data = shipment_records(queryset if page is None else page)
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
 
     def perform_create(self, serializer):
-        #Read the company from user's profile
-        user_company = self.request.user.profile.company
+        #Read the company from user's profile (or token claims)
+        _, company_id = user_scope(self.request.user)
 
         #save the shipment with that company automatically
-        serializer.save(company=user_company, owner=self.request.user)
+        serializer.save(company_id=company_id, owner_id=self.request.user.id)
+
+async def _aiter_chunks(chunks):
+    # Each chunk is produced in the request's sync thread, where its DB
+    # connection (and an export's server-side cursor) lives
+    chunks = iter(chunks)
+    done = object()
+    try:
+        while (chunk := await sync_to_async(next)(chunks, done)) is not done:
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            await sync_to_async(chunks.close)()
+
+
+def streaming_response(request, chunks, **kwargs):
+    """
+    StreamingHttpResponse for a sync iterator of chunks. Under ASGI Django reads
+    a sync iterator to the end before sending a byte, so there the chunks are
+    handed over as an async iterator instead.
+    """
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        chunks = _aiter_chunks(chunks)
+    return StreamingHttpResponse(chunks, **kwargs)
+
+class ShipmentBulkCreate(views.APIView):
+    """
+    Creates shipments from a manifest upload: a JSON array, NDJSON or CSV body.
+    Rows are validated with the ShipmentSerializer rules and the response streams
+    back one NDJSON result line per row. ?distance_mode=geodesic|vincenty|haversine
+    picks how distances are computed (default: the DISTANCE_MODE setting).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    # The body is read as a stream by api.bulk, not parsed up front by DRF
+    parser_classes = []
+
+    def post(self, request):
+        content_type = request.content_type.split(';')[0].strip()
+        fmt = BULK_CONTENT_TYPES.get(content_type)
+        if fmt is None:
+            return Response(
+                {"error": f"Unsupported content type. Use one of: {', '.join(BULK_CONTENT_TYPES)}."},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+
+        try:
+            distance_mode = get_distance_mode(request.query_params.get('distance_mode'))
+        except ValueError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = iter_rows(request._request, fmt)
+        _, company_id = user_scope(request.user)
+        results = ingest_shipments(rows, company_id=company_id, owner_id=request.user.id, distance_mode=distance_mode)
+        return streaming_response(request, results, content_type='application/x-ndjson')
+
+class ShipmentExport(ShipmentScopeMixin, generics.GenericAPIView):
+    """
+    Streams every shipment the user can see (same scoping and ?search=/filter/
+    ordering params as the list) as CSV or NDJSON. Rows are read through a
+    server-side cursor, so memory stays flat however big the export is.
+    Add ?compress=gzip for a gzipped download.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, fmt):
+        if fmt not in EXPORT_FORMATS:
+            return Response({"error": f"Unknown export format '{fmt}'."}, status=status.HTTP_404_NOT_FOUND)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        content_type, chunks = EXPORT_FORMATS[fmt], export_rows(queryset, fmt)
+        filename = f"shipments.{fmt}"
+        if request.query_params.get('compress') == 'gzip':
+            content_type, chunks, filename = 'application/gzip', gzip_stream(chunks), filename + '.gz'
+
+        response = streaming_response(request, chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+class DistanceMatrixView(views.APIView):
+    """
+    Distance matrix between N places, plus a CO2 matrix per vehicle asked for,
+    for comparing depots and stops without creating shipments. Coordinates come
+    from the known Locations and the geocoding cache; the body is streamed as
+    it's rendered.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        serializer = DistanceMatrixSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        try:
+            coordinates = matrix_coordinates(data['locations'])
+        except MatrixError as exc:
+            return Response({"error": str(exc), "locations": exc.places}, status=status.HTTP_400_BAD_REQUEST)
+        except GeocoderServiceError as exc:
+            return Response({"error": f"Geocoding failed: {exc}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        body = stream_matrix(data['locations'], coordinates, data['weight'], data['vehicles'], data['distance_mode'])
+        return streaming_response(request, body, content_type='application/json')
 
 class ShipmentDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Shipment.objects.all()
+    queryset = Shipment.objects.select_related('owner')
     serializer_class = ShipmentSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
 
@@ -86,7 +233,8 @@ class AddEmployeeView(views.APIView):
 
     def post(self, request):
         # SECURITY: Only managers can add employees
-        if request.user.profile.role != 'manager':
+        role, company_id = user_scope(request.user)
+        if role != 'manager':
             return Response({"error": "Only managers can add employees."}, status=403)
 
         serializer = AddEmployeeSerializer(data=request.data)
@@ -99,9 +247,81 @@ class AddEmployeeView(views.APIView):
             )
             # Link to the Manager's company
             profile = user.profile
-            profile.company = request.user.profile.company
+            profile.company_id = company_id
             profile.role = serializer.validated_data['role']
             profile.save()
             
             return Response({"message": f"Added {user.username} to {profile.company.name}"}, status=201)
-        return Response(serializer.errors, status=400)
\ No newline at end of file
+        return Response(serializer.errors, status=400)
+
+# Emissions Analytics View
+class EmissionAnalyticsView(views.APIView):
+    """
+    Total CO2 from the pre-aggregated EmissionRollup table, so the cost depends on
+    the number of buckets, not the number of shipments.
+
+    Query params: bucket=day|week|month|total, group_by=vehicle,lane,company,
+    start/end=YYYY-MM-DD and (staff only) company=<id>.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    BUCKETS = {'day': None, 'week': TruncWeek, 'month': TruncMonth, 'total': None}
+    GROUPS = {
+        'company': ['company_id'],
+        'vehicle': ['vehicle_id', 'vehicle__name'],
+        'lane': ['origin_id', 'origin__name', 'destination_id', 'destination__name'],
+    }
+
+    def get(self, request):
+        role, company_id = (None, None) if request.user.is_staff else user_scope(request.user)
+        if request.user.is_staff:
+            rollups = EmissionRollup.objects.all()
+            if request.query_params.get('company'):
+                company = request.query_params['company']
+                if not company.isdigit():
+                    return Response({"company": "Must be a company id."}, status=400)
+                rollups = rollups.filter(company_id=int(company))
+        elif role == 'manager':
+            rollups = EmissionRollup.objects.filter(company_id=company_id)
+        else:
+            return Response({"error": "Only managers can view company analytics."}, status=403)
+
+        bucket = request.query_params.get('bucket', 'month')
+        if bucket not in self.BUCKETS:
+            return Response({"bucket": f"Must be one of: {', '.join(self.BUCKETS)}."}, status=400)
+
+        group_by = [g for g in request.query_params.get('group_by', '').split(',') if g]
+        unknown = set(group_by) - set(self.GROUPS)
+        if unknown:
+            return Response({"group_by": f"Unknown grouping: {', '.join(sorted(unknown))}."}, status=400)
+
+        for param, lookup in (('start', 'day__gte'), ('end', 'day__lte')):
+            if request.query_params.get(param):
+                try:
+                    value = parse_date(request.query_params[param])
+                except ValueError:
+                    value = None
+                if value is None:
+                    return Response({param: "Use the YYYY-MM-DD format."}, status=400)
+                rollups = rollups.filter(**{lookup: value})
+
+        fields = [field for group in group_by for field in self.GROUPS[group]]
+        if bucket == 'day':
+            rollups = rollups.annotate(period=F('day'))
+        elif bucket != 'total':
+            rollups = rollups.annotate(period=self.BUCKETS[bucket]('day'))
+        if bucket != 'total':
+            fields.insert(0, 'period')
+
+        totals = dict(
+            shipments=Sum('shipment_count'),
+            total_co2=Sum('total_co2'),
+            total_distance=Sum('total_distance'),
+            total_weight=Sum('total_weight'),
+        )
+        if fields:
+            results = list(rollups.values(*fields).annotate(**totals).order_by(*fields))
+        else:
+            results = [rollups.aggregate(**totals)]
+
+        return Response({"bucket": bucket, "group_by": group_by, "results": results})
@@ -54,8 +54,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost, so its timings cover the whole request
+    'api.instrumentation.ServerTimingMiddleware',
+    # Brotli or gzip, whichever the client accepts; before anything that sets the body
+    'api.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # WhiteNoise, usable in async mode too so the ASGI views stay on the event loop
+    'api.middleware.AsyncWhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -87,10 +92,12 @@ WSGI_APPLICATION = 'green_path.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
+# Persistent connections are per thread. Under ASGI every request runs its sync
+# code in a new thread, so set DB_CONN_MAX_AGE=0 there (see Procfile)
 DATABASES = {
     'default': dj_database_url.config(
         default=env('DATABASE_URL'),
-        conn_max_age=600,
+        conn_max_age=env.int('DB_CONN_MAX_AGE', default=600),
         ssl_require=not DEBUG
     )
 }
@@ -144,23 +151,127 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.ClaimsJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
+    # Same bytes as DRF's JSONRenderer, rendered by orjson
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10 #limit the number of items to 10 per page
 }
 
+# Upper bound for ?page_size= with cursor pagination
+MAX_PAGE_SIZE = env.int('MAX_PAGE_SIZE', default=100)
+
+# Access tokens carry role/company claims so requests don't load the profile
+SIMPLE_JWT = {
+    'TOKEN_OBTAIN_SERIALIZER': 'api.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'api.authentication.ClaimsTokenRefreshSerializer',
+    'TOKEN_USER_CLASS': 'api.authentication.ClaimsUser',
+}
+
+# Profile versions used to reject stale token claims are cached here. Use a
+# shared cache (e.g. CACHE_URL=redis://127.0.0.1:6379/1) with several processes
+CACHES = {'default': env.cache('CACHE_URL', default='locmemcache://')}
+# How long a process trusts its cached profile version
+AUTH_PROFILE_VERSION_TTL = env.int('AUTH_PROFILE_VERSION_TTL', default=60)
+
+# Request instrumentation: Server-Timing header on every response (it shows
+# timings to any client, so on by default only with DEBUG), and the Prometheus
+# histograms at /metrics, served only to a bearer METRICS_TOKEN (off when unset)
+SERVER_TIMING_HEADER = env.bool('SERVER_TIMING_HEADER', default=DEBUG)
+METRICS_TOKEN = env('METRICS_TOKEN', default=None)
+
+# Serve the shipment list/detail endpoints with the async views in
+# api/async_views.py. Only worth it under an ASGI server (see Procfile)
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
 
-""" # Celery Settings
-CELERY_BROKER_URL = 'redis://127.0.0.1:6379/0'
-CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/0'
-""" 
+
+# Celery Settings, e.g. CELERY_BROKER_URL=redis://127.0.0.1:6379/0
+CELERY_BROKER_URL = env('CELERY_BROKER_URL', default=None)
+CELERY_RESULT_BACKEND = env('CELERY_RESULT_BACKEND', default=None)
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TASK_ALWAYS_EAGER = True
-CELERY_TASK_EAGER_PROPAGATES = True 
\ No newline at end of file
+CELERY_TASK_ALWAYS_EAGER = env.bool('CELERY_TASK_ALWAYS_EAGER', default=False)
+CELERY_TASK_EAGER_PROPAGATES = True 
+
+# Where shipment metric jobs run after commit: 'celery' (needs a broker),
+# 'local' (in-process thread pool) or 'eager' (inline, blocks the request)
+METRICS_DISPATCH = env('METRICS_DISPATCH', default='celery' if CELERY_BROKER_URL else 'local')
+LOCAL_WORKER_THREADS = env.int('LOCAL_WORKER_THREADS', default=4)
+# Past METRICS_BATCH_THRESHOLD jobs per second (0: never), shipment metric jobs are
+# buffered for up to METRICS_BATCH_WINDOW seconds and sent as one batch job
+METRICS_BATCH_THRESHOLD = env.int('METRICS_BATCH_THRESHOLD', default=20)
+METRICS_BATCH_WINDOW = env.float('METRICS_BATCH_WINDOW', default=0.2)
+METRICS_BATCH_SIZE = env.int('METRICS_BATCH_SIZE', default=500)  # sent right away once this many are waiting
+# Shipments still 'pending' this many seconds after creation, with no lane retry to
+# wait on, lost their job (a crash, a broker outage): the retry run sends it again
+METRICS_STALE_AFTER = env.int('METRICS_STALE_AFTER', default=300)
+
+# Geocoding cache: in-process LRU in front of the GeocodeCacheEntry table
+GEOCODE_CACHE_SIZE = env.int('GEOCODE_CACHE_SIZE', default=10000)
+GEOCODE_CACHE_TTL = env.int('GEOCODE_CACHE_TTL', default=86400)  # seconds
+
+# Route cache: number of hottest lanes each Celery worker keeps in memory (loaded
+# when the worker process starts) and how many hits are buffered per write
+ROUTE_CACHE_PINNED_LANES = env.int('ROUTE_CACHE_PINNED_LANES', default=500)
+ROUTE_STATS_FLUSH_EVERY = env.int('ROUTE_STATS_FLUSH_EVERY', default=100)
+
+# Geocoder backends, tried in order on a cache miss. With a local gazetteer
+# (GeoNames-style TSV) configured, Nominatim is only the fallback.
+GEOCODER_GAZETTEER_PATH = env('GEOCODER_GAZETTEER_PATH', default=None)
+GEOCODER_BACKENDS = env.list('GEOCODER_BACKENDS', default=(
+    ['api.geocoders.GazetteerGeocoder', 'api.geocoders.NominatimGeocoder']
+    if GEOCODER_GAZETTEER_PATH else ['api.geocoders.NominatimGeocoder']
+))
+
+# Simulated lookup time of api.geocoders.DeterministicGeocoder (benchmarks only)
+GEOCODER_FAKE_LATENCY = env.float('GEOCODER_FAKE_LATENCY', default=0)
+
+# Geocoder client: lookups run concurrently and Nominatim calls are throttled
+# by a token bucket kept in the cache (shared by all workers when CACHE_URL is
+# a shared cache such as Redis, per process otherwise)
+GEOCODER_CONCURRENCY = env.int('GEOCODER_CONCURRENCY', default=4)  # lookups in flight per process
+GEOCODER_TIMEOUT = env.float('GEOCODER_TIMEOUT', default=5)  # seconds per Nominatim request
+GEOCODER_RATE_LIMIT = env.float('GEOCODER_RATE_LIMIT', default=1.0)  # Nominatim requests per second
+GEOCODER_RATE_BURST = env.int('GEOCODER_RATE_BURST', default=1)
+GEOCODER_QUEUE_TIMEOUT = env.float('GEOCODER_QUEUE_TIMEOUT', default=10)  # longest wait for a token, in seconds
+GEOCODER_QUEUE_SIZE = env.int('GEOCODER_QUEUE_SIZE', default=20)  # lookups waiting per process before failing fast
+
+# Lanes whose places fail to geocode are retried in the background with exponential
+# backoff (api/retries.py): every GEOCODE_RETRY_INTERVAL seconds (Celery beat, or
+# `manage.py retry_geocoding` from cron), dead-lettered after GEOCODE_RETRY_MAX_ATTEMPTS
+GEOCODE_RETRY_INTERVAL = env.float('GEOCODE_RETRY_INTERVAL', default=60)
+GEOCODE_RETRY_BASE_DELAY = env.float('GEOCODE_RETRY_BASE_DELAY', default=60)  # seconds before the first retry
+GEOCODE_RETRY_MAX_DELAY = env.float('GEOCODE_RETRY_MAX_DELAY', default=6 * 3600)
+GEOCODE_RETRY_MAX_ATTEMPTS = env.int('GEOCODE_RETRY_MAX_ATTEMPTS', default=8)
+GEOCODE_RETRY_BATCH_SIZE = env.int('GEOCODE_RETRY_BATCH_SIZE', default=100)  # lanes per run
+CELERY_BEAT_SCHEDULE = {
+    'retry-geocoding': {'task': 'api.tasks.retry_geocoding_task', 'schedule': GEOCODE_RETRY_INTERVAL},
+}
+
+# How shipment distances are computed: 'geodesic' (exact), 'vincenty' or 'haversine'
+# (fastest, within 0.6%). See api/distance.py
+DISTANCE_MODE = env('DISTANCE_MODE', default='geodesic')
+
+# Distance matrix endpoint: caps per request, and its default mode (vincenty: exact
+# to the millimetre, fast enough for a 1000 x 1000 matrix)
+DISTANCE_MATRIX_MODE = env('DISTANCE_MATRIX_MODE', default='vincenty')
+DISTANCE_MATRIX_MAX_LOCATIONS = env.int('DISTANCE_MATRIX_MAX_LOCATIONS', default=1000)
+DISTANCE_MATRIX_MAX_GEODESIC_LOCATIONS = env.int('DISTANCE_MATRIX_MAX_GEODESIC_LOCATIONS', default=100)
+DISTANCE_MATRIX_MAX_VEHICLES = env.int('DISTANCE_MATRIX_MAX_VEHICLES', default=10)  # each one adds an N×N CO2 matrix (~1.8MB at 500 places)
+DISTANCE_MATRIX_MAX_GEOCODE = env.int('DISTANCE_MATRIX_MAX_GEOCODE', default=10)  # never-seen places looked up per request
+DISTANCE_MATRIX_CHUNK_ROWS = env.int('DISTANCE_MATRIX_CHUNK_ROWS', default=100)  # matrix rows per streamed chunk
+
+# Bulk shipment ingestion: rows validated, inserted and priced per chunk
+BULK_INGEST_CHUNK_SIZE = env.int('BULK_INGEST_CHUNK_SIZE', default=1000)
+
+# Shipment export: rows fetched per server-side cursor round trip
+EXPORT_CHUNK_SIZE = env.int('EXPORT_CHUNK_SIZE', default=2000)